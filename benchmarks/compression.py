@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013 met.no
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compares the time taken to write an index file in each of the compression
+formats supported by python-apt-repo-setup.py, and the sizes of the results.
+"""
+
+import imp, os, shutil, sys, tempfile, time
+
+this_dir = os.path.split(os.path.abspath(__file__))[0]
+repo_setup = imp.load_source("repo_setup", os.path.join(this_dir, os.pardir, "python-apt-repo-setup.py"))
+
+default_types = "gz:6 gz:9 bz2:9 xz:6 xz:9 zst:3 zst:19"
+
+def synthetic_index(size):
+
+    # Create the text of a Packages file of approximately the given size.
+    pieces = []
+    total = 0
+    i = 0
+    
+    while total < size:
+        text = ("Package: package%i\n"
+                "Version: 1.%i-1\n"
+                "Architecture: amd64\n"
+                "Maintainer: Maintainer <maintainer@example.com>\n"
+                "Depends: libc6 (>= 2.15), libpackage%i (= 1.%i-1)\n"
+                "Section: utils\n"
+                "Priority: optional\n"
+                "Description: synthetic package %i\n"
+                " This package was generated for benchmarking purposes.\n"
+                "Filename: dists/lucid/main/binary-amd64/utils/package%i_1.%i-1_amd64.deb\n"
+                "Size: %i\n"
+                "MD5Sum: %032x\n"
+                "SHA1: %040x\n"
+                "SHA256: %064x\n\n") % (i, i, i, i, i, i, i, 1000 + i, i, i * 7, i * 13)
+        pieces.append(text)
+        total += len(text)
+        i += 1
+    
+    return "".join(pieces)
+
+def write_index(path, text, compression_types):
+
+    writer = repo_setup.IndexWriter(path, compression_types)
+    
+    # Write the text in pieces of a similar size to the stanzas of an index.
+    for i in range(0, len(text), 4096):
+        writer.write(text[i:i + 4096])
+    
+    writer.close()
+
+def benchmark(text, compression_types, temp_dir):
+
+    path = os.path.join(temp_dir, "Packages")
+    
+    print "%-8s %10s %10s %8s" % ("Format", "Time (s)", "Size", "Ratio")
+    
+    for compression_type in compression_types:
+    
+        start = time.time()
+        write_index(path, text, [compression_type])
+        elapsed = time.time() - start
+        
+        ext, level = compression_type
+        size = os.stat(path + "." + ext).st_size
+        name = repo_setup.format_compression([compression_type])
+        
+        print "%-8s %10.3f %10i %8.3f" % (name, elapsed, size, float(size) / len(text))
+    
+    # Compare writing all the formats at once with writing them one at a time.
+    start = time.time()
+    write_index(path, text, compression_types)
+    elapsed = time.time() - start
+    
+    print
+    print "All formats in one pass: %.3f s" % elapsed
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[:]
+    size = 60
+    
+    try:
+        if "--size" in args:
+            at = args.index("--size")
+            size = int(args[at + 1])
+            del args[at:at + 2]
+    except (IndexError, ValueError):
+        args = []
+    
+    if not args or len(args) > 3 or "-h" in args or "--help" in args:
+        sys.stderr.write("Usage: %s [<Packages file> | --size <megabytes>] [<formats>]\n" % sys.argv[0])
+        sys.stderr.write("Formats are given as a quoted list, defaulting to \"%s\".\n" % default_types)
+        sys.exit(1)
+    
+    if len(args) > 1 and os.path.isfile(args[1]):
+        text = open(args[1]).read()
+        del args[1]
+    else:
+        text = synthetic_index(size * 1024 * 1024)
+    
+    if len(args) > 1:
+        compression_types = repo_setup.parse_compression(args[1])
+    else:
+        compression_types = repo_setup.parse_compression(default_types)
+    
+    print "Index size: %i bytes" % len(text)
+    print
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        benchmark(text, compression_types, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    sys.exit()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013 met.no
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compares the time taken to place a batch of files in a repository using each of
+the modes accepted by the --link-mode option of the add command, reporting the
+methods that were actually used after falling back from unsupported ones. The
+files are created in a directory on the file system being tested.
+"""
+
+import imp, os, shutil, sys, tempfile, time
+
+this_dir = os.path.split(os.path.abspath(__file__))[0]
+repo_setup = imp.load_source("repo_setup", os.path.join(this_dir, os.pardir, "python-apt-repo-setup.py"))
+
+default_modes = "hardlink reflink range copy"
+
+def create_files(path, size, count):
+
+    # Create the given number of files with a total size of approximately the given
+    # number of bytes.
+    block = os.urandom(1024 * 1024)
+    file_size = size / count
+    paths = []
+    
+    for i in range(count):
+    
+        file_path = os.path.join(path, "package%i_1.0-1_amd64.deb" % i)
+        f = open(file_path, "wb")
+        written = 0
+        while written < file_size:
+            data = block[:file_size - written]
+            f.write(data)
+            written += len(data)
+        f.close()
+        paths.append(file_path)
+    
+    return paths
+
+def place_files(paths, dest_dir, mode):
+
+    # Return a dictionary mapping the copy methods used to the number of files that
+    # each of them copied.
+    methods = {}
+    
+    for path in paths:
+        dest_path = os.path.join(dest_dir, os.path.split(path)[1])
+        method = repo_setup.copy_file(path, dest_path, mode)
+        methods[method] = methods.get(method, 0) + 1
+    
+    return methods
+
+def benchmark(paths, size, modes, temp_dir):
+
+    print "%-10s %10s %12s  %s" % ("Mode", "Time (s)", "MB/s", "Methods used")
+    
+    for mode in modes:
+    
+        dest_dir = os.path.join(temp_dir, "dest")
+        os.mkdir(dest_dir)
+        
+        # Messages from copy_file are discarded while timing.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = time.time()
+            methods = place_files(paths, dest_dir, mode)
+            os.system("sync")
+            elapsed = time.time() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        
+        used = ", ".join(map(lambda (method, count): "%s (%i)" % (method, count),
+                             sorted(methods.items())))
+        print "%-10s %10.3f %12.1f  %s" % (mode, elapsed, size / 1048576.0 / max(elapsed, 0.001), used)
+        
+        shutil.rmtree(dest_dir)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[:]
+    size = 2048
+    count = 32
+    directory = None
+    
+    try:
+        if "--size" in args:
+            at = args.index("--size")
+            size = int(args[at + 1])
+            del args[at:at + 2]
+        if "--files" in args:
+            at = args.index("--files")
+            count = int(args[at + 1])
+            del args[at:at + 2]
+        if "--dir" in args:
+            at = args.index("--dir")
+            directory = args[at + 1]
+            del args[at:at + 2]
+    except (IndexError, ValueError):
+        args = []
+    
+    if not args or len(args) > 2 or "-h" in args or "--help" in args or count < 1:
+        sys.stderr.write("Usage: %s [--size <megabytes>] [--files <number>] [--dir <directory>] [<modes>]\n" % sys.argv[0])
+        sys.stderr.write("Modes are given as a quoted list, defaulting to \"%s\".\n" % default_modes)
+        sys.exit(1)
+    
+    if len(args) > 1:
+        modes = args[1].split()
+    else:
+        modes = default_modes.split()
+    
+    for mode in modes:
+        if mode not in repo_setup.copy_methods:
+            sys.stderr.write("Unknown mode: %s\n" % mode)
+            sys.exit(1)
+    
+    temp_dir = tempfile.mkdtemp(dir = directory)
+    try:
+        source_dir = os.path.join(temp_dir, "source")
+        os.mkdir(source_dir)
+        paths = create_files(source_dir, size * 1024 * 1024, count)
+        
+        print "Files: %i, total size: %i MB" % (count, size)
+        print
+        benchmark(paths, size * 1024 * 1024, modes, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    sys.exit()
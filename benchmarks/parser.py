@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013 met.no
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compares the throughput and peak memory use of the stanza parser used by
+python-apt-repo-setup.py with the parser it replaced, reading a Packages file.
+Each parser is run in a separate process so that their peak memory use can be
+measured independently.
+"""
+
+import imp, os, resource, shutil, subprocess, sys, tempfile, time
+
+this_dir = os.path.split(os.path.abspath(__file__))[0]
+repo_setup = imp.load_source("repo_setup", os.path.join(this_dir, os.pardir, "python-apt-repo-setup.py"))
+read_stanzas = repo_setup.read_stanzas
+
+def legacy_read_entry(lines):
+
+    # The parser previously used by PackageFile._read_entry.
+    previous = None
+    info = {}
+    headings = []
+    kept_lines = []
+    
+    for line in lines:
+    
+        kept_lines.append(line)
+        
+        if not line.strip():
+            if info:
+                yield info, headings, kept_lines
+                info = {}
+                headings = []
+                kept_lines = []
+            else:
+                continue
+        
+        elif not line.startswith(" "):
+            at = line.find(":")
+            heading = line[:at]
+            value = line[at+1:].strip()
+            if value == "":
+                info[heading] = []
+            else:
+                info[heading] = value
+            
+            previous = heading
+            if heading not in headings:
+                headings.append(heading)
+        
+        elif previous:
+            if isinstance(info[previous], list):
+                info[previous].append(line.strip())
+            else:
+                info[previous] += line.rstrip()
+    
+    if info:
+        yield info, headings, kept_lines
+
+def write_packages_file(path, count):
+
+    f = open(path, "w")
+    
+    for i in xrange(count):
+        f.write("Package: package%i\n"
+                "Version: 1.%i-1\n"
+                "Architecture: amd64\n"
+                "Maintainer: Maintainer <maintainer@example.com>\n"
+                "Installed-Size: %i\n"
+                "Depends: libc6 (>= 2.15), libpackage%i (= 1.%i-1)\n"
+                "Section: utils\n"
+                "Priority: optional\n"
+                "Description: synthetic package %i\n"
+                " This package was generated for benchmarking purposes. Its long\n"
+                " description is spread over several lines, as many are.\n"
+                " .\n"
+                " The last paragraph of the description.\n"
+                "Filename: dists/lucid/main/binary-amd64/utils/package%i_1.%i-1_amd64.deb\n"
+                "Size: %i\n"
+                "MD5Sum: %032x\n"
+                "SHA1: %040x\n"
+                "SHA256: %064x\n\n" % (i, i, 100 + i, i, i, i, i, i, 1000 + i, i, i * 7, i * 13))
+    
+    f.close()
+
+def run(parser, path):
+
+    # Keep every record, as Packages.read does, and look up the fields that it uses.
+    records = []
+    
+    start = time.time()
+    f = open(path)
+    
+    if parser == "legacy":
+        for info, headings, lines in legacy_read_entry(f.readlines()):
+            info["Package"], info["Filename"]
+            records.append((info, headings, lines))
+    else:
+        for stanza in read_stanzas(f):
+            stanza["Package"], stanza["Filename"]
+            records.append(stanza)
+    
+    f.close()
+    elapsed = time.time() - start
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%s %i %f %i" % (parser, len(records), elapsed, peak)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[:]
+    
+    if len(args) == 4 and args[1] == "--run":
+        run(args[2], args[3])
+        sys.exit()
+    
+    count = 100000
+    if len(args) == 2:
+        count = int(args[1])
+    elif len(args) != 1:
+        sys.stderr.write("Usage: %s [<number of stanzas>]\n" % args[0])
+        sys.exit(1)
+    
+    temp_dir = tempfile.mkdtemp()
+    
+    try:
+        path = os.path.join(temp_dir, "Packages")
+        write_packages_file(path, count)
+        size = os.stat(path).st_size
+        
+        print "Packages file: %i stanzas, %i bytes" % (count, size)
+        print
+        print "%-8s %10s %14s %14s" % ("Parser", "Time (s)", "Stanzas/s", "Peak RSS (KB)")
+        
+        for parser in "legacy", "stanza":
+            output = subprocess.Popen([sys.executable, __file__, "--run", parser, path],
+                                      stdout=subprocess.PIPE).communicate()[0]
+            name, records, elapsed, peak = output.split()
+            print "%-8s %10.3f %14.0f %14s" % (name, float(elapsed), int(records) / float(elapsed), peak)
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    sys.exit()
@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013 met.no
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Generates a synthetic repository and measures the time taken by each command of
+python-apt-repo-setup.py to build, update, sign and prune it, and by the FTP
+scripts to upload it to a local server that delays each command to simulate a
+distant one. The packages and sources are generated in Python with fixed contents
+so that the same parameters always produce the same files. The results are
+written as JSON with sorted keys so that runs of different versions can be
+compared with the --baseline option.
+"""
+
+import base64, ConfigParser, cStringIO, gzip, hashlib, imp, json, logging, os
+import platform, random, shutil, subprocess, sys, tarfile, tempfile, threading, time
+
+# The FTP server is optional. Without it, the FTP scripts are not measured.
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    FTPHandler = None
+
+this_dir = os.path.split(os.path.abspath(__file__))[0]
+package_dir = os.path.join(this_dir, os.pardir)
+repo_setup_path = os.path.join(package_dir, "python-apt-repo-setup.py")
+repo_setup = imp.load_source("repo_setup", repo_setup_path)
+
+# The version of the format of the results, which changes if their structure does.
+results_format = 1
+
+architecture_names = ["amd64", "i386", "arm64", "armhf", "ppc64el", "s390x", "mips64el",
+                      "riscv64"]
+
+# All files are given this modification time so that their archives are the same on
+# every run.
+fixed_mtime = 1356998400
+
+ftp_user = "benchmark"
+ftp_password = "benchmark"
+
+# Package generation
+
+class Generator:
+
+    # Writes packages and sources whose contents are determined by the seed. Each
+    # package contains a payload of the given size, made from a block of random
+    # data that is rotated differently for each package so that no two packages
+    # compress into each other.
+    
+    def __init__(self, size, seed = 0):
+    
+        self.size = size
+        self.random = random.Random(seed)
+        self.block = "".join(map(lambda i: chr(self.random.randrange(256)), range(65536)))
+    
+    def payload(self, name):
+    
+        offset = int(hashlib.sha1(name).hexdigest()[:8], 16) % len(self.block)
+        block = self.block[offset:] + self.block[:offset]
+        data = (name + "\n" + block * (self.size / len(block) + 1))[:self.size]
+        return data
+    
+    def tar_gz(self, members):
+    
+        # Return a gzip-compressed tar archive containing the (name, data) members.
+        output = cStringIO.StringIO()
+        gz = gzip.GzipFile("", "wb", 6, output, fixed_mtime)
+        tar = tarfile.open(fileobj = gz, mode = "w", format = tarfile.GNU_FORMAT)
+        
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = fixed_mtime
+            info.mode = 0644
+            info.uname = info.gname = "root"
+            tar.addfile(info, cStringIO.StringIO(data))
+        
+        tar.close()
+        gz.close()
+        return output.getvalue()
+    
+    def ar(self, members):
+    
+        # Return an ar archive containing the (name, data) members, as used by .deb
+        # files.
+        pieces = ["!<arch>\n"]
+        for name, data in members:
+            pieces.append("%-16s%-12i%-6i%-6i%-8s%-10i`\n" % (name, fixed_mtime, 0, 0,
+                                                               "100644", len(data)))
+            pieces.append(data)
+            if len(data) % 2:
+                pieces.append("\n")
+        
+        return "".join(pieces)
+    
+    def deb(self, name, version, architecture):
+    
+        files = [("./usr/bin/" + name, "#!/bin/sh\necho %s %s\n" % (name, version)),
+                 ("./usr/share/doc/%s/copyright" % name, "Generated for benchmarking.\n"),
+                 ("./usr/lib/%s/data" % name, self.payload("%s_%s_%s" % (name, version, architecture)))]
+        
+        control = ("Package: %s\n"
+                   "Source: %s\n"
+                   "Version: %s\n"
+                   "Architecture: %s\n"
+                   "Maintainer: Benchmark <benchmark@example.com>\n"
+                   "Installed-Size: %i\n"
+                   "Section: utils\n"
+                   "Priority: optional\n"
+                   "Description: Synthetic package for benchmarks\n"
+                   " This package was generated by benchmarks/repository.py.\n") % (
+                   name, name, version, architecture, self.size / 1024 + 1)
+        
+        md5sums = "".join(map(lambda (path, data): "%s  %s\n" % (hashlib.md5(data).hexdigest(), path[2:]), files))
+        
+        return self.ar([("debian-binary", "2.0\n"),
+                        ("control.tar.gz", self.tar_gz([("./control", control), ("./md5sums", md5sums)])),
+                        ("data.tar.gz", self.tar_gz(files))])
+    
+    def source(self, name, version, architectures):
+    
+        # Return a dictionary mapping the names of the original and diff archives of
+        # a source to their contents, and the text of its control file.
+        upstream = version.split("-")[0]
+        orig_name = "%s_%s.orig.tar.gz" % (name, upstream)
+        diff_name = "%s_%s.diff.gz" % (name, version)
+        
+        files = {
+            orig_name: self.tar_gz([("%s-%s/README" % (name, upstream), "Upstream source of %s.\n" % name)]),
+            diff_name: gzip_data("--- %s-%s/debian/changelog\n+++ %s-%s/debian/changelog\n" % (
+                                 name, upstream, name, upstream))
+            }
+        
+        dsc = ("Format: 1.0\n"
+               "Source: %s\n"
+               "Binary: %s\n"
+               "Architecture: any\n"
+               "Version: %s\n"
+               "Maintainer: Benchmark <benchmark@example.com>\n"
+               "Standards-Version: 3.9.3\n"
+               "Package-List:\n"
+               " %s deb utils optional arch=%s\n") % (name, name, version, name, ",".join(architectures))
+        
+        for heading, algorithm in (("Checksums-Sha1", "sha1"), ("Checksums-Sha256", "sha256"),
+                                   ("Files", "md5")):
+            dsc += heading + ":\n"
+            for file_name in sorted(files):
+                data = files[file_name]
+                dsc += " %s %i %s\n" % (hashlib.new(algorithm, data).hexdigest(), len(data), file_name)
+        
+        return files, dsc
+
+def gzip_data(data):
+
+    output = cStringIO.StringIO()
+    gz = gzip.GzipFile("", "wb", 9, output, fixed_mtime)
+    gz.write(data)
+    gz.close()
+    return output.getvalue()
+
+def crc24(data):
+
+    # The checksum used in ASCII armour (RFC 4880, section 6.1).
+    crc = 0xb704ce
+    for char in data:
+        crc ^= ord(char) << 16
+        for i in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864cfb
+    return crc & 0xffffff
+
+def clearsign(text, use_gpg):
+
+    # Return the text wrapped in a clearsigned message. The signature is made by gpg
+    # using its default key if requested, or is otherwise an armoured block of the
+    # right form that does not verify, which is enough for the signature to be
+    # removed when signatures are not checked.
+    if use_gpg:
+        s = subprocess.Popen(["gpg", "--batch", "--yes", "--clearsign"], stdin = subprocess.PIPE,
+                             stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        output, errors = s.communicate(text)
+        if s.returncode != 0:
+            raise RuntimeError("Failed to sign a source file: %s" % errors.strip())
+        return output
+    
+    signature = hashlib.sha256(text).digest() * 2
+    checksum = "".join(map(lambda shift: chr((crc24(signature) >> shift) & 0xff), (16, 8, 0)))
+    
+    return ("-----BEGIN PGP SIGNED MESSAGE-----\n"
+            "Hash: SHA256\n\n" + text +
+            "-----BEGIN PGP SIGNATURE-----\n\n" +
+            base64.b64encode(signature) + "\n"
+            "=" + base64.b64encode(checksum) + "\n"
+            "-----END PGP SIGNATURE-----\n")
+
+def generate(path, packages, versions, architectures, size, signed, use_gpg):
+
+    # Write packages * versions * architectures .deb files and packages * versions
+    # sources to the directory, signing the given fraction of the sources. Return the
+    # names of the packages.
+    generator = Generator(size)
+    names = []
+    signed_count = 0
+    
+    for i in range(packages):
+    
+        name = "bench%04i" % i
+        names.append(name)
+        
+        for j in range(versions):
+        
+            version = "1.%i-1" % j
+            
+            for architecture in architectures:
+                write_file(os.path.join(path, "%s_%s_%s.deb" % (name, version, architecture)),
+                           generator.deb(name, version, architecture))
+            
+            files, dsc = generator.source(name, version, architectures)
+            for file_name, data in files.items():
+                write_file(os.path.join(path, file_name), data)
+            
+            # Sign the sources evenly through the set.
+            number = i * versions + j + 1
+            if signed_count < int(number * signed):
+                dsc = clearsign(dsc, use_gpg)
+                signed_count += 1
+            
+            write_file(os.path.join(path, "%s_%s.dsc" % (name, version)), dsc)
+    
+    return names
+
+def write_file(path, data):
+
+    f = open(path, "wb")
+    f.write(data)
+    f.close()
+
+# FTP server
+
+def start_ftp_server(root_path, latency):
+
+    # Start a server on a free local port in a separate thread, returning the server
+    # and its address. Each command sent to the server is delayed by the latency.
+    class LatencyHandler(FTPHandler):
+    
+        def process_command(self, cmd, *args, **kwargs):
+            time.sleep(latency)
+            FTPHandler.process_command(self, cmd, *args, **kwargs)
+    
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(ftp_user, ftp_password, root_path, perm = "elradfmwMT")
+    LatencyHandler.authorizer = authorizer
+    
+    # Only report problems with the server.
+    logger = logging.getLogger("pyftpdlib")
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.WARNING)
+    
+    server = ThreadedFTPServer(("127.0.0.1", 0), LatencyHandler)
+    thread = threading.Thread(target = server.serve_forever, kwargs = {"handle_exit": False})
+    thread.daemon = True
+    thread.start()
+    
+    return server, "%s:%i" % server.address[:2]
+
+# Measurements
+
+class Runner:
+
+    # Runs commands, recording the time taken by each step and merging the reports
+    # written by the --stats option of the repository tool.
+    
+    def __init__(self, work_dir):
+    
+        self.work_dir = work_dir
+        self.log_path = os.path.join(work_dir, "log")
+        self.steps = {}
+        self.order = []
+    
+    def run(self, step, command, stdin = None, stats = True):
+    
+        stats_path = os.path.join(self.work_dir, "stats.json")
+        if stats:
+            command = command[:2] + ["--quiet", "--stats", stats_path] + command[2:]
+        
+        log = open(self.log_path, "a")
+        log.write("$ " + " ".join(command) + "\n")
+        log.flush()
+        
+        # The FTP scripts read the password from standard input when they are run
+        # without a terminal.
+        start = time.time()
+        s = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = log, stderr = log,
+                             preexec_fn = os.setsid)
+        s.communicate(stdin)
+        elapsed = time.time() - start
+        log.close()
+        
+        if s.returncode != 0:
+            raise RuntimeError("Command failed with status %i: %s (see %s)" % (
+                s.returncode, " ".join(command), self.log_path))
+        
+        report = {}
+        if stats:
+            report = json.load(open(stats_path))
+            os.remove(stats_path)
+        
+        self.record(step, elapsed, report)
+    
+    def record(self, step, elapsed, report):
+    
+        if step not in self.steps:
+            self.order.append(step)
+            self.steps[step] = {"seconds": 0.0, "runs": 0, "phases": {}, "counters": {},
+                                "peak_rss_kb": 0}
+        
+        entry = self.steps[step]
+        entry["seconds"] = round(entry["seconds"] + elapsed, 6)
+        entry["runs"] += 1
+        
+        for phase, values in report.get("phases", {}).items():
+            merged = entry["phases"].setdefault(phase, {"seconds": 0.0, "calls": 0})
+            merged["seconds"] = round(merged["seconds"] + values["seconds"], 6)
+            merged["calls"] += values["calls"]
+        
+        for name, value in report.get("counters", {}).items():
+            entry["counters"][name] = entry["counters"].get(name, 0) + value
+        
+        entry["peak_rss_kb"] = max(entry["peak_rss_kb"], report.get("peak_rss_kb", 0),
+                                   report.get("peak_child_rss_kb", 0))
+
+def revision():
+
+    # Return the revision of the working copy being measured, if it is known.
+    try:
+        s = subprocess.Popen(["git", "rev-parse", "HEAD"], cwd = package_dir,
+                             stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        output = s.communicate()[0].strip()
+    except OSError:
+        return None
+    
+    return s.returncode == 0 and output or None
+
+def apply_settings(root_path, settings):
+
+    # Change the settings written by the create command, given as a list of
+    # (section, option, value) tuples.
+    path = os.path.join(root_path, repo_setup.state_dir_name, repo_setup.settings_name)
+    parser = ConfigParser.RawConfigParser()
+    parser.read(path)
+    
+    for section, option, value in settings:
+        if not parser.has_section(section):
+            parser.add_section(section)
+        parser.set(section, option, value)
+    
+    f = open(path, "w")
+    parser.write(f)
+    f.close()
+
+def benchmark(work_dir, parameters):
+
+    input_dir = os.path.join(work_dir, "input")
+    root_path = os.path.join(work_dir, "repo")
+    os.mkdir(input_dir)
+    
+    suites = map(lambda i: "suite%i" % (i + 1), range(parameters["suites"]))
+    architectures = architecture_names[:parameters["architectures"]]
+    
+    runner = Runner(work_dir)
+    
+    start = time.time()
+    names = generate(input_dir, parameters["packages"], parameters["versions"], architectures,
+                     parameters["size"], parameters["signed"], parameters["gpg"])
+    runner.record("generate", time.time() - start, {})
+    
+    python = sys.executable
+    runner.run("create", [python, repo_setup_path, "create", root_path, ",".join(suites), "main"])
+    apply_settings(root_path, parameters["settings"])
+    
+    for suite in suites:
+        runner.run("add", [python, repo_setup_path, "add",
+                           os.path.join(root_path, "dists", suite, "main"), input_dir])
+    
+    update = [python, repo_setup_path, "update", root_path, "--jobs", str(parameters["jobs"])]
+    runner.run("update", update)
+    runner.run("update_unchanged", update)
+    
+    if parameters["gpg"]:
+        runner.run("sign", [python, repo_setup_path, "sign", root_path, ",".join(suites)])
+    
+    # Remove a tenth of the packages from each suite.
+    removed = names[:max(1, len(names) / 10)]
+    for suite in suites:
+        runner.run("remove", [python, repo_setup_path, "remove",
+                              os.path.join(root_path, "dists", suite, "main")] + removed)
+    runner.run("update_after_remove", update)
+    
+    if FTPHandler and parameters["ftp"]:
+    
+        ftp_root = os.path.join(work_dir, "ftp")
+        os.makedirs(os.path.join(ftp_root, "repo"))
+        server, address = start_ftp_server(ftp_root, parameters["latency"] / 1000.0)
+        
+        connections = ["-j", str(parameters["connections"])]
+        upload = [python, os.path.join(package_dir, "ftp_upload.py")] + connections + \
+                 [root_path, address, ftp_user, "/repo"]
+        delete = [python, os.path.join(package_dir, "ftp_delete.py")] + connections + \
+                 [address, ftp_user, "/repo"]
+        
+        try:
+            runner.run("ftp_upload", upload, ftp_password + "\n", stats = False)
+            runner.run("ftp_upload_unchanged", upload, ftp_password + "\n", stats = False)
+            runner.run("ftp_delete", delete, ftp_password + "\n", stats = False)
+        finally:
+            server.close_all()
+    
+    return runner
+
+# Reports
+
+def write_results(path, results):
+
+    f = open(path, "w")
+    json.dump(results, f, indent = 2, sort_keys = True, separators = (",", ": "))
+    f.write("\n")
+    f.close()
+
+def print_results(results, baseline = None):
+
+    if baseline:
+        print "%-22s %10s %10s %8s" % ("Step", "Time (s)", "Baseline", "Change")
+    else:
+        print "%-22s %10s %6s %12s" % ("Step", "Time (s)", "Runs", "Peak RSS (kB)")
+    
+    for step in results["order"]:
+    
+        entry = results["steps"][step]
+        
+        if baseline:
+            previous = baseline["steps"].get(step)
+            if previous and previous["seconds"] > 0:
+                print "%-22s %10.3f %10.3f %+7.1f%%" % (step, entry["seconds"], previous["seconds"],
+                    (entry["seconds"] - previous["seconds"]) * 100.0 / previous["seconds"])
+            else:
+                print "%-22s %10.3f %10s %8s" % (step, entry["seconds"], "-", "-")
+        else:
+            print "%-22s %10.3f %6i %12i" % (step, entry["seconds"], entry["runs"], entry["peak_rss_kb"])
+
+
+def take_option(args, name, default, convert = int):
+
+    if name not in args:
+        return default
+    
+    at = args.index(name)
+    value = convert(args[at + 1])
+    del args[at:at + 2]
+    return value
+
+if __name__ == "__main__":
+
+    args = sys.argv[:]
+    
+    parameters = {"packages": 100, "versions": 2, "architectures": 2, "suites": 2,
+                  "size": 16384, "signed": 0.5, "jobs": 1, "latency": 20,
+                  "connections": 4, "settings": []}
+    
+    try:
+        for name in ("packages", "versions", "architectures", "suites", "size", "jobs",
+                     "latency", "connections"):
+            parameters[name] = take_option(args, "--" + name, parameters[name])
+        
+        parameters["signed"] = take_option(args, "--signed", parameters["signed"], float)
+        
+        # Settings are given as <section>.<option>=<value>, such as pool.enabled=yes.
+        while "--setting" in args:
+            setting = take_option(args, "--setting", None, str)
+            key, value = setting.split("=", 1)
+            section, option = key.split(".", 1)
+            parameters["settings"].append((section, option, value))
+        
+        directory = take_option(args, "--dir", None, str)
+        output_path = take_option(args, "--output", None, str)
+        baseline_path = take_option(args, "--baseline", None, str)
+        generate_path = take_option(args, "--generate", None, str)
+    
+    except (IndexError, ValueError):
+        args = []
+    
+    parameters["gpg"] = "--gpg" in args
+    parameters["ftp"] = "--no-ftp" not in args
+    keep = "--keep" in args
+    
+    for flag in ("--gpg", "--no-ftp", "--keep"):
+        if flag in args:
+            args.remove(flag)
+    
+    if len(args) != 1 or parameters["architectures"] > len(architecture_names) or \
+       min(parameters["packages"], parameters["versions"], parameters["architectures"],
+           parameters["suites"], parameters["jobs"], parameters["connections"]) < 1:
+        sys.stderr.write("Usage: %s [--packages <N>] [--versions <M>] [--architectures <K>] [--suites <S>]\n"
+                         "       [--size <bytes per package>] [--signed <fraction of sources>] [--gpg]\n"
+                         "       [--jobs <update processes>] [--latency <milliseconds>] [--connections <number>]\n"
+                         "       [--no-ftp] [--setting <section>.<option>=<value>] ...\n"
+                         "       [--dir <directory>] [--keep] [--output <results file>] [--baseline <results file>]\n"
+                         "   or: %s [--packages <N>] ... --generate <directory>\n" % (sys.argv[0], sys.argv[0]))
+        sys.exit(1)
+    
+    # Only write the packages and sources if a directory is given for them.
+    if generate_path:
+        if not os.path.isdir(generate_path):
+            os.makedirs(generate_path)
+        generate(generate_path, parameters["packages"], parameters["versions"],
+                 architecture_names[:parameters["architectures"]], parameters["size"],
+                 parameters["signed"], parameters["gpg"])
+        sys.exit()
+    
+    if parameters["ftp"] and not FTPHandler:
+        sys.stderr.write("The pyftpdlib module is not available, so the FTP scripts will not be measured.\n")
+    
+    work_dir = tempfile.mkdtemp(dir = directory)
+    try:
+        runner = benchmark(work_dir, parameters)
+    finally:
+        if keep:
+            print "Files kept in", work_dir
+        else:
+            shutil.rmtree(work_dir)
+    
+    results = {"format": results_format,
+               "revision": revision(),
+               "version": repo_setup.__version__,
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "processors": repo_setup.multiprocessing.cpu_count(),
+               "parameters": parameters,
+               "order": runner.order,
+               "steps": runner.steps}
+    
+    if baseline_path:
+        baseline = json.load(open(baseline_path))
+        if baseline.get("parameters") != json.loads(json.dumps(parameters)):
+            sys.stderr.write("The baseline was measured with different parameters.\n")
+        print_results(results, baseline)
+    else:
+        print_results(results)
+    
+    if output_path:
+        write_results(output_path, results)
+    
+    sys.exit()
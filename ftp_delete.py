@@ -17,12 +17,13 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import ftplib, getpass, os, stat, sys
+from ftp_pool import FTPPool, delete_remote, local_tree, remote_inventory, stale_paths
 
-def delete(host, user, remote_path):
+def delete(host, user, remote_path, connections = 4, repo_path = None, dry_run = False,
+           quiet = False):
 
-    ftp = ftplib.FTP(host)
-    ftp.login(user, getpass.getpass())
-    ftp.cwd("/")
+    pool = FTPPool(host, user, getpass.getpass(), "/", connections, quiet = quiet)
+    ftp = pool.session()
     
     path = ""
     for piece in remote_path.split("/"):
@@ -33,46 +34,89 @@ def delete(host, user, remote_path):
             sys.stderr.write("Failed to enter remote directory: %s\n" % path)
             sys.exit(1)
 
-        print "Entering remote directory:", path
+        pool.log("Entering remote directory:", path)
         ftp.cwd(piece)
     
-    delete_files(path, ftp)
-    ftp.quit()
+    pool.remote_path = path or "/"
+    
+    try:
+        if repo_path:
+            return prune_files(repo_path, path, pool, dry_run)
+        else:
+            return delete_files(path, pool, dry_run)
+    finally:
+        pool.close()
 
-def delete_files(path, ftp):
+def delete_files(path, pool, dry_run = False):
 
-    remote_files = set(ftp.nlst())
+    # List the whole remote tree once to find the files and directories, delete the
+    # files using all the sessions, then remove the directories, deepest first.
+    remote_files = remote_inventory(pool.session())
     
-    for child in remote_files:
+    files = sorted(filter(lambda p: not remote_files[p][0], remote_files))
+    directories = sorted(filter(lambda p: remote_files[p][0], remote_files), reverse = True)
     
-        try:
-            print "Deleting", path + "/" + child
-            ftp.delete(child)
+    return delete_remote(pool, path, files, directories, dry_run)
 
-        except ftplib.error_perm:
-        
-            ftp.cwd(child)
-            delete_files(path + "/" + child, ftp)
-            ftp.cwd("..")
-            
-            ftp.rmd(child)
+def prune_files(repo_path, path, pool, dry_run = False):
 
+    # Delete the remote files and directories that are not in the local repository.
+    remote_files = remote_inventory(pool.session())
+    directories, files = local_tree(repo_path)
+    
+    files, directories = stale_paths(remote_files, directories, files)
+    if not files and not directories:
+        pool.log("No files to delete.")
+    
+    return delete_remote(pool, path, files, directories, dry_run)
 
 if __name__ == "__main__":
 
     args = sys.argv[:]
     
-    if len(args) != 4:
-        sys.stderr.write("Usage: %s <FTP server> <user name> <remote path>\n" % args[0])
+    # The number of connections used to delete files at the same time.
+    connections = 4
+    if "-j" in args:
+        index = args.index("-j")
+        try:
+            connections = int(args[index + 1])
+            del args[index:index + 2]
+        except (IndexError, ValueError):
+            connections = 0
+    
+    # Only delete files that are not in the given local repository.
+    repo_path = None
+    missing_path = False
+    if "--prune" in args:
+        index = args.index("--prune")
+        try:
+            repo_path = args[index + 1]
+            del args[index:index + 2]
+        except IndexError:
+            missing_path = True
+    
+    # Report the files that would be deleted without deleting them.
+    dry_run = "-n" in args
+    if dry_run:
+        args.remove("-n")
+    
+    # Only report problems and, in a dry run, the files that would be deleted.
+    quiet = "-q" in args
+    if quiet:
+        args.remove("-q")
+    
+    if len(args) != 4 or connections < 1 or missing_path:
+        sys.stderr.write("Usage: %s [-j <connections>] [-n] [-q] [--prune <repository path>] <FTP server> <user name> <remote path>\n" % args[0])
         sys.exit(1)
 
     host, user, remote_path = args[1:]
 
     try:
-        delete(host, user, remote_path)
+        result = delete(host, user, remote_path, connections = connections,
+                        repo_path = repo_path, dry_run = dry_run, quiet = quiet)
     except ftplib.Error:
         sys.stderr.write("FTP operation failed.\n")
         raise
         sys.exit(1)
     
-    sys.exit()
+    sys.exit(result)
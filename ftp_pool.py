@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013 met.no
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Functions and classes shared by the ftp_upload.py and ftp_delete.py scripts.
+
+import calendar, ftplib, os, Queue, re, socket, sys, threading, time
+
+# The directory containing information that the repository tool keeps between runs,
+# which is not needed on the server.
+state_dir_name = ".python-apt-repo"
+
+# The manifest stored in the remote directory by ftp_upload.py.
+manifest_name = ".python-apt-repo-manifest"
+
+# The directory in the repository root that holds the shared pool of files, if used.
+pool_dir_name = "pool"
+
+# Errors that indicate that a session has failed and should be opened again. Other
+# IOError and OSError exceptions come from local files and are not retried.
+session_errors = (ftplib.error_temp, ftplib.error_reply, EOFError, socket.error)
+
+# Server features
+
+def server_features(ftp):
+
+    # Return a dictionary mapping the names of the features the server reports to
+    # their parameters.
+    try:
+        response = ftp.sendcmd("FEAT")
+    except ftplib.error_perm:
+        return {}
+    
+    features = {}
+    for line in response.splitlines()[1:-1]:
+        pieces = line.strip().split(None, 1)
+        if pieces:
+            features[pieces[0].upper()] = (pieces[1:] or [""])[0]
+    
+    return features
+
+def use_mlsd(ftp, features = None):
+
+    # Return whether the server supports the MLSD command, which describes files
+    # in a standard format.
+    if features is None:
+        features = server_features(ftp)
+    
+    return "MLST" in features
+
+sha256_pattern = re.compile(r"\b[0-9a-fA-F]{64}\b")
+
+def remote_checksum(ftp, path, features):
+
+    # Return the SHA256 checksum of a remote file if the server can calculate it,
+    # using either the HASH command or the older XSHA256 command, or None if it
+    # cannot.
+    try:
+        if "SHA-256" in features.get("HASH", "").upper():
+            # The algorithm marked with an asterisk is already selected.
+            if "SHA-256*" not in features["HASH"].upper():
+                ftp.sendcmd("OPTS HASH SHA-256")
+            response = ftp.sendcmd("HASH " + path)
+        elif "XSHA256" in features:
+            response = ftp.sendcmd("XSHA256 " + path)
+        else:
+            return None
+    except ftplib.error_perm:
+        return None
+    
+    match = sha256_pattern.search(response)
+    if match:
+        return match.group().lower()
+    
+    return None
+
+def parse_mlsd_line(line):
+
+    # type=file;size=1234;modify=20130101120000; name
+    facts, name = line.split(" ", 1)
+    details = {}
+    for fact in facts.split(";"):
+        key, sep, value = fact.partition("=")
+        details[key.lower()] = value
+    
+    file_type = details.get("type", "").lower()
+    if file_type in ("cdir", "pdir"):
+        return None
+    
+    try:
+        size = int(details.get("size", ""))
+    except ValueError:
+        size = None
+    
+    try:
+        mtime = calendar.timegm(time.strptime(details.get("modify", "")[:14], "%Y%m%d%H%M%S"))
+    except ValueError:
+        mtime = None
+    
+    return name, file_type == "dir", size, mtime
+
+def parse_list_line(line):
+
+    # drwxr-xr-x    2 user     group        4096 Jan 01 12:00 name
+    pieces = line.split(None, 8)
+    if len(pieces) < 9 or line.startswith("total"):
+        return None
+    
+    name = pieces[8]
+    if pieces[0].startswith("l"):
+        name = name.split(" -> ")[0]
+    
+    if name in (".", ".."):
+        return None
+    
+    try:
+        size = int(pieces[4])
+    except ValueError:
+        size = None
+    
+    return name, pieces[0].startswith("d"), size, None
+
+def list_directory(ftp, path, mlsd):
+
+    # Return a list of the names of the files in the directory with whether each of
+    # them is a directory, its size and modification time, where known.
+    lines = []
+    
+    if mlsd:
+        command = "MLSD"
+        parse = parse_mlsd_line
+    else:
+        command = "LIST"
+        parse = parse_list_line
+    
+    if path:
+        command += " " + path
+    
+    ftp.retrlines(command, lines.append)
+    return filter(None, map(parse, lines))
+
+def remote_inventory(ftp, path = "", mlsd = None):
+
+    # Return a dictionary mapping the paths of the files and directories below the
+    # current remote directory to whether they are directories, their sizes and
+    # modification times. Each remote directory is only listed once.
+    if mlsd is None:
+        mlsd = use_mlsd(ftp)
+    
+    inventory = {}
+    
+    for name, is_dir, size, mtime in list_directory(ftp, path, mlsd):
+    
+        child_path = path and path + "/" + name or name
+        inventory[child_path] = (is_dir, size, mtime)
+        
+        if is_dir:
+            inventory.update(remote_inventory(ftp, child_path, mlsd))
+    
+    return inventory
+
+def pool_link(path, repo_path):
+
+    # Return whether the file is a link to a file in the repository's pool. The
+    # indices refer to the files in the pool, so the links are not uploaded. Only the
+    # link itself is followed because the file in the pool can also be a link, to a
+    # file outside the repository.
+    if not os.path.islink(path):
+        return False
+    
+    target = os.path.normpath(os.path.join(os.path.split(os.path.abspath(path))[0],
+                                           os.readlink(path)))
+    rel_path = os.path.relpath(target, os.path.abspath(repo_path))
+    return rel_path.split(os.sep)[0] == pool_dir_name
+
+def local_tree(path):
+
+    # Return sets of the paths of the directories and files in a local repository,
+    # relative to its root and in the form used for remote paths.
+    directories = set()
+    files = set()
+    
+    for dir_path, dir_names, file_names in os.walk(path):
+    
+        rel_dir = os.path.relpath(dir_path, path)
+        if rel_dir == "." and state_dir_name in dir_names:
+            dir_names.remove(state_dir_name)
+        
+        rel_pieces = filter(lambda piece: piece != ".", rel_dir.split(os.sep))
+        
+        for name in dir_names:
+            directories.add("/".join(rel_pieces + [name]))
+        for name in file_names:
+            if not pool_link(os.path.join(dir_path, name), path):
+                files.add("/".join(rel_pieces + [name]))
+    
+    return directories, files
+
+def stale_paths(remote_files, directories, files):
+
+    # Return lists of the remote files and directories that are not in the local
+    # repository, in the order in which they can be deleted. The manifest written by
+    # uploads is kept.
+    stale_files = []
+    stale_directories = []
+    
+    for child_path, (is_dir, size, mtime) in remote_files.items():
+        if is_dir:
+            if child_path not in directories:
+                stale_directories.append(child_path)
+        elif child_path not in files and child_path not in (manifest_name, manifest_name + ".new"):
+            stale_files.append(child_path)
+    
+    stale_files.sort()
+    stale_directories.sort(reverse = True)
+    return stale_files, stale_directories
+
+def delete_remote(pool, path, files, directories, dry_run = False):
+
+    # Delete the files using all the sessions, then remove the directories in the
+    # order given, returning 0 on success or 1 if any files could not be deleted.
+    if dry_run:
+        for child_path in files:
+            print "Would delete", path + "/" + child_path
+        for child_path in directories:
+            print "Would remove directory", path + "/" + child_path
+        return 0
+    
+    def delete_file(ftp, child_path):
+        pool.log("Deleting", path + "/" + child_path)
+        ftp.delete(child_path)
+    
+    failed = pool.run(delete_file, files)
+    if failed:
+        sys.stderr.write("Failed to delete %i files.\n" % len(failed))
+        return 1
+    
+    ftp = pool.session()
+    for child_path in directories:
+        pool.log("Removing directory", path + "/" + child_path)
+        ftp.rmd(child_path)
+    
+    return 0
+
+# Sessions
+
+class FTPPool:
+
+    # A number of logged in sessions with a server, each of them starting in the
+    # same remote directory, that are used by a pool of threads to perform tasks.
+    # Sessions that fail are opened again and their tasks retried. Messages about
+    # progress are not written if the pool is quiet.
+    
+    def __init__(self, host, user, password, remote_path = "/", connections = 4,
+                 retries = 3, quiet = False):
+        
+        self.host = host
+        self.user = user
+        self.password = password
+        self.remote_path = remote_path
+        self.retries = retries
+        self.quiet = quiet
+        self.sessions = [None] * max(1, connections)
+        self.lock = threading.Lock()
+        self._features = None
+    
+    def connect(self):
+    
+        # The server can be given as <host>:<port> to use a port other than 21.
+        host, port = self.host, 21
+        if host.count(":") == 1:
+            host, port = host.split(":")
+            port = int(port)
+        
+        ftp = ftplib.FTP()
+        ftp.connect(host, port)
+        ftp.login(self.user, self.password)
+        ftp.cwd(self.remote_path)
+        return ftp
+    
+    def session(self, index = 0):
+    
+        # Return the session with the given index, opening it if necessary.
+        if self.sessions[index] is None:
+            self.sessions[index] = self.connect()
+        return self.sessions[index]
+    
+    def features(self):
+    
+        # Return the features of the server, asking for them the first time.
+        if self._features is None:
+            self._features = server_features(self.session())
+        return self._features
+    
+    def reset(self, index):
+    
+        ftp = self.sessions[index]
+        self.sessions[index] = None
+        
+        if ftp:
+            try:
+                ftp.close()
+            except session_errors:
+                pass
+    
+    def log(self, *pieces):
+    
+        # Write a message without interleaving it with those from other threads.
+        if self.quiet:
+            return
+        
+        self.lock.acquire()
+        try:
+            print " ".join(map(str, pieces))
+            sys.stdout.flush()
+        finally:
+            self.lock.release()
+    
+    def call(self, index, function, item):
+    
+        # Call the function with a session and the item, opening the session again
+        # and retrying if it fails. Permanent errors, including problems with local
+        # files, are not retried.
+        for attempt in range(self.retries + 1):
+        
+            try:
+                function(self.session(index), item)
+                return None
+            
+            except ftplib.error_perm, exception:
+                return exception
+            
+            except session_errors, exception:
+                self.reset(index)
+                if attempt < self.retries:
+                    self.log("Retrying", item, "(%s)" % str(exception).strip())
+                    time.sleep(min(2 ** attempt, 10))
+            
+            # Socket errors are also IOErrors, so these are only caught after them.
+            except (IOError, OSError), exception:
+                return exception
+        
+        return exception
+    
+    def run(self, function, items):
+    
+        # Call the function with a session and each of the items, using a thread for
+        # each session, and return a list of the items that failed with the errors
+        # that caused them to fail. This returns when all the items are finished.
+        queue = Queue.Queue()
+        for item in items:
+            queue.put(item)
+        
+        failed = []
+        
+        def worker(index):
+        
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                
+                exception = self.call(index, function, item)
+                if exception is not None:
+                    self.log("Failed:", item, "(%s)" % str(exception).strip())
+                    self.lock.acquire()
+                    failed.append((item, exception))
+                    self.lock.release()
+        
+        threads = []
+        for index in range(min(len(self.sessions), max(1, len(items)))):
+            thread = threading.Thread(target = worker, args = (index,))
+            thread.start()
+            threads.append(thread)
+        
+        for thread in threads:
+            thread.join()
+        
+        return failed
+    
+    def close(self):
+    
+        for index, ftp in enumerate(self.sessions):
+            if ftp:
+                try:
+                    ftp.quit()
+                except session_errors + (ftplib.Error,):
+                    pass
+            self.sessions[index] = None
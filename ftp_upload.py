@@ -16,81 +16,520 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import ftplib, getpass, os, stat, sys
+import cPickle, ftplib, getpass, hashlib, os, stat, StringIO, sys, time
+from ftp_pool import FTPPool, delete_remote, local_tree, manifest_name, pool_link, \
+                     remote_checksum, remote_inventory, stale_paths, state_dir_name, use_mlsd
 
-def upload(repo_path, host, user, remote_path, force = False):
+# Files are uploaded in phases so that clients never see indices that refer to files
+# that have not been uploaded yet: first packages and other files, then the indices
+# that describe them, and finally the Release files for each suite.
+index_prefixes = ("Packages", "Sources", "Contents", "Release", "InRelease", "Index")
+release_names = ("Release", "Release.gpg", "InRelease")
+by_hash_dir_name = "by-hash"
 
-    ftp = ftplib.FTP(host)
-    ftp.login(user, getpass.getpass())
-    ftp.cwd("/")
+# The manifest stored in the remote directory after each successful upload lists
+# the SHA256 checksum and size of each file. The local cache of checksums holds those
+# of files that are not described by the repository's own indices.
+checksum_cache_name = "upload-checksums"
+hash_block_size = 1024 * 1024
+
+# Uploads of files at least this large are recorded in the state directory while
+# they are in progress, so that they can be resumed if they are interrupted, and
+# report their progress as they are copied.
+resume_threshold = 1024 * 1024
+partial_dir_name = "partial-uploads"
+transfer_block_size = 64 * 1024
+
+def upload(repo_path, host, user, remote_path, force = False, connections = 4,
+           prune = False, dry_run = False, quiet = False):
+
+    pool = FTPPool(host, user, getpass.getpass(), "/", connections, quiet = quiet)
+    ftp = pool.session()
+    
+    # In a dry run, remote directories are not created, so a missing directory means
+    # that every file would be copied.
+    exists = True
     
     path = ""
     for piece in remote_path.split("/"):
         if not piece:
             continue
         path += "/" + piece
-        if piece not in ftp.nlst():
-            print "Creating remote directory:", path
+        if not exists or piece not in ftp.nlst():
+            if dry_run:
+                print "Would create remote directory:", path
+                exists = False
+                continue
+            pool.log("Creating remote directory:", path)
             ftp.mkd(piece)
 
-        print "Entering remote directory:", path
+        pool.log("Entering remote directory:", path)
         ftp.cwd(piece)
     
-    upload_files(remote_path, repo_path, ftp, check_size = not force)
-    ftp.quit()
+    # Any other sessions start in the remote directory.
+    pool.remote_path = path or "/"
+    
+    # Read the contents of the whole remote tree and the manifest written by the last
+    # upload before transferring anything, then work out which directories need to
+    # be created and which files copied.
+    remote_files = {}
+    if exists:
+        pool.log("Reading remote directory:", remote_path)
+        remote_files = remote_inventory(ftp, mlsd = use_mlsd(ftp, pool.features()))
+    
+    manifest = None
+    if not force and manifest_name in remote_files:
+        manifest = read_remote_manifest(ftp)
+    
+    local_files = local_checksums(repo_path)
+    directories, files = transfer_plan(repo_path, remote_files, check_size = not force,
+                                       local_files = local_files, manifest = manifest)
+    
+    # Files that are no longer in the local repository are only deleted once the
+    # indices that no longer refer to them have been uploaded, using the listing of
+    # the remote tree that was read before the upload.
+    if prune:
+        stale_files, stale_directories = stale_paths(remote_files, *local_tree(repo_path))
+    
+    try:
+        if dry_run:
+            for child_path in directories:
+                print "Would create remote directory:", path + "/" + child_path
+            for child_path in files:
+                print "Would copy", os.path.join(repo_path, *child_path.split("/"))
+            result = 0
+        else:
+            result = upload_files(remote_path, repo_path, pool, directories, files,
+                                  remote_files, local_files)
+            if result == 0 and local_files != manifest:
+                write_remote_manifest(pool.session(), local_files, pool.log)
+        
+        if result == 0 and prune:
+            result = delete_remote(pool, path, stale_files, stale_directories, dry_run)
+        
+        return result
+    finally:
+        pool.close()
 
-def upload_files(remote_path, path, ftp, check_size = False):
+# Checksums
 
-    remote_files = set(ftp.nlst())
+def read_fields(path):
+
+    # Return a list of dictionaries containing the fields of each stanza in a
+    # Release, Packages or Sources file. Continuation lines are appended to the
+    # value of the field they follow.
+    stanzas = []
+    fields = {}
+    heading = None
+    
+    for line in open(path).read().split("\n"):
+    
+        if not line.strip():
+            if fields:
+                stanzas.append(fields)
+            fields = {}
+            heading = None
+        
+        elif line[0] in " \t":
+            if heading:
+                fields[heading] += "\n" + line.strip()
+        
+        elif ":" in line:
+            heading, value = line.split(":", 1)
+            fields[heading] = value.strip()
     
-    for child in os.listdir(path):
+    if fields:
+        stanzas.append(fields)
     
-        child_path = os.path.join(path, child)
+    return stanzas
 
-        if os.path.isfile(child_path):
+def index_checksums(path):
+
+    # Return a dictionary mapping the paths of files, relative to the repository
+    # root, to the SHA256 checksums and sizes that the repository's Release, Packages
+    # and Sources files record for them.
+    known = {}
+    
+    for dir_path, dir_names, file_names in os.walk(path):
+    
+        rel_dir = os.path.relpath(dir_path, path)
+        if rel_dir == "." and state_dir_name in dir_names:
+            dir_names.remove(state_dir_name)
+        if by_hash_dir_name in dir_names:
+            dir_names.remove(by_hash_dir_name)
+        
+        rel_pieces = filter(lambda piece: piece != ".", rel_dir.split(os.sep))
         
-            # Always copy Release*, Packages* and Sources* files.
-            copy = True
+        for name in file_names:
+        
+            file_path = os.path.join(dir_path, name)
             
-            if child.startswith("Release"):
-                copy = True
+            if name == "Release":
+                # Files are listed relative to the directory containing the Release file.
+                for fields in read_fields(file_path)[:1]:
+                    for line in fields.get("SHA256", "").split("\n"):
+                        pieces = line.split()
+                        if len(pieces) == 3:
+                            child_path = "/".join(rel_pieces + pieces[2].split("/"))
+                            known[child_path] = (pieces[0], int(pieces[1]))
             
-            elif child.startswith("Packages"):
-                copy = True
+            elif name == "Packages":
+                # Files are listed relative to the repository root.
+                for fields in read_fields(file_path):
+                    if "Filename" in fields and "SHA256" in fields and "Size" in fields:
+                        known[fields["Filename"]] = (fields["SHA256"], int(fields["Size"]))
+            
+            elif name == "Sources":
+                for fields in read_fields(file_path):
+                    if "Directory" not in fields:
+                        continue
+                    for line in fields.get("Checksums-Sha256", "").split("\n"):
+                        pieces = line.split()
+                        if len(pieces) == 3:
+                            child_path = fields["Directory"] + "/" + pieces[2]
+                            known[child_path] = (pieces[0], int(pieces[1]))
+    
+    return known
+
+def compute_checksum(path):
+
+    h = hashlib.sha256()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(hash_block_size)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    
+    return h.hexdigest()
+
+def local_checksums(path):
+
+    # Return a dictionary mapping the path of each file in the repository to its
+    # SHA256 checksum and size. Checksums are taken from the repository's indices
+    # where they describe files of the same size, from the names of files published
+    # by hash, or from a cache of those calculated by previous uploads, so only new
+    # and changed files that the indices do not describe are read.
+    known = index_checksums(path)
+    
+    cache_path = os.path.join(path, state_dir_name, checksum_cache_name)
+    try:
+        cache = cPickle.load(open(cache_path, "rb"))
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        cache = {}
+    
+    new_cache = {}
+    local_files = {}
+    
+    for dir_path, dir_names, file_names in os.walk(path):
+    
+        rel_dir = os.path.relpath(dir_path, path)
+        if rel_dir == "." and state_dir_name in dir_names:
+            dir_names.remove(state_dir_name)
+        
+        rel_pieces = filter(lambda piece: piece != ".", rel_dir.split(os.sep))
+        
+        for name in file_names:
+        
+            if pool_link(os.path.join(dir_path, name), path):
+                continue
+            
+            child_path = "/".join(rel_pieces + [name])
+            s = os.stat(os.path.join(dir_path, name))
+            size = s[stat.ST_SIZE]
+            key = (size, s[stat.ST_MTIME], s[stat.ST_INO])
+            
+            if child_path in known and known[child_path][1] == size:
+                checksum = known[child_path][0]
+            
+            elif rel_pieces[-2:] == [by_hash_dir_name, "SHA256"]:
+                checksum = name
+            
+            elif child_path in cache and cache[child_path][0] == key:
+                checksum = cache[child_path][1]
+                new_cache[child_path] = cache[child_path]
+            
+            else:
+                checksum = compute_checksum(os.path.join(dir_path, name))
+                new_cache[child_path] = (key, checksum)
             
-            elif child.startswith("Sources"):
+            local_files[child_path] = (checksum, size)
+    
+    if os.path.isdir(os.path.dirname(cache_path)) and new_cache != cache:
+        f = open(cache_path, "wb")
+        cPickle.dump(new_cache, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+    
+    return local_files
+
+def read_remote_manifest(ftp):
+
+    # Return a dictionary mapping the paths of the files uploaded previously to
+    # their SHA256 checksums and sizes.
+    manifest = {}
+    
+    f = StringIO.StringIO()
+    try:
+        ftp.retrbinary("RETR " + manifest_name, f.write)
+    except ftplib.error_perm:
+        return None
+    
+    for line in f.getvalue().split("\n"):
+        pieces = line.split(None, 2)
+        if len(pieces) == 3:
+            manifest[pieces[2]] = (pieces[0], int(pieces[1]))
+    
+    return manifest
+
+def write_remote_manifest(ftp, local_files, log):
+
+    # Write the manifest under a temporary name and rename it so that a failed upload
+    # never leaves an incomplete manifest.
+    lines = []
+    for child_path in sorted(local_files):
+        checksum, size = local_files[child_path]
+        lines.append("%s %i %s\n" % (checksum, size, child_path))
+    
+    log("Writing manifest:", manifest_name)
+    ftp.storbinary("STOR " + manifest_name + ".new", StringIO.StringIO("".join(lines)))
+    ftp.rename(manifest_name + ".new", manifest_name)
+
+def upload_phase(child_path):
+
+    pieces = child_path.split("/")
+    name = pieces[-1]
+    
+    # <repo>/dists/<suite>/Release
+    if len(pieces) == 3 and pieces[0] == "dists" and name in release_names:
+        return 2
+    
+    elif name.startswith(index_prefixes) or by_hash_dir_name in pieces[:-1] or \
+        filter(lambda piece: piece.endswith(".diff"), pieces[:-1]):
+        return 1
+    
+    return 0
+
+def transfer_plan(path, remote_files, check_size = False, local_files = None,
+                  manifest = None):
+
+    # Return lists of the remote directories to create and the files to copy, given
+    # as paths relative to the repository root, in the order they are found.
+    # If a manifest from a previous upload is available, files are only copied if
+    # their checksums or sizes differ from those recorded in it, or if the remote
+    # file is missing or has a different size.
+    directories = []
+    files = []
+    
+    for dir_path, dir_names, file_names in os.walk(path):
+    
+        rel_dir = os.path.relpath(dir_path, path)
+        if rel_dir == ".":
+            rel_dir = ""
+            if state_dir_name in dir_names:
+                dir_names.remove(state_dir_name)
+        
+        dir_names.sort()
+        
+        for child in dir_names:
+            child_path = "/".join(filter(None, rel_dir.split(os.sep) + [child]))
+            if child_path not in remote_files:
+                directories.append(child_path)
+        
+        for child in sorted(file_names):
+        
+            if pool_link(os.path.join(dir_path, child), path):
+                continue
+            
+            child_path = "/".join(filter(None, rel_dir.split(os.sep) + [child]))
+            
+            if manifest is not None:
+                copy = child_path not in remote_files or \
+                       manifest.get(child_path) != local_files[child_path] or \
+                       remote_files[child_path][1] not in (None, local_files[child_path][1])
+            
+            # Without a manifest, always copy Release*, Packages* and Sources* files.
+            elif child.startswith("Release") or child.startswith("Packages") or \
+                child.startswith("Sources"):
                 copy = True
             
-            elif check_size and child in remote_files:
+            elif check_size and child_path in remote_files:
             
-                # Copy files if required to, or if the remote size differs
-                # from the local size. Ideally, we should also compare the
-                # file hashes.
-                local_size = os.stat(child_path)[stat.ST_SIZE]
-                
-                ftp.sendcmd("TYPE I")
-                remote_size = ftp.size(child)
-                ftp.sendcmd("TYPE A")
-                
-                if local_size == remote_size:
-                    copy = False
+                # Copy files if the remote size differs from the local size.
+                local_size = os.stat(os.path.join(dir_path, child))[stat.ST_SIZE]
+                copy = remote_files[child_path][1] != local_size
+            
+            else:
+                copy = True
             
             if copy:
-                print "Copying", child_path
-                f = open(child_path, "rb")
-                ftp.storbinary("STOR " + child, f)
-                f.close()
+                files.append(child_path)
+    
+    return directories, files
 
-        elif os.path.isdir(child_path):
-            if child not in ftp.nlst():
-                print "Creating remote directory:", remote_path+"/"+child
-                ftp.mkd(child)
+def format_size(size):
 
-            print "Entering remote directory:", remote_path+"/"+child
-            ftp.cwd(child)
-            upload_files(remote_path+"/"+child, child_path, ftp, check_size = check_size)
-            ftp.cwd("..")
+    for units in ("bytes", "KB", "MB"):
+        if size < 1024:
+            return "%.1f %s" % (size, units)
+        size /= 1024.0
+    
+    return "%.1f GB" % size
+
+def partial_record_path(path, child_path):
+
+    return os.path.join(path, state_dir_name, partial_dir_name,
+                        hashlib.sha1(child_path).hexdigest())
+
+def read_partial_record(path, child_path):
 
+    # Return the checksum and size of the local file that was being uploaded when an
+    # earlier upload of the file was interrupted, or None if there was none.
+    try:
+        pieces = open(partial_record_path(path, child_path)).read().split()
+        return pieces[0], int(pieces[1])
+    except (IOError, IndexError, ValueError):
+        return None
+
+def write_partial_record(path, child_path, checksum, size):
+
+    record_path = partial_record_path(path, child_path)
+    if not os.path.isdir(os.path.dirname(record_path)):
+        try:
+            os.makedirs(os.path.dirname(record_path))
+        except OSError:
+            # Another thread may have created the directory.
+            pass
+    
+    f = open(record_path, "w")
+    f.write("%s %i %s\n" % (checksum, size, child_path))
+    f.close()
+
+def remove_partial_record(path, child_path):
+
+    try:
+        os.remove(partial_record_path(path, child_path))
+    except OSError:
+        pass
+
+def upload_file(ftp, path, child_path, offset = 0, log = None):
+
+    # Copy the file, starting at the given offset, reporting the progress of large
+    # files with the log function. Servers that do not accept the REST command are
+    # asked to append to the remote file instead.
+    local_path = os.path.join(path, *child_path.split("/"))
+    size = os.stat(local_path)[stat.ST_SIZE]
+    
+    state = {"copied": offset, "reported": offset * 10 / max(size, 1)}
+    
+    def progress(block):
+        state["copied"] += len(block)
+        tenths = state["copied"] * 10 / size
+        if log and size >= resume_threshold and tenths > state["reported"]:
+            state["reported"] = tenths
+            log("%s: %i%%" % (local_path, tenths * 10))
+    
+    f = open(local_path, "rb")
+    try:
+        f.seek(offset)
+        if offset == 0:
+            ftp.storbinary("STOR " + child_path, f, transfer_block_size, progress)
+        else:
+            try:
+                ftp.storbinary("STOR " + child_path, f, transfer_block_size, progress,
+                               rest = offset)
+            except ftplib.error_perm:
+                f.seek(offset)
+                ftp.storbinary("APPE " + child_path, f, transfer_block_size, progress)
+    finally:
+        f.close()
+    
+    return state["copied"] - offset
+
+def file_size(ftp, child_path):
+
+    # Return the size of a remote file, or None if it is unknown. Some servers only
+    # report sizes in binary mode.
+    try:
+        ftp.voidcmd("TYPE I")
+        return ftp.size(child_path)
+    except ftplib.error_perm:
+        return None
+
+def verify_upload(ftp, child_path, checksum, size, features):
+
+    # Check the size of the remote file and, if the server can calculate it, its
+    # checksum.
+    remote_size = file_size(ftp, child_path)
+    if remote_size not in (None, size):
+        return False
+    
+    remote = remote_checksum(ftp, child_path, features)
+    return remote in (None, checksum)
+
+def upload_files(remote_path, path, pool, directories, files, remote_files = {},
+                 local_files = {}):
+
+    ftp = pool.session()
+    features = pool.features()
+    
+    for child_path in directories:
+        pool.log("Creating remote directory:", remote_path + "/" + child_path)
+        ftp.mkd(child_path)
+    
+    phases = [[], [], []]
+    for child_path in files:
+        phases[upload_phase(child_path)].append(child_path)
+    
+    def upload_child(ftp, child_path):
+    
+        local_path = os.path.join(path, *child_path.split("/"))
+        
+        if child_path in local_files:
+            checksum, size = local_files[child_path]
+        else:
+            size = os.stat(local_path)[stat.ST_SIZE]
+            checksum = compute_checksum(local_path)
+        
+        # Resume an interrupted upload of a large file if the file has not changed
+        # since, continuing from the end of the partial remote copy.
+        # The remote size is read again in case an earlier attempt in this run failed.
+        offset = 0
+        if size >= resume_threshold:
+            if read_partial_record(path, child_path) == (checksum, size):
+                remote_size = file_size(ftp, child_path)
+                if 0 < remote_size < size:
+                    offset = remote_size
+                    pool.log("Resuming", local_path, "at", format_size(offset))
+            write_partial_record(path, child_path, checksum, size)
+        
+        start = time.time()
+        copied = upload_file(ftp, path, child_path, offset, pool.log)
+        
+        # Check that resumed uploads produced the same file, copying the whole file
+        # again if they did not.
+        if offset and not verify_upload(ftp, child_path, checksum, size, features):
+            pool.log("Copying", local_path, "again after a failed resume")
+            copied = upload_file(ftp, path, child_path, 0, pool.log)
+        
+        remove_partial_record(path, child_path)
+        
+        elapsed = time.time() - start
+        pool.log("Copied", local_path, "(%s in %.1f s, %s/s)" % (
+                 format_size(copied), elapsed, format_size(copied / max(elapsed, 0.001))))
+    
+    # Only start each phase when all the files in the previous one have been copied.
+    for phase_files in phases:
+    
+        failed = pool.run(upload_child, phase_files)
+        
+        if failed:
+            sys.stderr.write("Failed to copy %i files. Not copying any more files.\n" % len(failed))
+            return 1
+    
+    return 0
 
 if __name__ == "__main__":
 
@@ -99,17 +538,44 @@ if __name__ == "__main__":
     if force:
         args.remove("-f")
     
-    if len(args) != 5:
-        sys.stderr.write("Usage: %s <repository path> <FTP server> <user name> <remote path>\n" % args[0])
+    # The number of connections used to transfer files at the same time.
+    connections = 4
+    if "-j" in args:
+        index = args.index("-j")
+        try:
+            connections = int(args[index + 1])
+            del args[index:index + 2]
+        except (IndexError, ValueError):
+            connections = 0
+    
+    # Delete remote files that are not in the local repository after uploading.
+    prune = "--prune" in args
+    if prune:
+        args.remove("--prune")
+    
+    # Report the files that would be copied or deleted without changing anything.
+    dry_run = "-n" in args
+    if dry_run:
+        args.remove("-n")
+    
+    # Only report problems and, in a dry run, the files that would be changed.
+    quiet = "-q" in args
+    if quiet:
+        args.remove("-q")
+    
+    if len(args) != 5 or connections < 1:
+        sys.stderr.write("Usage: %s [-f] [-j <connections>] [-n] [-q] [--prune] <repository path> <FTP server> <user name> <remote path>\n" % args[0])
         sys.exit(1)
 
     repo_path, host, user, remote_path = args[1:]
 
     try:
-        upload(repo_path, host, user, remote_path, force = force)
+        result = upload(repo_path, host, user, remote_path, force = force,
+                        connections = connections, prune = prune, dry_run = dry_run,
+                        quiet = quiet)
     except ftplib.Error:
         sys.stderr.write("FTP transfer failed.\n")
         raise
         sys.exit(1)
     
-    sys.exit()
+    sys.exit(result)
@@ -16,89 +16,1569 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import bz2, gzip, glob, os, shutil, stat, subprocess, sys, time
+import array, atexit, bz2, ConfigParser, cPickle, cStringIO, ctypes, ctypes.util, difflib
+import errno, fcntl, functools, gzip, glob, hashlib, heapq, json, multiprocessing, os, Queue
+import re, resource, shutil, sqlite3, stat, subprocess, sys, tarfile, tempfile, threading
+import time, zlib
+from multiprocessing.pool import ThreadPool
+
+# Optional modules used to read compressed control archives in packages. If these
+# are not available, the xz and zstd tools are used instead.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 __version__ = "0.1.0"
 
-suite_Release_headings = [
-    "Architectures", "Codename", "Components", "Date", "Label", "Origin",
-    "Suite", "Description"
-    ]
+suite_Release_headings = [
+    "Architectures", "Codename", "Components", "Date", "Label", "Origin",
+    "Suite", "Description"
+    ]
+
+arch_Release_headings = [
+    "Archive", "Component", "Label", "Origin", "Architecture", "Description"
+    ]
+
+details = {"Architectures": ["amd64", "i386", "source"],
+           "Codename": "lucid",
+           "Suite": "lucid",
+           "Components": ["experimental"],
+           "Date": time.strftime("%a, %d %b %Y %H:%M:%S %Z"),
+           "Label": "met.no",
+           "Origin": "met.no",
+           "Description": "Experimental Debian and Ubuntu packages for the Norwegian Meteorological Institute"}
+
+hashes = [("MD5Sum", "md5"), ("SHA1", "sha1"), ("SHA256", "sha256")]
+checksums = {"Files": "MD5Sum", "Checksums-Sha1": "SHA1", "Checksums-Sha256": "SHA256"}
+
+# The compressed versions of each index file to write, given as pairs of formats and
+# compression levels, where None selects the default level for a format. The available
+# formats are listed in the compressors dictionary. These can be changed for each
+# repository in its settings file.
+Packages_compression = [("gz", None), ("bz2", None)]
+Sources_compression = [("gz", None), ("bz2", None)]
+
+# The number of threads used by the xz and zstd compressors, where 0 means one for
+# each processor.
+compression_threads = 0
+
+# apt-get expects to find architecture-specific subdirectories in each component directory.
+# We define some default ones to ensure that repositories work straight away even if they
+# do not contain packages for those architectures.
+default_architectures = ["source", "binary-all", "binary-i386", "binary-amd64"]
+
+# Information that is kept between runs is stored in a directory in the root of the
+# repository, next to the dists directory.
+state_dir_name = ".python-apt-repo"
+metadata_cache_name = "metadata-cache"
+settings_name = "settings"
+manifests_dir_name = "manifests"
+catalogue_name = "catalogue.db"
+by_hash_dir_name = "by-hash"
+pdiffs_dir_name = "pdiffs"
+contents_dir_name = "contents"
+signatures_name = "signatures"
+
+# The directory in the repository root that holds the shared pool of package and
+# source files, if it is used.
+pool_dir_name = "pool"
+
+# Subdirectories of the architecture and source directories that contain files
+# written by the update command rather than packages.
+generated_dir_names = (by_hash_dir_name, "Packages.diff", "Sources.diff")
+
+# The catalogue database is optional and is enabled in the settings file.
+use_catalogue = False
+
+# If enabled in the settings file, index files are also published under their
+# checksums in by-hash subdirectories of each architecture and source directory,
+# keeping this many generations of them so that clients using an older Release
+# file can still obtain the files it refers to.
+use_by_hash = False
+by_hash_generations = 3
+
+# If enabled in the settings file, the differences between successive versions of
+# the Packages and Sources files are published in <index>.diff directories so that
+# clients can update their copies of the indices incrementally. This many of the
+# most recent patches are kept.
+use_pdiffs = False
+pdiff_patches = 14
+
+# If enabled in the settings file, Contents-<architecture>.gz files are written for
+# each suite from the lists of files in each package, which are cached using the
+# checksums of the packages. The lists are merged in groups of this size to limit
+# the number of files open at once.
+use_contents = False
+contents_merge_width = 256
+
+# The signatures of signed source control files are only checked if this is enabled
+# in the settings file. The files are checked in batches and the checksums of those
+# with good signatures are recorded so that they are not checked again.
+verify_signatures = False
+signature_batch_size = 256
+
+# If enabled in the settings file, each package and source file is stored once in
+# pool/<component>/<prefix>/<source>/ and the dists tree contains relative links to
+# it, so that a file published in several suites is only stored and hashed once.
+# The indices refer to the files in the pool.
+use_pool = False
+
+# Files are hashed in blocks of this size, using all the hash algorithms at once, and
+# groups of files are hashed using a pool of threads. The hashlib module releases the
+# global interpreter lock while hashing large blocks.
+hash_block_size = 1024 * 1024
+hash_threads = multiprocessing.cpu_count()
+
+# The cache used by Package and Source objects to avoid inspecting unchanged files.
+# This is only set while a command that benefits from it is running.
+metadata_cache = None
+
+# The catalogue database, which is only open while a command is running.
+catalogue = None
+
+# Messages about individual files and directories are not written if this is set by
+# the --quiet option.
+quiet = False
+
+def file_key(path):
+
+    # Files are identified by their path, inode, size and modification time in
+    # nanoseconds. Any change to a file should change at least one of these. Links
+    # are identified by the files they refer to, so that information about files in
+    # the pool is shared between the links to them.
+    s = os.stat(path)
+    return (os.path.realpath(path), s.st_ino, s.st_size, int(s.st_mtime * 1000000000))
+
+class MetadataCache:
+
+    def __init__(self, path):
+    
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.updates = {}
+        self.lock = threading.Lock()
+    
+    def load(self):
+    
+        self.entries = {}
+        
+        if not os.path.exists(self.path):
+            return
+        
+        try:
+            f = open(self.path, "rb")
+            self.entries = cPickle.load(f)
+            f.close()
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            sys.stderr.write("Ignoring unreadable metadata cache: %s\n" % self.path)
+            self.entries = {}
+    
+    def save(self):
+    
+        mkdir(os.path.split(self.path)[0])
+        
+        # Write the cache to a temporary file first so that an interrupted run
+        # cannot leave a truncated cache behind.
+        temp_path = self.path + ".new"
+        f = open(temp_path, "wb")
+        cPickle.dump(self.entries, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(temp_path, self.path)
+    
+    def lookup(self, path, field):
+    
+        key = file_key(path)
+        
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            
+            if entry and field in entry:
+                self.hits += 1
+                return entry[field]
+            
+            self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+    
+    def store(self, path, field, value):
+    
+        key = file_key(path)
+        
+        self.lock.acquire()
+        try:
+            self.entries.setdefault(key, {})[field] = value
+            self.updates.setdefault(key, {})[field] = value
+        finally:
+            self.lock.release()
+    
+    def take_updates(self):
+    
+        # Return the entries stored and the counters accumulated since the last call,
+        # for use by worker processes that share their results with the main process.
+        self.lock.acquire()
+        try:
+            updates = (self.updates, self.hits, self.misses)
+            self.updates = {}
+            self.hits = 0
+            self.misses = 0
+            return updates
+        finally:
+            self.lock.release()
+    
+    def merge(self, updates):
+    
+        entries, hits, misses = updates
+        
+        self.lock.acquire()
+        try:
+            for key, fields in entries.items():
+                self.entries.setdefault(key, {}).update(fields)
+            self.hits += hits
+            self.misses += misses
+        finally:
+            self.lock.release()
+    
+    def evict(self):
+    
+        # Remove entries for files that no longer exist or that have changed since
+        # they were cached.
+        for key in self.entries.keys():
+        
+            path = key[0]
+            try:
+                current = file_key(path)
+            except OSError:
+                current = None
+            
+            if current != key:
+                del self.entries[key]
+                self.evicted += 1
+
+def open_metadata_cache(root_path):
+
+    global metadata_cache
+    
+    metadata_cache = MetadataCache(os.path.join(root_path, state_dir_name, metadata_cache_name))
+    metadata_cache.load()
+    return metadata_cache
+
+def close_metadata_cache():
+
+    global metadata_cache
+    
+    if metadata_cache is None:
+        return
+    
+    metadata_cache.evict()
+    metadata_cache.save()
+    
+    statistics.count("metadata_cache_hits", metadata_cache.hits)
+    statistics.count("metadata_cache_misses", metadata_cache.misses)
+    
+    message("Metadata cache: %i hits, %i misses, %i evicted" % (
+        metadata_cache.hits, metadata_cache.misses, metadata_cache.evicted))
+    
+    metadata_cache = None
+
+# Instrumentation
+
+def io_counters():
+
+    # Return the numbers of bytes read and written by this process, including those
+    # passed through pipes, or None if the system does not report them.
+    try:
+        f = open("/proc/self/io")
+        lines = f.readlines()
+        f.close()
+    except IOError:
+        return None
+    
+    counters = {}
+    for line in lines:
+        name, sep, value = line.partition(":")
+        counters[name] = int(value)
+    
+    return counters["rchar"], counters["wchar"]
+
+class Statistics:
+
+    # The time spent in each phase of a command, the number of times each phase was
+    # entered and counts of other events, which are reported by the --stats option.
+    # Phases can be entered by several threads at once and can contain other phases,
+    # so their times can add up to more than the time taken by the command.
+    
+    def __init__(self):
+    
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.io = io_counters()
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+    
+    def add_time(self, phase, seconds):
+    
+        self.lock.acquire()
+        try:
+            self.times[phase] = self.times.get(phase, 0) + seconds
+            self.calls[phase] = self.calls.get(phase, 0) + 1
+        finally:
+            self.lock.release()
+    
+    def count(self, name, value = 1):
+    
+        self.lock.acquire()
+        try:
+            self.counts[name] = self.counts.get(name, 0) + value
+        finally:
+            self.lock.release()
+    
+    def io_counts(self):
+    
+        # Return the counts of bytes read and written since the process started or
+        # since the counts were last taken.
+        io = io_counters()
+        if io is None or self.io is None:
+            return io, {}
+        
+        return io, {"bytes_read": io[0] - self.io[0], "bytes_written": io[1] - self.io[1]}
+    
+    def take(self):
+    
+        # Return the times and counts accumulated since the last call, including the
+        # bytes read and written, for use by worker processes that share them with
+        # the main process.
+        self.lock.acquire()
+        try:
+            self.io, io_counts = self.io_counts()
+            for name, value in io_counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+            
+            taken = (self.times, self.calls, self.counts)
+            self.times = {}
+            self.calls = {}
+            self.counts = {}
+            return taken
+        finally:
+            self.lock.release()
+    
+    def merge(self, taken):
+    
+        times, calls, counts = taken
+        
+        self.lock.acquire()
+        try:
+            for phase, seconds in times.items():
+                self.times[phase] = self.times.get(phase, 0) + seconds
+            for phase, number in calls.items():
+                self.calls[phase] = self.calls.get(phase, 0) + number
+            for name, value in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+        finally:
+            self.lock.release()
+    
+    def report(self, command, arguments):
+    
+        counts = dict(self.counts)
+        for name, value in self.io_counts()[1].items():
+            counts[name] = counts.get(name, 0) + value
+        
+        phases = {}
+        for phase, seconds in self.times.items():
+            phases[phase] = {"seconds": round(seconds, 6), "calls": self.calls[phase]}
+        
+        # The peak resident set sizes are given in kilobytes. That of the child
+        # processes is the largest of any worker or tool that has finished.
+        return {"command": command,
+                "arguments": arguments,
+                "seconds": round(time.time() - self.started, 6),
+                "phases": phases,
+                "counters": counts,
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "peak_child_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+statistics = Statistics()
+
+def timed(phase):
+
+    # Return a decorator that records the time spent in a function as a phase.
+    def decorator(function):
+    
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                statistics.add_time(phase, time.time() - start)
+        
+        return timed_function
+    
+    return decorator
+
+def spawn(command, **kwargs):
+
+    # Start a process, counting the processes started by the command.
+    statistics.count("subprocesses")
+    return subprocess.Popen(command, **kwargs)
+
+def write_statistics(path, command, arguments):
+
+    f = open(path, "w")
+    json.dump(statistics.report(command, arguments), f, indent = 2, sort_keys = True,
+              separators = (",", ": "))
+    f.write("\n")
+    f.close()
+
+# Settings
+
+def parse_compression(text):
+
+    # Parse a list of formats with optional levels, such as "gz:9 bz2 xz:6".
+    compression_types = []
+    
+    for item in text.replace(",", " ").split():
+    
+        ext, sep, level = item.partition(":")
+        if ext not in compressors:
+            raise ValueError("Unknown compression format: %s" % ext)
+        
+        if level:
+            compression_types.append((ext, int(level)))
+        else:
+            compression_types.append((ext, None))
+    
+    return compression_types
+
+def format_compression(compression_types):
+
+    items = []
+    for ext, level in compression_types:
+        if level is None:
+            items.append(ext)
+        else:
+            items.append("%s:%i" % (ext, level))
+    
+    return " ".join(items)
+
+def read_settings(root_path):
+
+    global Packages_compression, Sources_compression, compression_threads, use_catalogue
+    global use_by_hash, by_hash_generations, use_pdiffs, pdiff_patches, use_contents
+    global verify_signatures, use_pool
+    
+    path = os.path.join(root_path, state_dir_name, settings_name)
+    if not os.path.exists(path):
+        return
+    
+    parser = ConfigParser.RawConfigParser()
+    
+    try:
+        parser.read(path)
+        
+        if parser.has_option("compression", "packages"):
+            Packages_compression = parse_compression(parser.get("compression", "packages"))
+        if parser.has_option("compression", "sources"):
+            Sources_compression = parse_compression(parser.get("compression", "sources"))
+        if parser.has_option("compression", "threads"):
+            compression_threads = parser.getint("compression", "threads")
+        if parser.has_option("catalogue", "database"):
+            use_catalogue = parser.getboolean("catalogue", "database")
+        if parser.has_option("by-hash", "enabled"):
+            use_by_hash = parser.getboolean("by-hash", "enabled")
+        if parser.has_option("by-hash", "generations"):
+            by_hash_generations = max(1, parser.getint("by-hash", "generations"))
+        if parser.has_option("pdiff", "enabled"):
+            use_pdiffs = parser.getboolean("pdiff", "enabled")
+        if parser.has_option("pdiff", "patches"):
+            pdiff_patches = max(1, parser.getint("pdiff", "patches"))
+        if parser.has_option("contents", "enabled"):
+            use_contents = parser.getboolean("contents", "enabled")
+        if parser.has_option("signatures", "verify"):
+            verify_signatures = parser.getboolean("signatures", "verify")
+        if parser.has_option("pool", "enabled"):
+            use_pool = parser.getboolean("pool", "enabled")
+    
+    except (ConfigParser.Error, ValueError), exception:
+        sys.stderr.write("Problem with settings file: %s (%s)\n" % (path, exception))
+
+def write_default_settings(root_path):
+
+    path = os.path.join(root_path, state_dir_name, settings_name)
+    if os.path.exists(path):
+        return
+    
+    mkdir(os.path.join(root_path, state_dir_name))
+    
+    parser = ConfigParser.RawConfigParser()
+    parser.add_section("compression")
+    parser.set("compression", "packages", format_compression(Packages_compression))
+    parser.set("compression", "sources", format_compression(Sources_compression))
+    parser.set("compression", "threads", str(compression_threads))
+    parser.add_section("catalogue")
+    parser.set("catalogue", "database", use_catalogue and "yes" or "no")
+    parser.add_section("by-hash")
+    parser.set("by-hash", "enabled", use_by_hash and "yes" or "no")
+    parser.set("by-hash", "generations", str(by_hash_generations))
+    parser.add_section("pdiff")
+    parser.set("pdiff", "enabled", use_pdiffs and "yes" or "no")
+    parser.set("pdiff", "patches", str(pdiff_patches))
+    parser.add_section("contents")
+    parser.set("contents", "enabled", use_contents and "yes" or "no")
+    parser.add_section("signatures")
+    parser.set("signatures", "verify", verify_signatures and "yes" or "no")
+    parser.add_section("pool")
+    parser.set("pool", "enabled", use_pool and "yes" or "no")
+    
+    message("Creating", path)
+    f = open(path, "w")
+    parser.write(f)
+    f.close()
+
+# Checksums
+
+@timed("hashing")
+def compute_checksums(path):
+
+    # Read the file once, feeding each block to all the hash objects, and return a
+    # dictionary mapping each of the hash names to the digest of the file.
+    objects = map(lambda (name, algorithm): (name, hashlib.new(algorithm)), hashes)
+    
+    f = open(path, "rb")
+    while True:
+        data = f.read(hash_block_size)
+        if not data:
+            break
+        for name, obj in objects:
+            obj.update(data)
+    f.close()
+    
+    return dict(map(lambda (name, obj): (name, obj.hexdigest()), objects))
+
+def file_checksums(path):
+
+    # Return the checksums of the file, using cached values where possible.
+    if metadata_cache:
+        result = metadata_cache.lookup(path, "checksums")
+        if result is not None:
+            return result
+    
+    result = compute_checksums(path)
+    
+    if metadata_cache:
+        metadata_cache.store(path, "checksums", result)
+    
+    return result
+
+# Index files
+
+class HashingFile:
+
+    # A file that calculates the checksums and size of the data written to it. The
+    # data is written to a temporary file that replaces the file at the given path
+    # when it is closed, so that the old file is available until the new one is
+    # complete.
+    
+    def __init__(self, path):
+    
+        self.path = path
+        self.temp_path = path + ".new"
+        self.file = open(self.temp_path, "wb")
+        self.objects = map(lambda (name, algorithm): (name, hashlib.new(algorithm)), hashes)
+        self.size = 0
+    
+    def write(self, data):
+    
+        self.file.write(data)
+        for name, obj in self.objects:
+            obj.update(data)
+        self.size += len(data)
+    
+    def flush(self):
+    
+        self.file.flush()
+    
+    def close(self):
+    
+        self.file.close()
+        os.rename(self.temp_path, self.path)
+    
+    def discard(self):
+    
+        # Remove the temporary file, leaving any existing file in place.
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+    
+    def checksums(self):
+    
+        return dict(map(lambda (name, obj): (name, obj.hexdigest()), self.objects))
+
+class CompressionError(Exception):
+    pass
+
+def find_tool(name):
+
+    # Return the path of an executable in the search path, or None if not found.
+    for dir_path in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(dir_path, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    
+    return None
+
+class GzipCompressor:
+
+    def __init__(self, fileobj, level = None):
+    
+        # Leave the modification time out of the header so that the compressed files
+        # only depend on their contents, as with gzip -n.
+        self.file = gzip.GzipFile(fileobj.path, "wb", 9 if level is None else level, fileobj, mtime = 0)
+    
+    def write(self, data):
+    
+        self.file.write(data)
+    
+    def close(self):
+    
+        self.file.close()
+
+class Bz2Compressor:
+
+    def __init__(self, fileobj, level = None):
+    
+        self.fileobj = fileobj
+        self.compressor = bz2.BZ2Compressor(9 if level is None else level)
+    
+    def write(self, data):
+    
+        self.fileobj.write(self.compressor.compress(data))
+    
+    def close(self):
+    
+        self.fileobj.write(self.compressor.flush())
+
+class ProcessCompressor:
+
+    # Compresses data using an external tool, copying its output to the file in a
+    # separate thread.
+    
+    def __init__(self, fileobj, command):
+    
+        self.fileobj = fileobj
+        self.process = spawn(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target = self.copy_output)
+        self.thread.start()
+    
+    def copy_output(self):
+    
+        while True:
+            data = self.process.stdout.read(hash_block_size)
+            if not data:
+                break
+            self.fileobj.write(data)
+    
+    def write(self, data):
+    
+        self.process.stdin.write(data)
+    
+    def close(self):
+    
+        # The process is waited for even if its input cannot be closed, which happens
+        # if it has already exited.
+        try:
+            self.process.stdin.close()
+        finally:
+            self.thread.join()
+            status = self.process.wait()
+        
+        if status != 0:
+            # The output is incomplete, so it must not replace the existing file.
+            self.fileobj.discard()
+            raise CompressionError("Problem compressing file: %s" % self.fileobj.path)
+
+def XzCompressor(fileobj, level = None):
+
+    if level is None:
+        level = 6
+    
+    # The lzma module only compresses using a single thread, so the xz tool is used
+    # instead when more than one thread is available, if it is installed.
+    threads = compression_threads or multiprocessing.cpu_count()
+    if lzma and (threads == 1 or not find_tool("xz")):
+        return StreamCompressor(fileobj, lzma.LZMACompressor(preset = level))
+    
+    if not find_tool("xz"):
+        raise CompressionError("The xz tool or the lzma module is needed to write %s" % fileobj.path)
+    
+    return ProcessCompressor(fileobj, ["xz", "-c", "-%i" % level, "-T%i" % threads])
+
+def ZstdCompressor(fileobj, level = None):
+
+    if level is None:
+        level = 19
+    
+    threads = compression_threads or multiprocessing.cpu_count()
+    if zstandard:
+        compressor = zstandard.ZstdCompressor(level = level, threads = threads)
+        return StreamCompressor(fileobj, compressor.compressobj())
+    
+    if not find_tool("zstd"):
+        raise CompressionError("The zstd tool or the zstandard module is needed to write %s" % fileobj.path)
+    
+    command = ["zstd", "-c", "-q", "-%i" % level, "-T%i" % threads]
+    if level > 19:
+        command.insert(1, "--ultra")
+    
+    return ProcessCompressor(fileobj, command)
+
+class StreamCompressor:
+
+    # Uses a compressor object with compress and flush methods.
+    
+    def __init__(self, fileobj, compressor):
+    
+        self.fileobj = fileobj
+        self.compressor = compressor
+    
+    def write(self, data):
+    
+        self.fileobj.write(self.compressor.compress(data))
+    
+    def close(self):
+    
+        self.fileobj.write(self.compressor.flush())
+
+compressors = {"gz": GzipCompressor, "bz2": Bz2Compressor, "xz": XzCompressor,
+               "zst": ZstdCompressor}
+
+class CompressorThread(threading.Thread):
+
+    # Feeds data to a compressor in its own thread so that different formats can be
+    # compressed at the same time. The zlib and bz2 modules release the global
+    # interpreter lock while compressing.
+    
+    def __init__(self, output):
+    
+        threading.Thread.__init__(self)
+        self.output = output
+        self.queue = Queue.Queue(16)
+        self.error = None
+    
+    def run(self):
+    
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            elif self.error:
+                continue
+            
+            try:
+                self.output.write(data)
+            except Exception, exception:
+                self.error = exception
+        
+        # The compressor is closed even if writing failed, so that any process it
+        # started is waited for, but only the first error is reported.
+        try:
+            self.output.close()
+        except Exception, exception:
+            self.error = self.error or exception
+    
+    def write(self, data):
+    
+        self.queue.put(data)
+    
+    def close(self):
+    
+        self.queue.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+class TimedOutput:
+
+    # Records the time spent writing to an output, such as a compressor, and closing
+    # it as a phase.
+    
+    def __init__(self, output, phase):
+    
+        self.output = output
+        self.phase = phase
+    
+    def write(self, data):
+    
+        start = time.time()
+        self.output.write(data)
+        statistics.add_time(self.phase, time.time() - start)
+    
+    def close(self):
+    
+        start = time.time()
+        self.output.close()
+        statistics.add_time(self.phase, time.time() - start)
+
+class IndexWriter:
+
+    # Writes an index file and its compressed versions in a single pass, recording
+    # the checksums of each file as it is written so that none of them need to be
+    # read again.
+    
+    # Text is collected into blocks of this size before being passed to the threads
+    # that compress it.
+    block_size = 1024 * 1024
+    
+    def __init__(self, path, compression_types = []):
+    
+        self.files = [HashingFile(path)]
+        self.outputs = [self.files[0]]
+        
+        try:
+            for ext, level in compression_types:
+                fileobj = HashingFile(path + "." + ext)
+                self.files.append(fileobj)
+                self.outputs.append(TimedOutput(compressors[ext](fileobj, level), "compression"))
+        except Exception:
+            self.discard()
+            raise
+        
+        # Compress each format in a separate thread if there is more than one.
+        if len(compression_types) > 1:
+            self.outputs[1:] = map(CompressorThread, self.outputs[1:])
+            for output in self.outputs[1:]:
+                output.start()
+        
+        self.paths = map(lambda f: f.path, self.files)
+        self.unused_paths = unused_compressed_files(path, compression_types)
+        self.pending = []
+        self.pending_size = 0
+    
+    def write(self, text):
+    
+        self.pending.append(text)
+        self.pending_size += len(text)
+        
+        if self.pending_size >= self.block_size:
+            self.flush()
+    
+    def flush(self):
+    
+        data = "".join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        
+        try:
+            for output in self.outputs:
+                output.write(data)
+        except Exception:
+            self.discard()
+            raise
+    
+    def close(self):
+    
+        # Return a dictionary mapping the path of each file to its checksums.
+        self.flush()
+        
+        # If any of the compressed files cannot be written, none of the files replace
+        # the existing ones.
+        errors = []
+        for output in self.outputs[1:]:
+            try:
+                output.close()
+            except Exception, exception:
+                errors.append(exception)
+        
+        if errors:
+            for fileobj in self.files:
+                fileobj.discard()
+            raise errors[0]
+        
+        checksums = {}
+        try:
+            for fileobj in self.files:
+                fileobj.close()
+                checksums[fileobj.path] = fileobj.checksums()
+        except Exception:
+            for fileobj in self.files:
+                fileobj.discard()
+            raise
+        
+        # Compressed versions in formats that are no longer used would otherwise be
+        # left out of date, without being listed in the Release file.
+        for path in self.unused_paths:
+            remove_file(path)
+        
+        return checksums
+    
+    def discard(self):
+    
+        # Close the compressors, ignoring any further errors, and remove the temporary
+        # files, leaving the existing ones in place.
+        for output in self.outputs[1:]:
+            try:
+                output.close()
+            except Exception:
+                pass
+        
+        for fileobj in self.files:
+            fileobj.discard()
+
+def unused_compressed_files(path, compression_types):
+
+    # Return the paths of the compressed versions of an index file in the formats
+    # that are not given.
+    exts = map(lambda (ext, level): ext, compression_types)
+    return map(lambda ext: path + "." + ext, filter(lambda ext: ext not in exts, sorted(compressors)))
+
+def map_in_threads(function, items):
+
+    # Apply the function to each of the items using a pool of threads, returning the
+    # results in the same order as the items.
+    if len(items) < 2 or hash_threads < 2:
+        return map(function, items)
+    
+    pool = ThreadPool(min(hash_threads, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def checksum_files(paths, function = compute_checksums):
+
+    # Return a dictionary mapping each path to the checksums of the file it refers to.
+    return dict(zip(paths, map_in_threads(function, paths)))
+
+# Package archives
+
+class DebError(Exception):
+    pass
+
+def ar_members(f):
+
+    # Yield the name and size of each member of an ar archive, leaving the file
+    # positioned at the start of the member's data each time.
+    if f.read(8) != "!<arch>\n":
+        raise DebError("Not an ar archive")
+    
+    offset = 8
+    
+    while True:
+    
+        f.seek(offset)
+        header = f.read(60)
+        if len(header) < 60:
+            return
+        
+        # Each header contains the name, modification time, owner, group, mode and
+        # size of the member, followed by a terminating sequence.
+        if header[58:60] != "`\n":
+            raise DebError("Invalid ar member header")
+        
+        name = header[:16].rstrip()
+        if name.endswith("/"):
+            name = name[:-1]
+        
+        size = int(header[48:58])
+        yield name, size
+        
+        # Members are aligned to even offsets.
+        offset += 60 + size + (size % 2)
+
+def decompress_data(data, name):
+
+    # Decompress the data according to the extension of the name.
+    if name.endswith(".gz"):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    
+    elif name.endswith(".xz"):
+        if lzma:
+            return lzma.decompress(data)
+        command = ["xz", "-d", "-c"]
+    
+    elif name.endswith(".zst"):
+        if zstandard:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        command = ["zstd", "-d", "-c"]
+    
+    elif name.endswith(".bz2"):
+        return bz2.decompress(data)
+    
+    else:
+        return data
+    
+    s = spawn(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result, errors = s.communicate(data)
+    if s.returncode != 0:
+        raise DebError("Failed to decompress %s: %s" % (name, errors.strip()))
+    
+    return result
+
+class MemberReader:
+
+    # A file-like object that decompresses a member of an ar archive as it is read,
+    # so that large data archives do not need to be held in memory.
+    
+    block_size = 1024 * 1024
+    
+    def __init__(self, f, size, name):
+    
+        self.file = f
+        self.remaining = size
+        self.buffer = ""
+        self.offset = 0
+        self.process = None
+        
+        if name.endswith(".gz"):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif name.endswith(".bz2"):
+            self.decompressor = bz2.BZ2Decompressor()
+        elif name.endswith(".xz") and lzma:
+            self.decompressor = lzma.LZMADecompressor()
+        elif name.endswith(".zst") and zstandard:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif name.endswith(".xz") or name.endswith(".zst"):
+            self.decompressor = None
+            self._start_process(name.endswith(".xz") and "xz" or "zstd")
+        else:
+            self.decompressor = None
+    
+    def _start_process(self, tool):
+    
+        # Decompress the data with the tool, using a thread to pass the compressed
+        # data to it.
+        self.process = spawn([tool, "-d", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        
+        def feed():
+            while self.remaining:
+                data = self.file.read(min(self.block_size, self.remaining))
+                if not data:
+                    break
+                self.remaining -= len(data)
+                self.process.stdin.write(data)
+            self.process.stdin.close()
+        
+        self.thread = threading.Thread(target = feed)
+        self.thread.start()
+    
+    def _fill(self):
+    
+        # Return the next block of decompressed data, or an empty string at the end.
+        data = self.file.read(min(self.block_size, self.remaining))
+        self.remaining -= len(data)
+        
+        if not data:
+            self.remaining = 0
+            return ""
+        elif self.decompressor:
+            return self.decompressor.decompress(data)
+        else:
+            return data
+    
+    def read(self, size = -1):
+    
+        if self.process:
+            return self.process.stdout.read(size)
+        
+        pieces = []
+        
+        while size != 0:
+        
+            if self.offset == len(self.buffer):
+                if not self.remaining:
+                    break
+                self.buffer = self._fill()
+                self.offset = 0
+                continue
+            
+            if size < 0:
+                end = len(self.buffer)
+            else:
+                end = min(len(self.buffer), self.offset + size)
+                size -= end - self.offset
+            
+            pieces.append(self.buffer[self.offset:end])
+            self.offset = end
+        
+        return "".join(pieces)
+    
+    def close(self):
+    
+        if self.process:
+            self.process.stdout.read()
+            self.thread.join()
+            if self.process.wait() != 0:
+                raise DebError("Failed to decompress the data archive")
+
+@timed("control")
+def read_deb_control(path):
+
+    # Read the control file from the control archive in a package without running
+    # dpkg-deb or reading the data archive that follows it.
+    f = open(path, "rb")
+    
+    try:
+        for name, size in ar_members(f):
+        
+            if name.startswith("control.tar"):
+            
+                data = decompress_data(f.read(size), name)
+                tar = tarfile.open(fileobj = cStringIO.StringIO(data))
+                
+                for member in tar:
+                    if member.name in ("control", "./control"):
+                        return tar.extractfile(member).read()
+                
+                raise DebError("No control file in the control archive")
+            
+            elif name.startswith("data.tar"):
+                break
+        
+        raise DebError("No control archive found")
+    
+    except (tarfile.TarError, zlib.error, IOError, ValueError), exception:
+        raise DebError(str(exception))
+    
+    finally:
+        f.close()
+
+@timed("file_lists")
+def read_deb_file_list(path):
+
+    # Return a sorted list of the files and links in the data archive of a package,
+    # reading the archive as a stream.
+    f = open(path, "rb")
+    
+    try:
+        for name, size in ar_members(f):
+        
+            if name.startswith("data.tar"):
+            
+                reader = MemberReader(f, size, name)
+                tar = tarfile.open(fileobj = reader, mode = "r|")
+                names = []
+                
+                for member in tar:
+                    if not member.isdir():
+                        file_name = member.name
+                        if file_name.startswith("./"):
+                            file_name = file_name[2:]
+                        file_name = file_name.lstrip("/")
+                        if file_name and "\n" not in file_name:
+                            names.append(file_name)
+                
+                reader.close()
+                names.sort()
+                return names
+        
+        raise DebError("No data archive found")
+    
+    except (tarfile.TarError, zlib.error, IOError, EOFError, ValueError), exception:
+        raise DebError(str(exception))
+    
+    finally:
+        f.close()
+
+# Signed files
+
+class SignatureError(Exception):
+    pass
+
+def clearsigned_lines(lines):
+
+    # Return the signed text from the lines of a clearsigned file, without the armor
+    # headers and signature, undoing the escaping of lines that start with dashes.
+    if not lines or not lines[0].startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+        raise SignatureError("No signed message found")
+    
+    i = 1
+    while i < len(lines) and lines[i].strip():
+        i += 1
+    
+    text = []
+    for line in lines[i + 1:]:
+    
+        if line.startswith("-----BEGIN PGP SIGNATURE-----"):
+            return text
+        elif line.startswith("- "):
+            line = line[2:]
+        
+        text.append(line)
+    
+    raise SignatureError("No signature found")
+
+def is_clearsigned(path):
+
+    f = open(path)
+    try:
+        return f.readline().startswith("-----BEGIN PGP SIGNED MESSAGE-----")
+    finally:
+        f.close()
+
+@timed("signature_checks")
+def check_signatures(paths):
+
+    # Check the signatures of the files using a single gpg process for each batch of
+    # files, returning a dictionary mapping each path to a description of the problem
+    # with its signature, or None if it is good. gpg stops at the first bad signature,
+    # so the files after it are checked in another batch.
+    results = {}
+    pending = paths[:]
+    
+    while pending:
+    
+        batch = pending[:signature_batch_size]
+        try:
+            s = spawn(["gpg", "--batch", "--status-fd", "1", "--verify-files"] + batch,
+                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = s.communicate()
+        except OSError, exception:
+            output = ""
+            errors = str(exception)
+        
+        # The status of each file is reported between FILE_START and FILE_DONE lines.
+        started = 0
+        status = []
+        for line in output.split("\n"):
+        
+            pieces = line.split()
+            if pieces[:1] != ["[GNUPG:]"] or len(pieces) < 2:
+                continue
+            
+            if pieces[1] == "FILE_START":
+                if started and batch[started - 1] not in results:
+                    results[batch[started - 1]] = signature_problem(status)
+                started += 1
+                status = []
+            elif pieces[1] == "FILE_DONE":
+                results[batch[started - 1]] = signature_problem(status)
+            elif started:
+                status.append(pieces[1])
+        
+        if started == 0:
+            # gpg could not be run, or it failed before checking any files.
+            for path in batch:
+                results[path] = errors.strip() or "gpg failed"
+            started = len(batch)
+        
+        elif batch[started - 1] not in results:
+            results[batch[started - 1]] = signature_problem(status)
+        
+        pending = pending[started:]
+    
+    return results
+
+def signature_problem(status):
+
+    if "GOODSIG" in status and "VALIDSIG" in status:
+        return None
+    
+    for keyword in ("BADSIG", "EXPKEYSIG", "REVKEYSIG", "NO_PUBKEY", "ERRSIG", "NODATA",
+                    "FILE_ERROR"):
+        if keyword in status:
+            return keyword
+    
+    return "no valid signature"
+
+def check_source_signatures(root_path, paths):
+
+    # Check the signatures of any signed source files that have not been found to be
+    # good before, reporting those with bad signatures. Only the checksums of files
+    # with good signatures are recorded, so that others are checked again after the
+    # keyring changes. Return a list of the files with bad signatures.
+    if not verify_signatures:
+        return []
+    
+    cache_path = os.path.join(root_path, state_dir_name, signatures_name)
+    try:
+        good = cPickle.load(open(cache_path, "rb"))
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        good = set()
+    
+    checksums = {}
+    for path in paths:
+        checksum = file_checksums(path)["SHA256"]
+        if checksum in good:
+            statistics.count("signature_cache_hits")
+        elif is_clearsigned(path):
+            checksums[path] = checksum
+    
+    if not checksums:
+        return []
+    
+    message("Checking signatures of %i source files" % len(checksums))
+    results = check_signatures(sorted(checksums))
+    
+    bad = []
+    for path, problem in sorted(results.items()):
+        if problem:
+            sys.stderr.write("Bad signature in file: %s (%s)\n" % (path, problem))
+            bad.append(path)
+        else:
+            good.add(checksums[path])
+    
+    mkdir(os.path.join(root_path, state_dir_name))
+    f = open(cache_path, "wb")
+    cPickle.dump(good, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    
+    return bad
+
+# Control files and indices
+
+class Stanza(object):
+
+    # A stanza from a control file or index. Only the text of the stanza is kept
+    # initially. Values are located and decoded when they are requested, and the
+    # table of headings and value offsets is only built when it is needed.
+    
+    __slots__ = ("text", "table", "values")
+    
+    def __init__(self, text):
+    
+        self.text = text
+        self.table = None
+        self.values = None
+    
+    def __getstate__(self):
+    
+        return self.text, self.values
+    
+    def __setstate__(self, state):
+    
+        self.text, self.values = state
+        self.table = None
+    
+    def __repr__(self):
+    
+        return "<Stanza %s>" % repr(self.get("Package", self.get("Source")))
+    
+    def _offsets(self):
+    
+        # Return a tuple of headings and an array of the start and end offsets of
+        # their values in the text.
+        if self.table is None:
+        
+            names = []
+            offsets = array.array("I")
+            
+            for match in field_heading.finditer(self.text):
+                if names:
+                    offsets.append(match.start())
+                names.append(intern(match.group(1)))
+                offsets.append(match.end())
+            
+            if names:
+                offsets.append(len(self.text))
+            
+            self.table = tuple(names), offsets
+        
+        return self.table
+    
+    def _find(self, heading):
+    
+        # Return the start and end offsets of the value for the heading. Later fields
+        # with the same heading replace earlier ones.
+        if self.table is not None:
+            names, offsets = self.table
+            for i in range(len(names) - 1, -1, -1):
+                if names[i] == heading:
+                    return offsets[2 * i], offsets[2 * i + 1]
+            return None
+        
+        text = self.text
+        key = "\n" + heading + ":"
+        at = text.rfind(key)
+        
+        if at != -1:
+            start = at + len(key)
+        elif text.startswith(key[1:]):
+            start = len(key) - 1
+        else:
+            return None
+        
+        match = field_end.search(text, start)
+        if match:
+            return start, match.start() + 1
+        else:
+            return start, len(text)
+    
+    def _decode(self, start, end):
+    
+        # A value that starts on the line after its heading is returned as a list of
+        # lines. Otherwise, any continuation lines are appended to the first line.
+        lines = self.text[start:end].split("\n")
+        first = lines[0].strip()
+        
+        if first == "":
+            return map(lambda line: line.strip(), filter(None, lines[1:]))
+        else:
+            return first + "".join(map(lambda line: line.rstrip(), lines[1:]))
+    
+    def __getitem__(self, heading):
+    
+        if self.values and heading in self.values:
+            return self.values[heading]
+        
+        offsets = self._find(heading)
+        if offsets is None:
+            raise KeyError(heading)
+        
+        value = self._decode(*offsets)
+        
+        if self.values is None:
+            self.values = {}
+        self.values[heading] = value
+        return value
+    
+    def __setitem__(self, heading, value):
+    
+        if self.values is None:
+            self.values = {}
+        self.values[heading] = value
+    
+    def __contains__(self, heading):
+    
+        return bool(self.values and heading in self.values) or self._find(heading) is not None
+    
+    has_key = __contains__
+    
+    def get(self, heading, default = None):
+    
+        try:
+            return self[heading]
+        except KeyError:
+            return default
+    
+    def headings(self):
+    
+        # Return the headings in the order in which they first appear.
+        headings = []
+        seen = set()
+        for name in self._offsets()[0]:
+            if name not in seen:
+                seen.add(name)
+                headings.append(name)
+        return headings
+    
+    def keys(self):
+    
+        keys = self.headings()
+        seen = set(keys)
+        for heading in self.values or {}:
+            if heading not in seen:
+                seen.add(heading)
+                keys.append(heading)
+        return keys
+    
+    def lines(self):
+    
+        return self.text.splitlines(True)
+    
+    def copy(self):
+    
+        # Return a stanza that shares the text and the table of this one, with a copy
+        # of the values decoded so far.
+        stanza = Stanza(self.text)
+        stanza.table = self.table
+        if self.values:
+            stanza.values = dict(self.values)
+        return stanza
+
+def layer_fields(info, fields):
 
-arch_Release_headings = [
-    "Archive", "Component", "Label", "Origin", "Architecture", "Description"
-    ]
+    # Return the information with the given fields added to it or replacing those
+    # already present. A stanza is copied rather than converted to a dictionary, so
+    # that its other values are still only decoded when they are requested.
+    if isinstance(info, Stanza):
+        layered = info.copy()
+    else:
+        layered = dict(info)
+    
+    for heading, value in fields.items():
+        layered[heading] = value
+    
+    return layered
 
-details = {"Architectures": ["amd64", "i386", "source"],
-           "Codename": "lucid",
-           "Suite": "lucid",
-           "Components": ["experimental"],
-           "Date": time.strftime("%a, %d %b %Y %H:%M:%S %Z"),
-           "Label": "met.no",
-           "Origin": "met.no",
-           "Description": "Experimental Debian and Ubuntu packages for the Norwegian Meteorological Institute"}
+# Headings start at the beginning of a line and stanzas are separated by lines that
+# are empty or only contain whitespace.
+field_heading = re.compile(r"^([^ \t\n][^:\n]*):", re.M)
+field_end = re.compile(r"\n(?=[^ \t])")
+stanza_separator = re.compile(r"\n(?:[ \t]*\n)+")
 
-hashes = [("MD5Sum", "md5sum"), ("SHA1", "sha1sum"), ("SHA256", "sha256sum")]
-checksums = {"Files": "md5sum", "Checksums-Sha1": "sha1sum", "Checksums-Sha256": "sha256sum"}
+def read_stanzas(source, block_size = 1024 * 1024):
+
+    # Yield a Stanza for each paragraph in the source, which can either be a list
+    # of lines or an open file. Files are read in blocks, so only the text of the
+    # stanzas themselves is kept in memory.
+    if isinstance(source, list):
+        blocks = ["".join(source)]
+    else:
+        blocks = iter(lambda: source.read(block_size), "")
+    
+    pending = ""
+    
+    for block in blocks:
+    
+        texts = stanza_separator.split(pending + block)
+        pending = texts.pop()
+        
+        for text in texts:
+            text = text.lstrip()
+            if text:
+                yield Stanza(text + "\n")
+    
+    text = pending.lstrip()
+    if text:
+        if not text.endswith("\n"):
+            text += "\n"
+        yield Stanza(text)
 
-Packages_compression = [("gz", gzip.GzipFile), ("bz2", bz2.BZ2File)]
-Sources_compression = [("gz", gzip.GzipFile), ("bz2", bz2.BZ2File)]
+def repository_file_name(path, depth):
 
-# apt-get expects to find architecture-specific subdirectories in each component directory.
-# We define some default ones to ensure that repositories work straight away even if they
-# do not contain packages for those architectures.
-default_architectures = ["source", "binary-all", "binary-i386", "binary-amd64"]
+    # Return the path of a file relative to the repository root, which is found the
+    # given number of directories above it. Links to files in the pool are replaced
+    # by the paths of the files they refer to.
+    pieces = os.path.abspath(path).split(os.sep)
+    
+    if os.path.islink(path):
+        target = os.path.join(os.sep.join(pieces[:-1]), os.readlink(path))
+        rel_pieces = os.path.relpath(target, os.sep.join(pieces[:-depth])).split(os.sep)
+        if rel_pieces[0] == pool_dir_name:
+            return "/".join(rel_pieces)
+    
+    return "/".join(pieces[-depth:])
 
 class PackageFile:
 
     def _read_entry(self, lines):
-
-        previous = None
-        info = {}
-        headings = []
-        kept_lines = []
-        
-        for line in lines:
-        
-            # Keep each line for situations where the source text is required.
-            kept_lines.append(line)
-            
-            if not line.strip():
-                if info:
-                    yield info, headings, kept_lines
-                    info = {}
-                    headings = []
-                    kept_lines = []
-                else:
-                    continue
-            
-            elif not line.startswith(" "):
-                at = line.find(":")
-                heading = line[:at]
-                value = line[at+1:].strip()
-                if value == "":
-                    info[heading] = []
-                else:
-                    info[heading] = value
-                
-                previous = heading
-                if heading not in headings:
-                    headings.append(heading)
-            
-            elif previous:
-                if isinstance(info[previous], list):
-                    info[previous].append(line.strip())
-                else:
-                    info[previous] += line.rstrip()
-        
-        if info:
-            yield info, headings, kept_lines
+    
+        for stanza in read_stanzas(lines):
+            yield stanza, stanza.headings(), stanza.lines()
 
 class Package(PackageFile):
 
     suffix = ".deb"
     
-    def __init__(self, path = None, info = None):
+    # The fields that describe the package file in an index rather than the package.
+    file_headings = ("Filename", "Size") + zip(*hashes)[0]
+    
+    def __init__(self, path = None, info = None, headings = None, lines = None):
     
         self.path = path
         
@@ -109,23 +1589,42 @@ class Package(PackageFile):
             self._has_info = False
             self._info = {}
         
-        if path:
+        self._headings = headings or []
+        self.lines = []
+        
+        # If the information includes the details of the file, as it does when read
+        # from an index, trust it instead of examining the file.
+        if info and not filter(lambda heading: heading not in info, self.file_headings):
+            self._headings = filter(lambda h: h not in self.file_headings, self._headings)
+            self.lines = self._control_lines(lines or [])
+        
+        elif path:
         
             # The file name includes everything in the path from the repository root.
             # dists/<suite>/<component>/<architecture>/<section>/<file name>
-            self._info["Filename"] = "/".join(path.split(os.sep)[-6:])
+            self._info["Filename"] = repository_file_name(path, 6)
             
             size = os.stat(path)[stat.ST_SIZE]
             self._info["Size"] = size
+            self._info.update(file_checksums(path))
+    
+    def _control_lines(self, lines):
+    
+        # Return the lines of a stanza without those describing the package file.
+        kept_lines = []
+        keep = True
+        
+        for line in lines:
+        
+            if not line.strip():
+                continue
+            elif not line.startswith(" "):
+                keep = line[:line.find(":")] not in self.file_headings
             
-            for name, command in hashes:
-            
-                s = subprocess.Popen([command, path], stdout=subprocess.PIPE)
-                result = s.stdout.read().strip().split()[0]
-                self._info[name] = result
+            if keep:
+                kept_lines.append(line)
         
-        self._headings = []
-        self.lines = []
+        return kept_lines
     
     def __repr__(self):
     
@@ -146,14 +1645,32 @@ class Package(PackageFile):
         if self._has_info:
             return
         
-        s = subprocess.Popen(["dpkg-deb", "-I", self.path, "control"], stdout=subprocess.PIPE)
+        if metadata_cache:
+            cached = metadata_cache.lookup(self.path, "control")
+            if cached is not None:
+                info, self._headings, self.lines = cached
+                self._info = layer_fields(info, self._info)
+                self._has_info = True
+                return
+        
+        try:
+            control = read_deb_control(self.path)
+        except DebError, exception:
+            sys.stderr.write("Failed to read control information from package: %s (%s)\n" % (self.path, exception))
+            return
+        
+        # The fields describing the package file are added to the control information.
+        file_info = self._info
         
-        for info, headings, lines in self._read_entry(s.stdout.readlines()):
+        for info, headings, lines in self._read_entry(control.splitlines(True)):
         
-            self._info.update(info)
+            self._info = layer_fields(info, file_info)
             self._headings = headings
             self.lines += lines
             self._has_info = True
+            
+            if metadata_cache:
+                metadata_cache.store(self.path, "control", (info, headings, lines))
     
     def architecture(self):
     
@@ -170,9 +1687,8 @@ class Package(PackageFile):
         self._get_info()
         
         text = "".join(self.lines)
-        headings = ("Filename", "Size") + zip(*hashes)[0]
         
-        for key in headings:
+        for key in self.file_headings:
             text += key + ": " + str(self._info[key]) + "\n"
         
         return text
@@ -184,41 +1700,51 @@ class Packages(PackageFile):
         self.path = path
         self.repo_path = os.sep.join(self.path.split(os.sep)[:-5])
         self.packages = {}
-        self.lines = []
     
     def add_package(self, package):
     
         packages = self.packages.setdefault(package["Package"], {})
         packages[package["Version"]] = package
     
-    def read(self):
+    def read(self, verify = False):
     
+        # By default, the information in the index is trusted. If verify is True,
+        # each package file is examined instead.
         self.packages = {}
-        self.lines = []
         
-        for info, headings, lines in self._read_entry(open(self.path).readlines()):
+        Packages_file = open(self.path)
+        
+        for info, headings, lines in self._read_entry(Packages_file):
         
             try:
                 file_name = info["Filename"]
             except KeyError:
                 if info.has_key("Package"):
                     sys.stderr.write("Failed to find a file name for package: %s\n" % info["Package"])
+                continue
             
             path = os.path.join(self.repo_path, file_name)
-            self.add_package(Package(path = path))
-            
-            self.lines += lines
+            if verify:
+                self.add_package(Package(path = path))
+            else:
+                self.add_package(Package(path = path, info = info, headings = headings, lines = lines))
+        
+        Packages_file.close()
     
-    def write(self):
+    @timed("index")
+    def write(self, compression_types = []):
     
-        Packages_file = open(self.path, "w")
+        Packages_file = IndexWriter(self.path, compression_types)
         
-        for package_versions_dict in self.packages.values():
-            for package in package_versions_dict.values():
-                Packages_file.write(package.packages_text() + "\n")
+        # Write the packages in a consistent order so that successive versions of the
+        # index only differ where packages have changed.
+        for name in sorted(self.packages.keys()):
+            package_versions_dict = self.packages[name]
+            for version in sorted(package_versions_dict.keys()):
+                Packages_file.write(package_versions_dict[version].packages_text() + "\n")
         
         Packages_file.write("\n")
-        Packages_file.close()
+        return Packages_file.close()
     
     def find(self, name):
     
@@ -231,7 +1757,7 @@ class Source(PackageFile):
 
     suffix = ".dsc"
     
-    def __init__(self, path):
+    def __init__(self, path, info = None, headings = None, lines = None):
     
         self.path = path
         self.file_name = os.path.split(path)[1]
@@ -239,6 +1765,17 @@ class Source(PackageFile):
         self._info = {}
         self._headings = []
         self.lines = []
+        self._from_index = False
+        self._checksums = None
+        
+        # Information read from an index describes the source as it appears in the
+        # index, with the name of the source given by the Package field.
+        if info:
+            self._has_info = True
+            self._from_index = True
+            self._info = info
+            self._headings = headings or []
+            self.lines = filter(lambda line: line.strip(), lines or [])
     
     def __repr__(self):
     
@@ -248,38 +1785,54 @@ class Source(PackageFile):
     def __getitem__(self, key):
     
         self._get_info()
+        
+        if self._from_index and key == "Source" and key not in self._info:
+            key = "Package"
+        
         return self._info[key]
     
+    @timed("control")
     def _get_info(self):
     
         if self._has_info:
             return
         
+        if metadata_cache:
+            cached = metadata_cache.lookup(self.path, "control")
+            if cached is not None:
+                self._info, self._headings, self.lines = cached
+                self._has_info = True
+                return
+        
+        # The signatures of signed files are checked separately, if at all, so they
+        # are only removed here.
         f = open(self.path)
-        first_line = f.readline()
-        if first_line.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+        lines = f.readlines()
+        f.close()
         
-            f.close()
-            s = subprocess.Popen(["gpg", "--decrypt", self.path], stdout=subprocess.PIPE,
-                                                                  stderr=subprocess.PIPE)
-            lines = s.stdout.readlines()
-            if s.wait() != 0:
-                sys.stderr.write("Problem with file: %s\n" % self.path)
-                for line in s.stderr.readlines():
-                    sys.stderr.write("  "+line)
-        else:
-            lines = [first_line] + f.readlines()
+        if lines and lines[0].startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+            try:
+                lines = clearsigned_lines(lines)
+            except SignatureError, exception:
+                sys.stderr.write("Problem with file: %s (%s)\n" % (self.path, exception))
+                lines = []
         
         for info, headings, lines in self._read_entry(lines):
             self._info = info
             self._headings = headings
             self.lines += lines
             self._has_info = True
+            
+            if metadata_cache:
+                metadata_cache.store(self.path, "control", (info, headings, lines))
     
     def sources_text(self):
     
         self._get_info()
         
+        if self._from_index:
+            return "".join(self.lines)
+        
         text = ""
         
         for heading in self._headings:
@@ -299,125 +1852,430 @@ class Source(PackageFile):
                 
                 if heading in checksums:
                 
-                    try:
-                        command = checksums[heading]
-                    except KeyError:
-                        continue
-                    
-                    s = subprocess.Popen([command, self.path], stdout=subprocess.PIPE)
-                    result = s.stdout.read().strip().split()[0]
+                    result = self.checksums()[checksums[heading]]
                     size = os.stat(self.path)[stat.ST_SIZE]
                     text += " %s %i %s\n" % (result, size, self.file_name)
             else:
                 text += " " + value + "\n"
         
-        source_dir = os.path.split(os.path.abspath(self.path))[0]
-        text += "Directory: " + os.sep.join(source_dir.split(os.sep)[-5:]) + "\n"
+        # dists/<suite>/<component>/source/<section>/<file name>
+        source_dir = repository_file_name(self.path, 6).rsplit("/", 1)[0]
+        text += "Directory: " + source_dir + "\n"
+        
+        return text
+    
+    def checksums(self):
+    
+        # The checksums of the source file are only calculated once for each object.
+        if self._checksums is None:
+            self._checksums = file_checksums(self.path)
+        return self._checksums
+    
+    def find_section(self, path, binaries = None):
+    
+        self._get_info()
+        
+        # Each line of the package list starts with the name, type and section of a
+        # binary package, and may be followed by other fields.
+        for line in self._info.get("Package-List", []):
+        
+            pieces = line.split()
+            if len(pieces) >= 3:
+                return pieces[2]
+        
+        # Otherwise, look for the binary packages built from the source in the
+        # component, listing its directories if an index of them was not supplied.
+        if binaries is None:
+            binaries = BinaryIndex(path)
+        
+        version = self._info["Version"].split(":")[-1]
+        
+        for binary in self._info["Binary"].split(","):
+        
+            section = binaries.find(binary.strip(), version)
+            if section:
+                return section
+            
+            sys.stderr.write("Failed to find packages for binary: %s\n" % binary)
+        
+        return None
+    
+    def original_archive_names(self):
+    
+        self._get_info()
+        
+        files = map(lambda line: line.split()[-1], self._info["Files"])
+        names = []
+        
+        for name in files:
+            if ".orig." in name:
+                names.append(name)
+        
+        return names
+    
+    def diff_archive_name(self):
+    
+        self._get_info()
+        
+        files = map(lambda line: line.split()[-1], self._info["Files"])
+        for name in files:
+            if ".diff." in name:
+                return name
+        
+        return None
+
+class BinaryIndex:
+
+    # The sections of the binary packages in a component, indexed by package name and
+    # version, which are found by listing each architecture and section directory
+    # once instead of searching all of them for each package.
+    
+    @timed("scan")
+    def __init__(self, path):
+    
+        self.sections = {}
+        
+        for arch_path in sorted(glob.glob(os.path.join(path, "binary-*"))):
+        
+            for section in sorted(os.listdir(arch_path)):
+            
+                section_path = os.path.join(arch_path, section)
+                if section in generated_dir_names or not os.path.isdir(section_path):
+                    continue
+                
+                for name in os.listdir(section_path):
+                    if name.endswith(Package.suffix):
+                        pieces = name[:-len(Package.suffix)].split("_")
+                        if len(pieces) == 3:
+                            self.sections.setdefault((pieces[0], pieces[1]), section)
+    
+    def find(self, name, version):
+    
+        return self.sections.get((name, version.split(":")[-1]))
+
+class Sources(PackageFile):
+
+    def __init__(self, path):
+    
+        self.path = path
+        self.repo_path = os.sep.join(self.path.split(os.sep)[:-5])
+        self.sources = {}
+    
+    def add_source(self, source):
+    
+        self.sources[source["Source"]] = source
+    
+    def read(self, verify = False):
+    
+        # By default, the information in the index is trusted. If verify is True,
+        # each source file is read instead.
+        self.sources = {}
+        
+        Sources_file = open(self.path)
+        
+        for info, headings, lines in self._read_entry(Sources_file):
+        
+            try:
+                dsc = filter(lambda i: i.endswith(".dsc"), info["Files"])[0].split()[-1]
+            except (KeyError, IndexError):
+                if info.has_key("Package"):
+                    sys.stderr.write("Failed to find a dsc file for package: %s\n" % info["Package"])
+                continue
+            
+            path = os.path.join(self.repo_path, info["Directory"], dsc)
+            if verify:
+                self.add_source(Source(path))
+            else:
+                self.add_source(Source(path, info = info, headings = headings, lines = lines))
+        
+        Sources_file.close()
+    
+    @timed("index")
+    def write(self, compression_types = []):
+    
+        Sources_file = IndexWriter(self.path, compression_types)
+        
+        for name in sorted(self.sources.keys()):
+            Sources_file.write(self.sources[name].sources_text() + "\n")
+        
+        return Sources_file.close()
+    
+    def find(self, name):
+    
+        try:
+            return self.sources[name]
+        except KeyError:
+            return []
+
+# Catalogue database
+
+catalogue_schema = """
+CREATE TABLE IF NOT EXISTS packages (
+    path TEXT PRIMARY KEY, directory TEXT NOT NULL,
+    suite TEXT, component TEXT, architecture TEXT, section TEXT,
+    name TEXT, version TEXT, source TEXT,
+    inode INTEGER, size INTEGER, mtime_ns INTEGER,
+    md5sum TEXT, sha1 TEXT, sha256 TEXT, stanza TEXT);
+CREATE INDEX IF NOT EXISTS packages_directory ON packages (directory, name);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (suite, component, name);
+CREATE INDEX IF NOT EXISTS packages_source ON packages (suite, component, source);
+
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY, directory TEXT NOT NULL,
+    suite TEXT, component TEXT, section TEXT,
+    name TEXT, version TEXT,
+    inode INTEGER, size INTEGER, mtime_ns INTEGER,
+    md5sum TEXT, sha1 TEXT, sha256 TEXT, stanza TEXT);
+CREATE INDEX IF NOT EXISTS sources_directory ON sources (directory, name);
+CREATE INDEX IF NOT EXISTS sources_name ON sources (suite, component, name);
+
+CREATE TABLE IF NOT EXISTS binaries (source_path TEXT NOT NULL, name TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS binaries_source ON binaries (source_path);
+CREATE INDEX IF NOT EXISTS binaries_name ON binaries (name);
+"""
+
+class Catalogue:
+
+    # A database of the packages and sources in a repository, their locations,
+    # checksums and index entries. It is kept up to date by the add, remove and
+    # update commands.
+    
+    def __init__(self, path, root_path):
+    
+        self.path = path
+        self.root_path = os.path.abspath(root_path)
+        self.created = not os.path.exists(path)
+        
+        mkdir(os.path.split(path)[0])
+        
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.executescript(catalogue_schema)
+    
+    def close(self):
+    
+        self.connection.commit()
+        self.connection.close()
+    
+    def relative_path(self, path):
+    
+        return os.path.relpath(os.path.abspath(path), self.root_path)
+    
+    def location(self, path):
+    
+        # dists/<suite>/<component>/<architecture>/<section>/<file name>
+        rel_path = self.relative_path(path)
+        pieces = rel_path.split(os.sep)
+        suite, component, architecture, section = pieces[-5:-1]
+        
+        return rel_path, os.sep.join(pieces[:-2]), suite, component, \
+               architecture.replace("binary-", ""), section
+    
+    def known_files(self, table, directory):
+    
+        # Return a dictionary mapping the names of the files in an architecture or
+        # source directory, relative to that directory, to the details used to check
+        # them and the text of their index entries.
+        known = {}
+        
+        cursor = self.connection.execute(
+            "SELECT path, inode, size, mtime_ns, stanza FROM %s WHERE directory = ?" % table,
+            (self.relative_path(directory),))
+        
+        for path, inode, size, mtime_ns, stanza in cursor:
+            name = os.sep.join(path.split(os.sep)[-2:])
+            known[name] = ((inode, size, mtime_ns), stanza)
+        
+        return known
+    
+    def package_row(self, package):
+    
+        rel_path, directory, suite, component, architecture, section = self.location(package.path)
         
-        return text
+        try:
+            source = package["Source"].split()[0]
+        except KeyError:
+            source = package["Package"]
+        
+        return (rel_path, directory, suite, component, architecture, section,
+                package["Package"], package["Version"], source) + \
+                file_key(package.path)[1:] + \
+                (package["MD5Sum"], package["SHA1"], package["SHA256"], package.packages_text())
     
-    def find_section(self, path):
+    def source_row(self, source):
     
-        self._get_info()
+        rel_path, directory, suite, component, architecture, section = self.location(source.path)
+        result = source.checksums()
         
-        for line in self._info["Package-List"]:
+        return (rel_path, directory, suite, component, section,
+                source["Source"], source["Version"]) + \
+                file_key(source.path)[1:] + \
+                (result["MD5Sum"], result["SHA1"], result["SHA256"], source.sources_text())
+    
+    def store_package(self, package):
+    
+        self.connection.execute("INSERT OR REPLACE INTO packages VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                self.package_row(package))
+    
+    def store_source(self, source):
+    
+        row = self.source_row(source)
+        self.connection.execute("INSERT OR REPLACE INTO sources VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
         
-            name, pkg_type, section, priority = line.split()
-            return section
+        self.connection.execute("DELETE FROM binaries WHERE source_path = ?", (row[0],))
+        for name in source["Binary"].split(","):
+            self.connection.execute("INSERT INTO binaries VALUES (?, ?)", (row[0], name.strip()))
+    
+    def remove_files(self, paths):
+    
+        for path in paths:
+            rel_path = self.relative_path(path)
+            self.connection.execute("DELETE FROM packages WHERE path = ?", (rel_path,))
+            self.connection.execute("DELETE FROM sources WHERE path = ?", (rel_path,))
+            self.connection.execute("DELETE FROM binaries WHERE source_path = ?", (rel_path,))
+    
+    def update_directory(self, directory, objects, known):
+    
+        # Store the packages or sources catalogued from a directory, only replacing
+        # the entries for files that have changed since they were stored, and remove
+        # the entries for files that are no longer present.
+        names = set()
         
-        for binary in self._info["Binary"].split(","):
+        for obj in objects:
         
-            version = self._info["Version"].split(":")[-1]
-            template = binary.strip() + "_" + version + "_*.deb"
+            name = os.sep.join(obj.path.split(os.sep)[-2:])
+            names.add(name)
             
-            search_path = os.path.join(path, "binary-*", "*", template)
-            packages = glob.glob(search_path)
-            
-            if not packages:
-                sys.stderr.write("Failed to find packages for binary: %s\n" % binary)
+            entry = known.get(name)
+            if entry and entry[0] == file_key(obj.path)[1:]:
                 continue
             
-            section_dir_path = os.path.split(packages[0])[0]
-            return os.path.split(section_dir_path)[1]
+            if isinstance(obj, Source):
+                self.store_source(obj)
+            else:
+                self.store_package(obj)
         
-        return None
+        self.remove_files(map(lambda name: os.path.join(directory, name),
+                              filter(lambda name: name not in names, known)))
+        self.connection.commit()
     
-    def original_archive_names(self):
+    def remove_directories(self, path, directories):
     
-        self._get_info()
+        # Remove the entries for directories below the given path that are not in the
+        # list of directories.
+        prefix = self.relative_path(path) + os.sep
+        keep = set(map(self.relative_path, directories))
         
-        files = map(lambda line: line.split()[-1], self._info["Files"])
-        names = []
+        for table in ("packages", "sources"):
         
-        for name in files:
-            if ".orig." in name:
-                names.append(name)
+            cursor = self.connection.execute(
+                "SELECT DISTINCT directory FROM %s WHERE substr(directory, 1, ?) = ?" % table,
+                (len(prefix), prefix))
+            
+            for (directory,) in cursor.fetchall():
+                if directory not in keep:
+                    paths = self.connection.execute(
+                        "SELECT path FROM %s WHERE directory = ?" % table, (directory,)).fetchall()
+                    self.remove_files(map(lambda (p,): os.path.join(self.root_path, p), paths))
         
-        return names
+        self.connection.commit()
     
-    def diff_archive_name(self):
+    def find(self, table, directory, name):
     
-        self._get_info()
-        
-        files = map(lambda line: line.split()[-1], self._info["Files"])
-        for name in files:
-            if ".diff." in name:
-                return name
+        cursor = self.connection.execute(
+            "SELECT path, stanza FROM %s WHERE directory = ? AND name = ?" % table,
+            (self.relative_path(directory), name))
         
-        return None
+        return map(lambda (path, stanza): (os.path.join(self.root_path, path), Stanza(stanza)),
+                   cursor.fetchall())
+    
+    def counts(self):
+    
+        return map(lambda table: self.connection.execute(
+                       "SELECT COUNT(*) FROM %s" % table).fetchone()[0],
+                   ("packages", "sources"))
 
-class Sources(PackageFile):
+def catalogued_package(path, stanza):
 
-    def __init__(self, path):
-    
-        self.path = path
-        self.repo_path = os.sep.join(self.path.split(os.sep)[:-5])
-        self.sources = {}
+    return Package(path = path, info = stanza, headings = stanza.headings(), lines = stanza.lines())
+
+def catalogued_source(path, stanza):
+
+    return Source(path, info = stanza, headings = stanza.headings(), lines = stanza.lines())
+
+class CatalogueIndex:
+
+    # Provides the find method of the Packages and Sources classes for a directory
+    # in the catalogue database.
     
-    def add_source(self, source):
+    def __init__(self, catalogue, path):
     
-        self.sources[source["Source"]] = source
+        self.catalogue = catalogue
+        self.path = path
+        self.is_source = os.path.split(path)[1] == "source"
     
-    def read(self):
+    def find(self, name):
     
-        self.sources = {}
-        self.lines = []
-        
-        for info, headings, lines in self._read_entry(open(self.path).readlines()):
+        if self.is_source:
+            found = self.catalogue.find("sources", self.path, name)
+            if found:
+                return catalogued_source(*found[-1])
+            else:
+                return []
         
-            try:
-                dsc = filter(lambda i: i.endswith(".dsc"), info["Files"])[0].split()[-1]
-            except (KeyError, IndexError):
-                if info.has_key("Package"):
-                    sys.stderr.write("Failed to find a dsc file for package: %s\n" % info["Package"])
-            
-            path = os.path.join(self.repo_path, info["Directory"], dsc)
-            self.add_source(Source(path))
-            
-            self.lines += lines
+        return map(lambda (path, stanza): catalogued_package(path, stanza),
+                   self.catalogue.find("packages", self.path, name))
+
+def open_catalogue(root_path):
+
+    global catalogue
     
-    def write(self):
+    if use_catalogue:
+        catalogue = Catalogue(os.path.join(root_path, state_dir_name, catalogue_name), root_path)
     
-        Sources_file = open(self.path, "w")
+    return catalogue
 
-        for source in self.sources.values():
-            Sources_file.write(source.sources_text() + "\n")
-        
-        Sources_file.close()
+def close_catalogue():
+
+    global catalogue
     
-    def find(self, name):
+    if catalogue is None:
+        return
     
-        try:
-            return self.sources[name]
-        except KeyError:
-            return []
+    message("Catalogue: %i packages, %i sources" % tuple(catalogue.counts()))
+    
+    catalogue.close()
+    catalogue = None
+
+
+# Messages about files being placed are written whole, as files may be placed by
+# several threads at once.
+message_lock = threading.Lock()
+
+def message(*pieces):
 
+    if quiet:
+        return
+    
+    message_lock.acquire()
+    try:
+        print " ".join(map(str, pieces))
+        sys.stdout.flush()
+    finally:
+        message_lock.release()
 
 def mkdir(path):
 
     if not os.path.exists(path):
-        print "Creating", path
-        os.mkdir(path)
+        message("Creating", path)
+        try:
+            os.mkdir(path)
+        except OSError, exception:
+            # Another thread may have created the directory first.
+            if exception.errno != errno.EEXIST:
+                raise
 
 def mkdirs(pieces):
 
@@ -428,27 +2286,213 @@ def mkdirs(pieces):
         path = os.path.join(path, piece)
         mkdir(path)
 
-def copy_file(src_path, dest_path):
+# Files added to a repository are copied using the first of these methods that works
+# for the mode requested, falling back to later ones if the file system does not
+# support earlier ones. Hard links share the file with its source, reflinks share
+# its data until either copy is changed, and copy_file_range copies the data in the
+# kernel without reading it into the process.
+copy_methods = {"hardlink": ["hardlink", "reflink", "range", "copy"],
+                "reflink": ["reflink", "range", "copy"],
+                "range": ["range", "copy"],
+                "copy": ["copy"],
+                "auto": ["reflink", "range", "copy"]}
+
+link_modes = ["auto", "symlink", "hardlink", "reflink", "range", "copy"]
+
+# Errors that mean that a copy method is not supported for a pair of files.
+unsupported_errors = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                      errno.ENOSYS, errno.EPERM, errno.EBADF)
+
+# The ioctl request used to clone a file on Linux, and the copy methods found not to
+# work between pairs of devices.
+FICLONE = 0x40049409
+unsupported_methods = set()
+
+libc = None
+
+def copy_file_range(src_file, dest_file, size):
+
+    global libc
+    
+    if libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    
+    try:
+        function = libc.copy_file_range
+    except AttributeError:
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    
+    function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                         ctypes.c_size_t, ctypes.c_uint]
+    function.restype = ctypes.c_ssize_t
+    
+    remaining = size
+    while remaining > 0:
+        copied = function(src_file.fileno(), None, dest_file.fileno(), None,
+                          min(remaining, 1 << 30), 0)
+        if copied < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        elif copied == 0:
+            break
+        remaining -= copied
+
+def copy_with_method(src_path, dest_path, method):
+
+    if method == "hardlink":
+        os.link(src_path, dest_path)
+        return
+    
+    elif method == "copy":
+        shutil.copy2(src_path, dest_path)
+        return
+    
+    src_file = open(src_path, "rb")
+    try:
+        dest_file = open(dest_path, "wb")
+        try:
+            if method == "reflink":
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            else:
+                copy_file_range(src_file, dest_file, os.fstat(src_file.fileno()).st_size)
+        finally:
+            dest_file.close()
+    finally:
+        src_file.close()
+    
+    shutil.copystat(src_path, dest_path)
+
+@timed("copying")
+def copy_file(src_path, dest_path, mode = "copy"):
 
+    # Copy the file using the methods for the given mode, returning the name of the
+    # method that was used.
     if os.path.exists(dest_path) or os.path.islink(dest_path):
-        print "Removing", dest_path
+        message("Removing", dest_path)
         os.remove(dest_path)
-    print "Copying", src_path, "to", dest_path
-    shutil.copy2(src_path, dest_path)
+    message("Copying", src_path, "to", dest_path)
+    
+    devices = (os.stat(src_path).st_dev, os.stat(os.path.split(os.path.abspath(dest_path))[0]).st_dev)
+    
+    for method in copy_methods[mode]:
+    
+        if (method, devices) in unsupported_methods and method != "copy":
+            continue
+        
+        try:
+            copy_with_method(src_path, dest_path, method)
+            return method
+        except (IOError, OSError), exception:
+            if method == "copy" or exception.errno not in unsupported_errors:
+                raise
+            unsupported_methods.add((method, devices))
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
 
 def link_file(src_path, dest_path):
 
     if os.path.exists(dest_path) or os.path.islink(dest_path):
-        print "Removing", dest_path
+        message("Removing", dest_path)
         os.remove(dest_path)
-    print "Linking", src_path, "to", dest_path
+    message("Linking", src_path, "to", dest_path)
     os.symlink(os.path.abspath(src_path),
                os.path.abspath(dest_path))
 
+def pool_directory(component_path, source_name):
+
+    # Files are stored in pool/<component>/<prefix>/<source>, where the prefix is the
+    # first letter of the source name, or the first four for libraries.
+    if source_name.startswith("lib"):
+        prefix = source_name[:4]
+    else:
+        prefix = source_name[:1]
+    
+    component = os.path.split(os.path.abspath(component_path))[1]
+    return os.path.join(repository_root(component_path), pool_dir_name, component,
+                        prefix, source_name)
+
+def pool_conflict(src_path, pool_dir, checksum = None):
+
+    # Return whether a different file with the same name is already in the pool. The
+    # SHA256 checksum of the file can be given if it is already known.
+    pool_path = os.path.join(pool_dir, os.path.split(src_path)[1])
+    if not os.path.exists(pool_path):
+        return False
+    
+    if checksum is None:
+        checksum = file_checksums(src_path)["SHA256"]
+    
+    if file_checksums(pool_path)["SHA256"] == checksum:
+        return False
+    
+    sys.stderr.write("A different file with the same name is already in the pool: %s\n" % pool_path)
+    return True
+
+def identical_file(src_path, dest_path, checksum = None):
+
+    # Return whether the destination is a file with the same contents as the source,
+    # whose SHA256 checksum can be given if it is already known.
+    if not os.path.isfile(dest_path) or \
+       os.path.getsize(dest_path) != os.path.getsize(src_path):
+        return False
+    
+    if checksum is None:
+        checksum = file_checksums(src_path)["SHA256"]
+    
+    return file_checksums(dest_path)["SHA256"] == checksum
+
+def place_file(src_path, dest_path, mode = "auto", pool_dir = None, checksum = None):
+
+    # Copy or link the file to its destination using the given mode. If a pool
+    # directory is given, the file is stored in the pool, unless an identical file is
+    # already there, and the destination is a relative link to it. Return whether the
+    # file was placed, or False if an identical file was already in place.
+    if pool_dir is None:
+        if identical_file(src_path, dest_path, checksum):
+            message("Keeping", dest_path)
+            return False
+        if mode == "symlink":
+            link_file(src_path, dest_path)
+        else:
+            copy_file(src_path, dest_path, mode)
+        return True
+    
+    pool_path = os.path.join(pool_dir, os.path.split(dest_path)[1])
+    
+    # Files in the pool are not replaced, so a link to one is already in place.
+    if os.path.islink(dest_path) and os.path.exists(pool_path) and \
+       os.path.realpath(dest_path) == os.path.realpath(pool_path):
+        message("Keeping", dest_path)
+        return False
+    
+    if os.path.exists(pool_path):
+        message("Using", pool_path)
+    else:
+        if not os.path.isdir(pool_dir):
+            message("Creating", pool_dir)
+            try:
+                os.makedirs(pool_dir)
+            except OSError, exception:
+                if exception.errno != errno.EEXIST:
+                    raise
+        if mode == "symlink":
+            link_file(src_path, pool_path)
+        else:
+            copy_file(src_path, pool_path, mode)
+    
+    if os.path.exists(dest_path) or os.path.islink(dest_path):
+        message("Removing", dest_path)
+        os.remove(dest_path)
+    
+    message("Linking", pool_path, "to", dest_path)
+    os.symlink(os.path.relpath(pool_path, os.path.split(os.path.abspath(dest_path))[0]),
+               dest_path)
+    return True
+
 def remove_file(path):
 
     if os.path.exists(path):
-        print "Removing", path
+        message("Removing", path)
         os.remove(path)
 
 def subdirectories(path):
@@ -469,20 +2513,24 @@ def find_files(path, FileClass):
         elif obj_path.endswith(FileClass.suffix):
             yield FileClass(path = obj_path)
 
-def find_files_from_pattern(pattern, FileClass):
 
-    for obj_path in glob.glob(pattern):
-    
-        if os.path.isfile(obj_path) and obj_path.endswith(FileClass.suffix):
-            yield FileClass(path = obj_path)
-
-
-def catalogue_packages(path, root_path):
+def catalogue_packages(path, root_path, known = {}):
 
+    # Packages that are unchanged since they were stored in the catalogue database
+    # are described by their stored entries instead of being examined again.
+    def catalogue_package(package_path):
+    
+        entry = known.get(os.sep.join(package_path.split(os.sep)[-2:]))
+        if entry and entry[0] == file_key(package_path)[1:]:
+            statistics.count("catalogue_hits")
+            return catalogued_package(package_path, Stanza(entry[1]))
+        else:
+            return Package(path = package_path)
+    
     packages = glob.glob(os.path.join(path, "*", "*.deb"))
-    return map(lambda p: Package(path = p), packages)
+    return map_in_threads(catalogue_package, packages)
 
-def write_catalogue_package_file(component, architecture, path, packages):
+def write_catalogue_package_file(component, architecture, path, packages, root_path):
 
     Packages_path = os.path.join(path, "Packages")
     Packages_obj = Packages(Packages_path)
@@ -490,18 +2538,40 @@ def write_catalogue_package_file(component, architecture, path, packages):
     for package in packages:
         Packages_obj.add_package(package)
     
-    Packages_obj.write()
-    compressed_files = compress_files(Packages_path, Packages_compression)
+    checksums = Packages_obj.write(Packages_compression)
+    compressed_files = map(lambda (ext, level): Packages_path + "." + ext, Packages_compression)
+    
+    if use_pdiffs:
+        diff_files, diff_checksums = update_index_diffs(root_path, Packages_path, checksums)
+        compressed_files += diff_files
+        checksums.update(diff_checksums)
     
     suite = path.split(os.sep)[-3]
-    Release_path = write_component_release(path, suite, component, architecture)
+    Release_path, Release_checksums = write_component_release(path, suite, component, architecture)
+    checksums.update(Release_checksums)
     
-    return [Packages_path, Release_path] + compressed_files
+    return [Packages_path, Release_path] + compressed_files, checksums
 
-def catalogue_sources(path, root_path):
+def catalogue_sources(path, root_path, known = {}):
 
+    def catalogue_source(source_path):
+    
+        entry = known.get(os.sep.join(source_path.split(os.sep)[-2:]))
+        if entry and entry[0] == file_key(source_path)[1:]:
+            statistics.count("catalogue_hits")
+            return catalogued_source(source_path, Stanza(entry[1]))
+        else:
+            return Source(source_path)
+    
     sources = glob.glob(os.path.join(path, "*", "*.dsc"))
-    return map(lambda s: Source(s), sources)
+    return map(catalogue_source, sources)
+
+def update_sources(path, root_path, component, known = {}):
+
+    # The index only includes one version of each source, so all the sources that
+    # were catalogued are also returned for the catalogue database.
+    sources = catalogue_sources(path, root_path, known)
+    return write_catalogue_sources_file(path, root_path, component, sources) + (sources,)
 
 def write_catalogue_sources_file(path, root_path, component, sources):
 
@@ -511,31 +2581,204 @@ def write_catalogue_sources_file(path, root_path, component, sources):
     for source in sources:
         Sources_obj.add_source(source)
     
-    Sources_obj.write()
-    compressed_files = compress_files(Sources_path, Sources_compression)
+    checksums = Sources_obj.write(Sources_compression)
+    compressed_files = map(lambda (ext, level): Sources_path + "." + ext, Sources_compression)
+    
+    if use_pdiffs:
+        diff_files, diff_checksums = update_index_diffs(root_path, Sources_path, checksums)
+        compressed_files += diff_files
+        checksums.update(diff_checksums)
     
     suite = path.split(os.sep)[-3]
-    Release_path = write_component_release(path, suite, component, "source")
+    Release_path, Release_checksums = write_component_release(path, suite, component, "source")
+    checksums.update(Release_checksums)
+    
+    return (Sources_obj.sources.values(), [Sources_path, Release_path] + compressed_files,
+            ["source"], checksums)
+
+def ed_script(old_path, new_path):
+
+    # Return the ed commands that turn the old file into the new one, using the
+    # diff tool if it is available.
+    try:
+        s = spawn(["diff", "--ed", old_path, new_path], stdout=subprocess.PIPE,
+                                                        stderr=subprocess.PIPE)
+    except OSError:
+        return difflib_ed_script(open(old_path).readlines(), open(new_path).readlines())
+    
+    output, errors = s.communicate()
+    
+    # The diff tool returns 1 if the files differ and 0 if they are the same.
+    if s.returncode not in (0, 1):
+        sys.stderr.write("Failed to compare files: %s %s\n" % (old_path, new_path))
+        for line in errors.splitlines(True):
+            sys.stderr.write("  "+line)
+        return None
+    
+    return output
+
+def difflib_ed_script(old_lines, new_lines):
+
+    # The commands are given in reverse order so that the line numbers in each one
+    # refer to lines that have not been changed by the commands before it.
+    commands = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, False)
+    
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
     
-    return Sources_obj.sources.values(), [Sources_path, Release_path] + compressed_files, ["source"]
+        if tag == "equal":
+            continue
+        elif tag == "insert":
+            commands.append("%ia\n" % i1)
+        else:
+            command = tag == "delete" and "d" or "c"
+            if i2 - i1 > 1:
+                commands.append("%i,%i%s\n" % (i1 + 1, i2, command))
+            else:
+                commands.append("%i%s\n" % (i2, command))
+        
+        if tag != "delete":
+            commands += new_lines[j1:j2]
+            commands.append(".\n")
+    
+    return "".join(commands)
+
+def read_diff_index(path):
+
+    # Return a list of the patches described by a diff index, in the order they are
+    # applied, with the checksum and size of the file each one applies to, of the
+    # patch itself and of its compressed version.
+    if not os.path.exists(path):
+        return None, []
+    
+    f = open(path)
+    stanzas = list(read_stanzas(f))
+    f.close()
+    
+    if not stanzas:
+        return None, []
+    
+    stanza = stanzas[0]
+    fields = {}
+    
+    for heading in ("SHA256-History", "SHA256-Patches", "SHA256-Download"):
+        for line in stanza.get(heading, []):
+            checksum, size, name = line.split()
+            if name.endswith(".gz"):
+                name = name[:-3]
+            fields.setdefault(name, {})[heading] = (checksum, int(size))
+    
+    patches = []
+    
+    for line in stanza.get("SHA256-History", []):
+        name = line.split()[-1]
+        entry = fields[name]
+        if len(entry) == 3:
+            patches.append((name, entry["SHA256-History"], entry["SHA256-Patches"],
+                            entry["SHA256-Download"]))
+    
+    current = stanza.get("SHA256-Current", "").split()
+    if len(current) == 2:
+        current = (current[0], int(current[1]))
+    else:
+        current = None
+    
+    return current, patches
 
-def compress_files(path, compression_types):
+@timed("pdiffs")
+def update_index_diffs(root_path, index_path, checksums):
 
-    compressed_files = []
+    # Compare the index file with the version written by the previous run, which is
+    # kept in the state directory, and add a patch to the diff index used by apt to
+    # update its copy of the index incrementally.
+    diff_dir = index_path + ".diff"
+    Index_path = os.path.join(diff_dir, "Index")
+    previous_path = os.path.join(root_path, state_dir_name, pdiffs_dir_name,
+                                 os.path.relpath(index_path, root_path))
+    
+    current = (checksums[index_path]["SHA256"], os.stat(index_path)[stat.ST_SIZE])
+    previous, patches = read_diff_index(Index_path)
+    
+    if not os.path.exists(previous_path):
+        # Without the previous version of the index, the existing patches cannot be
+        # extended to the new version.
+        previous = None
+        patches = []
+    
+    elif previous is None:
+        previous = (compute_checksums(previous_path)["SHA256"], os.stat(previous_path)[stat.ST_SIZE])
+    
+    if previous and previous != current:
+    
+        script = ed_script(previous_path, index_path)
+        
+        if script is None:
+            patches = []
+        else:
+            # Patches written in the same second are given a counter so that each
+            # name is only used once, both in the index and in the directory.
+            base_name = name = time.strftime("%Y-%m-%d-%H%M.%S", time.gmtime())
+            used = set(map(lambda patch: patch[0], patches))
+            counter = 1
+            while name in used or os.path.exists(os.path.join(diff_dir, name + ".gz")):
+                name = "%s-%i" % (base_name, counter)
+                counter += 1
+            
+            patch_path = os.path.join(diff_dir, name)
+            mkdir(diff_dir)
+            
+            # Only the compressed version of each patch is published.
+            patch_file = IndexWriter(patch_path, [("gz", None)])
+            patch_file.write(script)
+            patch_checksums = patch_file.close()
+            os.remove(patch_path)
+            
+            patches.append((name, previous, (patch_checksums[patch_path]["SHA256"], len(script)),
+                            (patch_checksums[patch_path + ".gz"]["SHA256"],
+                             os.stat(patch_path + ".gz")[stat.ST_SIZE])))
+    
+    patches = patches[-pdiff_patches:]
+    
+    # Remove the patches that are no longer listed.
+    if os.path.isdir(diff_dir):
+        names = set(map(lambda patch: patch[0] + ".gz", patches))
+        for name in os.listdir(diff_dir):
+            if name.endswith(".gz") and name not in names:
+                remove_file(os.path.join(diff_dir, name))
+    
+    # Keep the new version of the index for comparison with the next one.
+    previous_dir = os.path.split(previous_path)[0]
+    if not os.path.isdir(previous_dir):
+        os.makedirs(previous_dir)
+    if os.path.exists(previous_path):
+        os.remove(previous_path)
+    try:
+        os.link(index_path, previous_path)
+    except OSError:
+        shutil.copy2(index_path, previous_path)
+    
+    if not os.path.isdir(diff_dir):
+        return [], {}
     
-    for ext, Class in compression_types:
+    Index_file = IndexWriter(Index_path)
+    Index_file.write("SHA256-Current: %s %i\n" % current)
     
-        obj = Class(path + "." + ext, "w")
-        obj.write(open(path).read())
-        obj.close()
-        compressed_files.append(path + "." + ext)
+    for heading, item in (("SHA256-History", 1), ("SHA256-Patches", 2), ("SHA256-Download", 3)):
     
-    return compressed_files
+        Index_file.write(heading + ":\n")
+        suffix = heading == "SHA256-Download" and ".gz" or ""
+        
+        for patch in patches:
+            checksum, size = patch[item]
+            Index_file.write(" %s %i %s%s\n" % (checksum, size, patch[0], suffix))
+    
+    return [Index_path], Index_file.close()
 
+@timed("release")
 def write_component_release(path, suite, component, architecture):
 
     Release_path = os.path.join(path, "Release")
-    Release_file = open(Release_path, "w")
+    Release_file = IndexWriter(Release_path)
     
     arch_details = details.copy()
     arch_details["Archive"] = suite
@@ -545,11 +2788,15 @@ def write_component_release(path, suite, component, architecture):
     for heading in arch_Release_headings:
         Release_file.write(heading + ": " + arch_details[heading] + "\n")
     
-    return Release_path
+    return Release_path, Release_file.close()
 
-def write_suite_release(files, path, suite, components, architectures):
+@timed("release")
+def write_suite_release(files, path, suite, components, architectures, known_checksums = {}):
 
-    Release_file = open(os.path.join(path, "Release"), "w")
+    # The file is written to a temporary file that replaces the old Release file
+    # when it is complete.
+    Release_path = os.path.join(path, "Release")
+    Release_file = open(Release_path + ".new", "w")
     
     suite_details = details.copy()
     suite_details["Suite"] = suite
@@ -565,28 +2812,219 @@ def write_suite_release(files, path, suite, components, architectures):
         
         Release_file.write(heading + ": " + value + "\n")
     
+    if use_by_hash:
+        Release_file.write("Acquire-By-Hash: yes\n")
+    
     sizes = {}
     for file_path in files:
         sizes[file_path] = os.stat(file_path)[stat.ST_SIZE]
     
     if not sizes:
-        return
+        Release_file.close()
+        os.rename(Release_path + ".new", Release_path)
+        return {}
     
     max_size = max(sizes.values())
     max_size_length = len(str(max_size))
     
-    for name, command in hashes:
+    # Only calculate the checksums of files that are not already known.
+    release_checksums = checksum_files(filter(lambda f: f not in known_checksums, files))
+    for file_path in files:
+        if file_path in known_checksums:
+            release_checksums[file_path] = known_checksums[file_path]
+    
+    # File names are given relative to the suite directory.
+    path_pieces = os.path.normpath(path).split(os.sep)
+    
+    for name, algorithm in hashes:
+    
+        Release_file.write(name + ":\n")
+        
+        for file_path in files:
+        
+            result = release_checksums[file_path][name]
+            
+            padding = "    " + (max_size_length - len(str(sizes[file_path]))) * " "
+            pieces = os.path.normpath(file_path).split(os.sep)
+            Release_file.write(" %s%s%i %s\n" % (result, padding, sizes[file_path],
+                                                   "/".join(pieces[len(path_pieces):])))
+    
+    Release_file.close()
+    os.rename(Release_path + ".new", Release_path)
+    return release_checksums
+
+# Contents files
+
+def contents_cache_path(root_path, checksum):
+
+    return os.path.join(root_path, state_dir_name, contents_dir_name, checksum[:2], checksum)
+
+def cache_file_list(path, checksum, root_path):
+
+    # Record the list of files in a package in the state directory, where it is
+    # found using the checksum of the package.
+    cache_path = contents_cache_path(root_path, checksum)
+    if os.path.exists(cache_path):
+        statistics.count("contents_cache_hits")
+        return True
+    
+    statistics.count("contents_cache_misses")
+    
+    try:
+        names = read_deb_file_list(path)
+    except DebError, exception:
+        sys.stderr.write("Failed to read the file list from package: %s (%s)\n" % (path, exception))
+        return False
+    
+    cache_dir = os.path.split(cache_path)[0]
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+    
+    # Write to a temporary file first because more than one process may be writing
+    # the list for the same package.
+    temp_path = "%s.%i" % (cache_path, os.getpid())
+    f = open(temp_path, "w")
+    for name in names:
+        f.write(name + "\n")
+    f.close()
+    os.rename(temp_path, cache_path)
+    return True
+
+def read_file_list(path, qualifier):
+
+    # Yield pairs of file names and qualifiers from a sorted list of files.
+    f = open(path)
+    for line in f:
+        yield line[:-1], qualifier
+    f.close()
+
+def read_merged_file_list(f):
+
+    for line in f:
+        name, qualifiers = line[:-1].rsplit("\t", 1)
+        yield name, qualifiers
+    f.close()
+
+def merge_file_lists(lists):
+
+    # Merge sorted sequences of file names and qualifiers, yielding each file name
+    # once with the qualifiers of all the packages that contain it.
+    current = None
+    qualifiers = []
+    
+    for name, qualifier in heapq.merge(*lists):
+    
+        if name != current:
+            if qualifiers:
+                yield current, ",".join(qualifiers)
+            current = name
+            qualifiers = []
+        
+        qualifiers.append(qualifier)
+    
+    if qualifiers:
+        yield current, ",".join(qualifiers)
+
+@timed("index")
+def write_contents_file(path, entries):
+
+    # Write a Contents file from a list of pairs containing the paths of cached file
+    # lists and the section/name qualifiers of their packages. Only a limited number
+    # of lists are merged at once, with intermediate results written to temporary
+    # files, so that the memory used does not depend on the number of packages.
+    lists = map(lambda (list_path, qualifier): read_file_list(list_path, qualifier), entries)
+    
+    while len(lists) > contents_merge_width:
+    
+        merged_lists = []
+        
+        for i in range(0, len(lists), contents_merge_width):
+        
+            temp_file = tempfile.TemporaryFile()
+            for name, qualifiers in merge_file_lists(lists[i:i + contents_merge_width]):
+                temp_file.write(name + "\t" + qualifiers + "\n")
+            
+            temp_file.seek(0)
+            merged_lists.append(read_merged_file_list(temp_file))
+        
+        lists = merged_lists
+    
+    Contents_file = HashingFile(path)
+    compressor = GzipCompressor(Contents_file)
+    pending = []
+    
+    for name, qualifiers in merge_file_lists(lists):
+    
+        # Sort the qualifiers so that the output does not depend on how the lists
+        # were grouped, listing each package once if several versions of it contain
+        # the file.
+        qualifiers = ",".join(sorted(set(qualifiers.split(","))))
+        pending.append("%-59s %s\n" % (name, qualifiers))
+        
+        if len(pending) == 4096:
+            compressor.write("".join(pending))
+            pending = []
+    
+    compressor.write("".join(pending))
+    compressor.close()
+    Contents_file.close()
+    
+    return {path: Contents_file.checksums()}
+
+def update_contents(path, root_path, architecture, Packages_paths, pool = None):
+
+    # Write the Contents-<architecture>.gz file for a suite from the packages listed
+    # in the Packages files for the architecture in each of its components.
+    entries = []
+    missing = {}
+    
+    for Packages_path in Packages_paths:
+    
+        Packages_obj = Packages(Packages_path)
+        Packages_obj.read()
+        
+        for package_versions_dict in Packages_obj.packages.values():
+            for package in package_versions_dict.values():
+            
+                checksum = package["SHA256"]
+                entries.append((contents_cache_path(root_path, checksum),
+                                package["Section"] + "/" + package["Package"]))
+                
+                if not os.path.exists(entries[-1][0]):
+                    missing[checksum] = package.path
+    
+    # Read the file lists of packages that have not been seen before.
+    run_tasks(map(lambda (checksum, package_path):
+                            (cache_file_list, (package_path, checksum, root_path)),
+                            missing.items()), pool)
+    
+    entries = filter(lambda (list_path, qualifier): os.path.exists(list_path), entries)
+    
+    Contents_path = os.path.join(path, "Contents-" + architecture + ".gz")
+    message("Writing", Contents_path)
+    return Contents_path, write_contents_file(Contents_path, entries)
+
+def prune_contents_cache(root_path):
+
+    # Remove the cached file lists of packages that are no longer in any of the
+    # Packages files in the repository.
+    checksums = set()
+    
+    for Packages_path in glob.glob(os.path.join(root_path, "dists", "*", "*", "*", "Packages")):
     
-        Release_file.write(name + ":\n")
-        
-        for file_path in files:
+        Packages_obj = Packages(Packages_path)
+        Packages_obj.read()
         
-            s = subprocess.Popen([command, file_path], stdout=subprocess.PIPE)
-            result = s.stdout.read().strip().split()[0]
-            
-            padding = "    " + (max_size_length - len(str(sizes[file_path]))) * " "
-            pieces = file_path.split(os.sep)
-            Release_file.write(" %s%s%i %s\n" % (result, padding, sizes[file_path], os.sep.join(pieces[-3:])))
+        for package_versions_dict in Packages_obj.packages.values():
+            for package in package_versions_dict.values():
+                checksums.add(package["SHA256"])
+    
+    for cache_path in glob.glob(os.path.join(root_path, state_dir_name, contents_dir_name, "*", "*")):
+        if os.path.split(cache_path)[1] not in checksums:
+            remove_file(cache_path)
 
 # Create repository
 
@@ -611,30 +3049,64 @@ def create_repo(path, suites, components):
     mkdir(path)
     
     create_tree(["dists", suites, components, default_architectures], path)
+    write_default_settings(path)
     return 0
 
 # Add packages and sources
 
-def add_package(package, path, link = False):
+def add_package(package, path, mode = "auto"):
 
-    architecture = package.architecture()
-    section = package.section()
+    # Return whether the package was added, skipped because an identical file is
+    # already in place or rejected, with the package as it is stored in the component
+    # if it was added.
+    package._get_info()
+    if not package._has_info:
+        return "rejected", None
+    
+    try:
+        architecture = package.architecture()
+        section = package.section()
+    except KeyError, exception:
+        sys.stderr.write("Package has no %s field: %s\n" % (exception, package.path))
+        return "rejected", None
+    
+    pool_dir = None
+    if use_pool:
+        try:
+            source_name = package["Source"].split()[0]
+        except KeyError:
+            source_name = package["Package"]
+        pool_dir = pool_directory(path, source_name)
+        if pool_conflict(package.path, pool_dir, package["SHA256"]):
+            return "rejected", None
     
     dest_dir = os.path.join(path, "binary-" + architecture, section)
     mkdirs([path, "binary-" + architecture, section])
     dest_path = os.path.join(dest_dir, os.path.split(package["Filename"])[1])
-    if link:
-        link_file(package.path, dest_path)
-    else:
-        copy_file(package.path, dest_path)
+    
+    if not place_file(package.path, dest_path, mode, pool_dir, package["SHA256"]):
+        return "skipped", None
+    
+    # The stored package is described using the information already read instead of
+    # examining it again.
+    info = layer_fields(package._info, {"Filename": repository_file_name(dest_path, 6)})
+    return "added", Package(dest_path, info, package._headings, package.lines)
 
-def add_source(source, path, link = False, source_only = False):
+def add_source(source, path, mode = "auto", source_only = False, binaries = None):
 
-    section = source.find_section(path)
+    # Return whether the source was added, skipped because identical files are
+    # already in place or rejected, with the source as it is stored in the component
+    # if it was added.
+    source._get_info()
+    if not source._has_info:
+        sys.stderr.write("Failed to read control information from source: %s\n" % source.path)
+        return "rejected", None
+    
+    section = source.find_section(path, binaries)
     
     if not section and not source_only:
         sys.stderr.write("Failed to find a binary package for source: %s\n" % source.path)
-        return
+        return "rejected", None
     
     source_file_missing = False
     
@@ -663,51 +3135,226 @@ def add_source(source, path, link = False, source_only = False):
             source_file_missing = True
     
     if source_file_missing:
-        return
+        return "rejected", None
+    
+    # Each file is only hashed once, when it is compared with the pool and with the
+    # file already in the repository.
+    file_paths = [source.path, orig_path] + (diff_name and [diff_path] or [])
+    checksums = dict(map(lambda file_path: (file_path, file_checksums(file_path)["SHA256"]),
+                         file_paths))
+    
+    # The files of a source are stored together in the pool, so none of them are
+    # added if any of them differ from files already there.
+    pool_dir = None
+    if use_pool:
+        pool_dir = pool_directory(path, source["Source"])
+        if filter(lambda file_path: pool_conflict(file_path, pool_dir, checksums[file_path]),
+                  file_paths):
+            return "rejected", None
     
     dest_dir = os.path.join(path, "source", section)
     mkdirs([path, "source", section])
     
     # Copy the .dsc file.
     dest_path = os.path.join(dest_dir, source.file_name)
-    if link:
-        link_file(source.path, dest_path)
-    else:
-        copy_file(source.path, dest_path)
+    placed = [place_file(source.path, dest_path, mode, pool_dir, checksums[source.path])]
     
     # Copy the original archive.
-    if link:
-        link_file(orig_path, os.path.join(dest_dir, orig_name))
-    else:
-        copy_file(orig_path, os.path.join(dest_dir, orig_name))
+    placed.append(place_file(orig_path, os.path.join(dest_dir, orig_name), mode, pool_dir,
+                             checksums[orig_path]))
     
     # Copy the diff archive, if present.
     if diff_name:
-        if link:
-            link_file(diff_path, os.path.join(dest_dir, diff_name))
+        placed.append(place_file(diff_path, os.path.join(dest_dir, diff_name), mode, pool_dir,
+                                 checksums[diff_path]))
+    
+    if True not in placed:
+        return "skipped", None
+    
+    return "added", Source(dest_path)
+
+def repository_root(component_path):
+
+    # The component directory is found in <repo>/dists/<suite>/<component>.
+    return os.sep.join(os.path.abspath(component_path).split(os.sep)[:-3])
+
+@timed("scan")
+def input_files(patterns, manifest_path = None):
+
+    # Return lists of the package and source files given by the patterns, which may
+    # be file names, wildcard patterns or directories to search, and by the lines of
+    # a manifest, which are relative to the directory containing it. Each file is
+    # only included once. Patterns that match no files are also returned.
+    patterns = list(patterns)
+    
+    if manifest_path:
+        manifest_dir = os.path.split(os.path.abspath(manifest_path))[0]
+        for line in open(manifest_path).readlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                patterns.append(os.path.join(manifest_dir, line))
+    
+    found = {Package.suffix: [], Source.suffix: []}
+    unmatched = []
+    seen = set()
+    
+    for pattern in patterns:
+    
+        if os.path.isdir(pattern):
+            paths = []
+            for dir_path, dir_names, file_names in os.walk(pattern):
+                dir_names.sort()
+                paths += map(lambda name: os.path.join(dir_path, name), sorted(file_names))
         else:
-            copy_file(diff_path, os.path.join(dest_dir, diff_name))
+            paths = sorted(glob.glob(pattern))
+            if not paths:
+                unmatched.append(pattern)
+        
+        for file_path in paths:
+            suffix = os.path.splitext(file_path)[1]
+            real_path = os.path.realpath(file_path)
+            if suffix in found and os.path.isfile(file_path) and real_path not in seen:
+                seen.add(real_path)
+                found[suffix].append(file_path)
+    
+    return found[Package.suffix], found[Source.suffix], unmatched
 
-def add_packages_and_sources(path, file_paths, link = False, source_only = False):
+def add_packages_and_sources(path, file_paths, link = False, source_only = False,
+                             link_mode = "auto", manifest_path = None):
 
-    for file_path in file_paths:
+    # The link option is the same as the symlink mode.
+    if link:
+        link_mode = "symlink"
+    
+    root_path = repository_root(path)
+    read_settings(root_path)
+    
+    package_paths, source_paths, unmatched = input_files(file_paths, manifest_path)
+    
+    results = {"added": [], "skipped": [], "rejected": []}
+    
+    for pattern in unmatched:
+        sys.stderr.write("No files found for: %s\n" % pattern)
+        results["rejected"].append(pattern)
+    
+    # Packages with the same file name would be placed in the same place, so only
+    # the first of them is added.
+    names = {}
+    for package_path in package_paths[:]:
+        name = os.path.split(package_path)[1]
+        if name in names:
+            sys.stderr.write("Package has the same name as %s: %s\n" % (names[name], package_path))
+            results["rejected"].append(package_path)
+            package_paths.remove(package_path)
+        else:
+            names[name] = package_path
+    
+    # Each package is examined and placed in its own task, but the catalogue is only
+    # updated by this thread.
+    def add_package_file(package_path):
+        try:
+            return add_package(Package(path = package_path), path, mode = link_mode)
+        except (IOError, OSError), exception:
+            sys.stderr.write("Failed to add package: %s (%s)\n" % (package_path, exception))
+            return "rejected", None
+    
+    added = zip(package_paths, map_in_threads(add_package_file, package_paths))
+    
+    def read_source(source_path):
+        source = Source(source_path)
+        try:
+            source._get_info()
+        except (IOError, OSError), exception:
+            sys.stderr.write("Failed to read source: %s (%s)\n" % (source_path, exception))
+        return source
     
-        for package in find_files_from_pattern(file_path, Package):
-            add_package(package, path, link = link)
+    sources = map_in_threads(read_source, source_paths)
     
-    for file_path in file_paths:
+    # Sources with bad signatures are not added if signatures are checked.
+    bad = check_source_signatures(root_path, source_paths)
+    for source_path in bad:
+        results["rejected"].append(source_path)
     
-        for source in find_files_from_pattern(file_path, Source):
-            add_source(source, path, link = link, source_only = source_only)
+    # Index the binary packages in the component, including those just added, so that
+    # the sections of sources can be found without searching for each of them.
+    if sources:
+        binaries = BinaryIndex(path)
+    
+    # Versions of the same source can share files, so they are added in turn by the
+    # same task.
+    groups = {}
+    for source in sources:
+        if source.path not in bad:
+            groups.setdefault(source._info.get("Source", source.path), []).append(source)
+    
+    def add_source_files(group):
+        group_results = []
+        for source in group:
+            try:
+                result = add_source(source, path, mode = link_mode, source_only = source_only,
+                                    binaries = binaries)
+            except (IOError, OSError), exception:
+                sys.stderr.write("Failed to add source: %s (%s)\n" % (source.path, exception))
+                result = "rejected", None
+            group_results.append((source.path, result))
+        return group_results
+    
+    for group_results in map_in_threads(add_source_files, map(lambda key: groups[key], sorted(groups))):
+        added += group_results
+    
+    open_catalogue(root_path)
+    
+    for file_path, (status, entry) in added:
+        results[status].append(file_path)
+        if catalogue and entry:
+            if isinstance(entry, Package):
+                catalogue.store_package(entry)
+            else:
+                catalogue.store_source(entry)
+    
+    close_catalogue()
+    
+    print "Added %i files, skipped %i already present, rejected %i" % (
+        len(results["added"]), len(results["skipped"]), len(results["rejected"]))
+    for file_path in results["rejected"]:
+        sys.stderr.write("Rejected: %s\n" % file_path)
+    
+    if results["rejected"]:
+        return 1
     
     return 0
 
 # Remove packages and sources
 
-def remove_packages_and_sources(component_path, names):
+def component_file(arch_path, path):
+
+    # Indices refer to files in the pool rather than the links to them in the
+    # component, so find the link in the section directories of the architecture
+    # that refers to the file. Return None if there is none.
+    root_path = repository_root(os.path.split(os.path.abspath(arch_path))[0])
+    if os.path.relpath(os.path.abspath(path), root_path).split(os.sep)[0] != pool_dir_name:
+        return path
+    
+    for link_path in glob.glob(os.path.join(arch_path, "*", os.path.split(path)[1])):
+        if os.path.realpath(link_path) == os.path.realpath(path):
+            return link_path
+    
+    return None
+
+def remove_packages_and_sources(component_path, names, verify = False):
 
     names = set(names)
     
+    # The information in the catalogue database or the indices is trusted unless
+    # verification is requested, in which case the package files are examined with
+    # the help of the cache.
+    root_path = repository_root(component_path)
+    read_settings(root_path)
+    open_catalogue(root_path)
+    
+    if verify:
+        open_metadata_cache(root_path)
+    
     # Examine the different architectures available.
     
     catalogues = {}
@@ -716,13 +3363,15 @@ def remove_packages_and_sources(component_path, names):
     
         arch_path = os.path.join(component_path, arch)
         
-        if arch == "source":
+        if catalogue and not verify:
+            catalogues[arch] = CatalogueIndex(catalogue, arch_path)
+        elif arch == "source":
             Sources_obj = Sources(os.path.join(arch_path, "Sources"))
-            Sources_obj.read()
+            Sources_obj.read(verify)
             catalogues[arch] = Sources_obj
         else:
             Packages_obj = Packages(os.path.join(arch_path, "Packages"))
-            Packages_obj.read()
+            Packages_obj.read(verify)
             catalogues[arch] = Packages_obj
     
     # Read the binary packages first to obtain all the source packages, then read
@@ -742,7 +3391,9 @@ def remove_packages_and_sources(component_path, names):
         
             for package in catalogues[arch].find(name):
             
-                packages[name] = package
+                package_path = component_file(os.path.join(component_path, arch), package.path)
+                if package_path:
+                    packages[package_path] = package
                 try:
                     source_names.add(package["Source"])
                 except KeyError:
@@ -772,113 +3423,617 @@ def remove_packages_and_sources(component_path, names):
         
             for package in catalogues[arch].find(name):
             
-                packages[name] = package
+                package_path = component_file(os.path.join(component_path, arch), package.path)
+                if package_path:
+                    packages[package_path] = package
+    
+    source_paths = []
     
     if "source" in catalogues:
     
         for source in sources.values():
-            remove_file(source.path)
-            source_dir = os.path.split(source.path)[0]
+            source_path = component_file(os.path.join(component_path, "source"), source.path)
+            if not source_path:
+                continue
+            source_paths.append(source_path)
+            remove_file(source_path)
+            source_dir = os.path.split(source_path)[0]
             for file_name in map(lambda n: n.strip().split()[-1], source["Files"]):
                 remove_file(os.path.join(source_dir, file_name))
     
-    for package in packages.values():
-        remove_file(package.path)
+    # Files in the pool are only removed by the update command once nothing links to
+    # them.
+    for package_path in packages.keys():
+        remove_file(package_path)
     
+    if catalogue:
+        catalogue.remove_files(source_paths + packages.keys())
+    
+    close_catalogue()
+    close_metadata_cache()
     return 0
 
 # Update repository
 
-def update_tree(levels, parent_path, root_path = None, component = None, architecture = None):
+def init_worker(threads):
 
-    # <repo>/dists/<suite>/<component>/<architecture>
+    global hash_threads, statistics
     
-    if len(levels) == 0:
-        root_path = parent_path
+    # Share the available processors between the worker processes.
+    hash_threads = threads
     
-    print "Entering", parent_path
+    # Only record the work done by the worker, which is returned with each result.
+    statistics = Statistics()
+
+def run_in_worker(task):
+
+    function, arguments = task
+    result = function(*arguments)
     
-    subdirs = os.listdir(parent_path)
+    # Return any metadata collected by the worker so that it can be merged into
+    # the cache held by the main process, and the statistics about the task.
+    if metadata_cache:
+        return result, metadata_cache.take_updates(), statistics.take()
+    else:
+        return result, None, statistics.take()
+
+def run_tasks(tasks, pool = None):
+
+    # Run each (function, arguments) task, either in this process or using the
+    # pool of worker processes, returning the results in the order of the tasks.
+    if pool is None:
+        return map(lambda (function, arguments): function(*arguments), tasks)
     
-    files = []
-    packages = []
-    architectures = []
-    components = []
+    results = []
+    
+    for result, updates, taken in pool.map(run_in_worker, tasks):
+        if updates:
+            metadata_cache.merge(updates)
+        statistics.merge(taken)
+        results.append(result)
+    
+    return results
+
+@timed("scan")
+def directory_inventory(path):
+
+    # Return a sorted list of the names, sizes and modification times of the files
+    # in the section subdirectories of an architecture or source directory, ignoring
+    # the subdirectories that are written by the update command.
+    inventory = []
+    
+    for file_path in glob.glob(os.path.join(path, "*", "*")):
+        name = os.sep.join(file_path.split(os.sep)[-2:])
+        if name.split(os.sep)[0] in generated_dir_names:
+            continue
+        s = os.stat(file_path)
+        inventory.append((name, s.st_size, int(s.st_mtime * 1000000000)))
+    
+    inventory.sort()
+    return inventory
+
+def directory_compression(architecture):
+
+    if architecture == "source":
+        return Sources_compression
+    else:
+        return Packages_compression
+
+def manifest_path(root_path, path):
+
+    return os.path.join(root_path, state_dir_name, manifests_dir_name,
+                        os.path.relpath(path, root_path))
+
+def read_manifest(root_path, path):
+
+    file_path = manifest_path(root_path, path)
+    
+    if not os.path.exists(file_path):
+        return None
+    
+    try:
+        f = open(file_path, "rb")
+        manifest = cPickle.load(f)
+        f.close()
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+        sys.stderr.write("Ignoring unreadable manifest: %s\n" % file_path)
+        return None
+    
+    # Only use the manifest if the index files it describes are still present.
+    for file_path in manifest["files"]:
+        if not os.path.exists(file_path):
+            return None
+    
+    return manifest
+
+def write_manifest(root_path, path, inventory, compression, files, checksums, catalogued = False,
+                   by_hash = False):
+
+    file_path = manifest_path(root_path, path)
+    
+    manifest_dir = os.path.split(file_path)[0]
+    if not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    
+    # Record the checksums of the index files together with the details used to
+    # check that they have not been changed since.
+    file_checksums = {}
+    for index_path in files:
+        file_checksums[index_path] = (file_key(index_path), checksums[index_path])
+    
+    manifest = {"inventory": inventory, "compression": compression, "files": files,
+                "checksums": file_checksums, "catalogued": catalogued, "by_hash": by_hash}
+    
+    f = open(file_path, "wb")
+    cPickle.dump(manifest, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+def by_hash_history_path(root_path, path):
+
+    # Files are published by hash in both suite and architecture directories, so the
+    # history of each is stored in a file alongside the directory for its children.
+    return os.path.join(root_path, state_dir_name, by_hash_dir_name,
+                        os.path.relpath(path, root_path) + ".generations")
+
+def by_hash_entry(path, file_path, name, checksum):
+
+    # Return the path of a by-hash file relative to the directory it is published in.
+    return os.path.normpath(os.path.join(os.path.relpath(os.path.split(file_path)[0], path),
+                            by_hash_dir_name, name, checksum))
+
+def publish_by_hash(root_path, path, files, checksums, removed = {}):
+
+    # Link each index file to by-hash/<algorithm>/<checksum> in the directory that
+    # contains it, then remove the files that only belong to generations older than
+    # those kept. The files in each generation are given relative to the path. The
+    # removed dictionary maps the paths of index files that are no longer published
+    # to their checksums, and their entries are removed from every generation.
+    generation = set()
+    
+    for file_path in files:
+    
+        file_dir, file_name = os.path.split(file_path)
+        if file_name == "Release":
+            continue
+        
+        for name, algorithm in hashes:
+        
+            entry = by_hash_entry(path, file_path, name, checksums[file_path][name])
+            generation.add(entry)
+            
+            dest_path = os.path.join(path, entry)
+            if os.path.exists(dest_path):
+                continue
+            
+            mkdirs([file_dir, by_hash_dir_name, name])
+            try:
+                os.link(file_path, dest_path)
+            except OSError:
+                shutil.copy2(file_path, dest_path)
+    
+    # Read the list of generations published previously. If it is missing, any files
+    # already present are treated as a single older generation.
+    history_path = by_hash_history_path(root_path, path)
+    history = None
+    
+    if os.path.exists(history_path):
+        try:
+            f = open(history_path, "rb")
+            history = cPickle.load(f)
+            f.close()
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            sys.stderr.write("Ignoring unreadable by-hash history: %s\n" % history_path)
+    
+    if history is None:
+        existing = set(map(lambda p: os.path.relpath(p, path),
+                           glob.glob(os.path.join(path, by_hash_dir_name, "*", "*")) +
+                           glob.glob(os.path.join(path, "*", by_hash_dir_name, "*", "*"))))
+        history = filter(None, [existing - generation])
     
-    if len(levels) == 4:
+    dropped = set()
+    for file_path, file_checksums in removed.items():
+        for name, algorithm in hashes:
+            dropped.add(by_hash_entry(path, file_path, name, file_checksums[name]))
+    
+    dropped -= generation
+    for entry in dropped:
+        remove_file(os.path.join(path, entry))
+    
+    history = map(lambda old_generation: old_generation - dropped, history)
+    
+    if not history or history[-1] != generation:
+        history.append(generation)
+    
+    kept = history[-by_hash_generations:]
+    kept_entries = reduce(lambda a, b: a | b, kept, set())
+    
+    for old_generation in history[:-by_hash_generations]:
+        for entry in old_generation - kept_entries:
+            remove_file(os.path.join(path, entry))
+    
+    history_dir = os.path.split(history_path)[0]
+    if not os.path.isdir(history_dir):
+        os.makedirs(history_dir)
+    
+    f = open(history_path, "wb")
+    cPickle.dump(kept, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+def update_suite(path, root_path, pool = None, full = False):
 
-        info_dict = {}
+    # <repo>/dists/<suite>/<component>/<architecture>
+    
+    components = []
+    directories = []
+    architecture_dicts = {}
+    
+    for component in os.listdir(path):
+    
+        component_path = os.path.join(path, component)
+        if not os.path.isdir(component_path) or component in generated_dir_names:
+            continue
+        
+        message("Entering", component_path)
+        components.append(component)
+        
+        subdirs = os.listdir(component_path)
         
         # In the component level, the subdirectories represent architectures.
-        child_path = os.path.join(parent_path, "source")
+        child_path = os.path.join(component_path, "source")
         if "source" in subdirs and os.path.isdir(child_path):
-            print "Entering", child_path
-            sources = catalogue_sources(child_path, root_path)
-            packages, files, architectures = write_catalogue_sources_file(child_path, root_path, component, sources)
+            message("Entering", child_path)
+            directories.append((component, "source", child_path))
             subdirs.remove("source")
         
-        # Add a binary-i386 subdirectory if not present.
-        #if "binary-i386" not in subdirs:
-        #    os.mkdir(os.path.join(parent_path, "binary-i386"))
-        #    subdirs.append("binary-i386")
+        architecture_dict = architecture_dicts.setdefault(component, {})
         
         for subdir in subdirs:
         
-            child_path = os.path.join(parent_path, subdir)
+            child_path = os.path.join(component_path, subdir)
             if not os.path.isdir(child_path):
                 continue
             
-            print "Entering", child_path
+            message("Entering", child_path)
             architecture = subdir.replace("binary-", "")
+            directories.append((component, architecture, child_path))
+            architecture_dict[architecture] = child_path
+    
+    # Compare the contents of each directory with the manifest written by the
+    # previous run to find the directories whose indices need to be regenerated.
+    # The Packages files for each architecture also include the packages in the
+    # "all" architecture directory.
+    inventories = {}
+    for component, architecture, child_path in directories:
+        inventories[child_path] = directory_inventory(child_path)
+    
+    inputs = {}
+    manifests = {}
+    changed = set()
+    
+    for component, architecture, child_path in directories:
+    
+        inputs[child_path] = inventories[child_path]
+        all_path = architecture_dicts[component].get("all")
+        
+        if architecture not in ("source", "all") and all_path:
+            inputs[child_path] = inputs[child_path] + inventories[all_path]
+        
+        # The manifest is read even for a full update because it records the checksums
+        # of compressed indices whose by-hash files may need to be removed.
+        manifests[child_path] = read_manifest(root_path, child_path)
+        
+        # The index files also need to be written again if the compression settings
+        # or the use of by-hash files have changed, and the directory is catalogued
+        # again if the catalogue database was not in use when it was last updated.
+        manifest = manifests[child_path]
+        if full or not manifest or manifest["inventory"] != inputs[child_path] or \
+            manifest.get("compression") != directory_compression(architecture) or \
+            manifest.get("catalogued", False) != (catalogue is not None) or \
+            manifest.get("by_hash", False) != use_by_hash:
+            changed.add(child_path)
+        else:
+            statistics.count("unchanged_directories")
+            message("Unchanged", child_path)
+    
+    # Catalogue the sources and packages in each changed directory, and in the "all"
+    # architecture directory if its packages are needed by another directory. The
+    # sources are catalogued and written in one step because they do not depend on
+    # the contents of any other directory. The entries stored in the catalogue database
+    # are passed to the tasks so that unchanged files do not need to be examined.
+    catalogue_tasks = []
+    known = {}
+    
+    for component, architecture, child_path in directories:
+    
+        if architecture == "source":
+            if child_path in changed:
+                if catalogue:
+                    known[child_path] = catalogue.known_files("sources", child_path)
+                catalogue_tasks.append((component, architecture, child_path,
+                    (update_sources, (child_path, root_path, component, known.get(child_path, {})))))
+        
+        elif child_path in changed or \
+            (architecture == "all" and changed.intersection(architecture_dicts[component].values())):
+            if catalogue:
+                known[child_path] = catalogue.known_files("packages", child_path)
+            catalogue_tasks.append((component, architecture, child_path,
+                (catalogue_packages, (child_path, root_path, known.get(child_path, {})))))
+    
+    results = run_tasks(map(lambda task: task[3], catalogue_tasks), pool)
+    
+    packages = {}
+    files = {}
+    architectures = []
+    catalogues = {}
+    
+    known_checksums = {}
+    
+    for (component, architecture, child_path, task), result in zip(catalogue_tasks, results):
+    
+        if architecture == "source":
+            packages[child_path], files[child_path], new_archs, checksums, catalogued = result
+            known_checksums.update(checksums)
+        else:
+            catalogues[child_path] = result
+            catalogued = result
+        
+        if catalogue:
+            catalogue.update_directory(child_path, catalogued, known[child_path])
+    
+    # Write the package files for the changed directories, adding the entries for the
+    # "all" architecture to each of the package files for the other architectures.
+    write_tasks = []
+    
+    for component in components:
+    
+        architecture_dict = architecture_dicts[component]
+        
+        for architecture, child_path in architecture_dict.items():
+        
+            if child_path not in changed:
+                continue
             
-            # In each architecture directory, catalogue all the section subdirectories.
-            # In the source directory, catalogue the sources for the section instead.
-            new_packages = catalogue_packages(child_path, root_path)
+            new_packages = catalogues[child_path]
+            packages[child_path] = new_packages
             
-            packages += new_packages
-            info_dict[architecture] = (child_path, new_packages)
+            if architecture != "all" and "all" in architecture_dict:
+                new_packages = new_packages + catalogues[architecture_dict["all"]]
+            
+            write_tasks.append((child_path, (write_catalogue_package_file,
+                               (component, architecture, child_path, new_packages, root_path))))
+    
+    results = run_tasks(map(lambda (child_path, task): task, write_tasks), pool)
+    
+    for (child_path, task), (new_files, checksums) in zip(write_tasks, results):
+        files[child_path] = new_files
+        known_checksums.update(checksums)
+    
+    # Reuse the index files and checksums recorded for the unchanged directories.
+    for component, architecture, child_path in directories:
+    
+        if child_path in changed:
+            continue
         
-        # Write the package files.
-        for architecture, (path, new_packages) in info_dict.items():
+        manifest = manifests[child_path]
+        files[child_path] = manifest["files"]
         
-            # Add the all entries to each of the package files for the architectures.
-            if architecture != "all" and "all" in info_dict:
-                files += write_catalogue_package_file(component, architecture, path, new_packages + info_dict["all"][1])
-            else:
-                files += write_catalogue_package_file(component, architecture, path, new_packages)
+        for file_path, (key, file_checksums) in manifest["checksums"].items():
+            if file_key(file_path) == key:
+                known_checksums[file_path] = file_checksums
     
-    else:
-        for subdir in subdirs:
+    # Write the Contents file for each architecture whose packages have changed in
+    # any of the components, or whose Contents file is missing.
+    contents_files = []
+    new_contents_files = []
+    
+    if use_contents:
+    
+        contents_dicts = {}
+        for component, architecture, child_path in directories:
+            if architecture not in ("source", "all"):
+                contents_dicts.setdefault(architecture, []).append(child_path)
         
-            child_path = os.path.join(parent_path, subdir)
-            if not os.path.isdir(child_path):
+        for architecture, child_paths in sorted(contents_dicts.items()):
+        
+            Contents_path = os.path.join(path, "Contents-" + architecture + ".gz")
+            
+            if not os.path.exists(Contents_path) or changed.intersection(child_paths):
+                Packages_paths = map(lambda p: os.path.join(p, "Packages"), child_paths)
+                Contents_path, checksums = update_contents(path, root_path, architecture,
+                                                           Packages_paths, pool)
+                known_checksums.update(checksums)
+                new_contents_files.append(Contents_path)
+            
+            contents_files.append(Contents_path)
+    
+    # Publish the new index files under their checksums before the suite Release file
+    # that refers to them replaces the old one. Clients using the old Release file can
+    # still obtain the files it refers to from the earlier generations.
+    if use_by_hash:
+        for component, architecture, child_path in directories:
+        
+            if child_path not in changed:
                 continue
             
-            elif len(levels) == 3:
-                # In the suite level, the subdirectories represent components.
-                component = subdir
+            # Compressed indices in formats that are no longer used are also removed
+            # from the by-hash files, using the checksums recorded in the manifest.
+            index_name = architecture == "source" and "Sources" or "Packages"
+            unused = unused_compressed_files(os.path.join(child_path, index_name),
+                                             directory_compression(architecture))
+            removed = {}
+            manifest = manifests[child_path]
+            if manifest:
+                for file_path in unused:
+                    if file_path in manifest["checksums"]:
+                        removed[file_path] = manifest["checksums"][file_path][1]
             
-            new_packages, new_files, new_archs = update_tree(levels + [subdir], child_path, root_path, component, architecture)
-            packages += new_packages
-            files += new_files
-            architectures += new_archs
-            components.append(component)
+            publish_by_hash(root_path, child_path, files[child_path], known_checksums, removed)
+        
+        # Each generation of Contents files includes those that have not changed.
+        if new_contents_files:
+            known_checksums.update(checksum_files(
+                filter(lambda f: f not in known_checksums, contents_files)))
+            publish_by_hash(root_path, path, contents_files, known_checksums)
+    
+    # Collect the packages and files in the order that their directories were found.
+    all_packages = []
+    all_files = []
+    
+    for component in components:
+    
+        child_path = os.path.join(path, component, "source")
+        if child_path in files:
+            all_packages += packages.get(child_path, [])
+            all_files += files[child_path]
+            architectures.append("source")
+        
+        for child_path in architecture_dicts[component].values():
+            all_packages += packages.get(child_path, [])
+            all_files += files[child_path]
+    
+    all_files += contents_files
+    
+    # When in the suite/distribution directory, write a Release file.
+    suite = os.path.split(path)[1]
+    release_checksums = write_suite_release(all_files, path, suite, components, architectures,
+                                            known_checksums)
+    
+    # Remove the entries in the catalogue database for directories that no longer exist.
+    if catalogue:
+        catalogue.remove_directories(path, map(lambda d: d[2], directories))
+    
+    for component, architecture, child_path in directories:
+        if child_path in changed:
+            write_manifest(root_path, child_path, inputs[child_path],
+                           directory_compression(architecture), files[child_path],
+                           release_checksums, catalogue is not None, use_by_hash)
+    
+    return all_packages, all_files, architectures
+
+def update_tree(levels, parent_path, root_path = None, pool = None, full = False):
+
+    # <repo>/dists/<suite>
+    
+    if len(levels) == 1:
+        root_path = parent_path
+    
+    message("Entering", parent_path)
+    
+    if len(levels) == 3:
+        # In the suite level, the subdirectories represent components.
+        return update_suite(parent_path, root_path, pool, full)
+    
+    subdirs = os.listdir(parent_path)
+    
+    files = []
+    packages = []
+    architectures = []
+    
+    for subdir in subdirs:
+    
+        child_path = os.path.join(parent_path, subdir)
+        if not os.path.isdir(child_path):
+            continue
         
-        if len(levels) == 3:
+        # Ignore the directory used to store information between runs and the pool,
+        # which is only referred to by links in the dists tree.
+        elif len(levels) == 1 and subdir in (state_dir_name, pool_dir_name):
+            continue
         
-            # When in the suite/distribution directory, write a Release file.
-            suite = os.path.split(parent_path)[1]
-            write_suite_release(files, parent_path, suite, components, architectures)
+        new_packages, new_files, new_archs = update_tree(levels + [subdir], child_path, root_path, pool, full)
+        packages += new_packages
+        files += new_files
+        architectures += new_archs
     
     return packages, files, architectures
 
-def update_repo(path):
+@timed("scan")
+def source_files(root_path):
+
+    # Return the paths of the source control files in the repository.
+    paths = []
+    
+    for dir_path, dir_names, file_names in os.walk(os.path.join(root_path, "dists")):
+    
+        for name in generated_dir_names:
+            if name in dir_names:
+                dir_names.remove(name)
+        
+        for name in file_names:
+            if name.endswith(Source.suffix):
+                paths.append(os.path.join(dir_path, name))
+    
+    paths.sort()
+    return paths
+
+def prune_pool(root_path):
+
+    # Remove the files in the pool that are no longer linked to from the dists tree,
+    # then any directories that are left empty.
+    pool_path = os.path.join(os.path.abspath(root_path), pool_dir_name)
+    if not os.path.isdir(pool_path):
+        return
+    
+    linked = set()
+    for dir_path, dir_names, file_names in os.walk(os.path.join(root_path, "dists")):
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            if os.path.islink(file_path):
+                linked.add(os.path.realpath(file_path))
+    
+    for dir_path, dir_names, file_names in os.walk(pool_path, topdown = False):
+    
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            if os.path.realpath(file_path) not in linked:
+                message("Removing", file_path)
+                os.remove(file_path)
+        
+        if dir_path != pool_path and not os.listdir(dir_path):
+            message("Removing", dir_path)
+            os.rmdir(dir_path)
+
+def update_repo(path, jobs = 1, full = False):
 
-    # Catalogue the packages themselves.
-    origin = os.path.split(os.path.abspath(path))[1]
-    update_tree([origin], path)
+    read_settings(path)
+    open_metadata_cache(path)
+    
+    # Catalogue everything again if the catalogue database has just been created.
+    if open_catalogue(path) and catalogue.created:
+        full = True
+    
+    # Worker processes are created after the cache is opened so that they can use
+    # the information it contains.
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker, (max(1, hash_threads / jobs),))
+    else:
+        pool = None
+    
+    try:
+        # Catalogue the packages themselves.
+        origin = os.path.split(os.path.abspath(path))[1]
+        update_tree([origin], path, pool = pool, full = full)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    
+    # The cached file lists of packages that have been removed are only found by
+    # reading all the indices, so this is only done when everything is updated.
+    if use_contents and full:
+        prune_contents_cache(path)
+    
+    # Sources with bad signatures are reported but remain in the indices.
+    check_source_signatures(path, source_files(path))
+    
+    if use_pool:
+        prune_pool(path)
+    
+    close_catalogue()
+    close_metadata_cache()
     return 0
 
+@timed("signing")
 def sign_repo(root_path, suites):
 
     for suite in suites:
@@ -892,9 +4047,8 @@ def sign_repo(root_path, suites):
             if os.path.exists(Release_gpg_path):
                 os.remove(Release_gpg_path)
                 
-            s = subprocess.Popen(["gpg", "-a", "-b", "--sign", "-o",
-                                  Release_gpg_path, Release_path],
-                                  stderr=subprocess.PIPE)
+            s = spawn(["gpg", "-a", "-b", "--sign", "-o", Release_gpg_path, Release_path],
+                      stderr=subprocess.PIPE)
             if s.wait() != 0:
                 sys.stderr.write("Problem with file: %s\n" % Release_path)
                 for line in s.stderr.readlines():
@@ -907,20 +4061,43 @@ def sign_repo(root_path, suites):
     return 0
 
 create_syntax = "create <repository root directory> <suites> <components>"
-add_syntax = "add <repository component directory> [--link] [--source-only] <package or source file> ..."
-remove_syntax = "remove <repository component directory> <package name> ..."
-update_syntax = "update <repository root directory>"
+add_syntax = "add <repository component directory> [--link] [--link-mode <mode>] [--source-only] [--manifest <file>] <package, source file or directory> ..."
+remove_syntax = "remove <repository component directory> [--verify] <package name> ..."
+update_syntax = "update <repository root directory> [--jobs <number of processes>] [--full]"
 sign_syntax = "sign <repository root directory> <suites>"
 
 general_help = (
+    "    Any command can be preceded by these options:\n"
+    "      --quiet          do not report each file and directory as it is handled\n"
+    "      --stats <file>   write timings and counts for the command to a JSON file\n"
     "    <suites> is a comma-separated list of releases. "
     "For example: hardy,lucid,precise\n"
     "    <components> is a comma-separated list of components. "
-    "For example: main,universe,contrib\n\n"
+    "For example: main,universe,contrib\n"
+    "    <mode> is one of auto, symlink, hardlink, reflink, range or copy.\n\n"
     )
 
 if __name__ == "__main__":
 
+    # Options that apply to all commands are removed from the arguments before the
+    # command is found.
+    stats_path = None
+    
+    try:
+        while len(sys.argv) > 1 and sys.argv[1] in ("--quiet", "--stats"):
+            if sys.argv[1] == "--quiet":
+                quiet = True
+            else:
+                stats_path = sys.argv[2]
+                del sys.argv[2]
+            del sys.argv[1]
+    except IndexError:
+        sys.argv = sys.argv[:1]
+    
+    # The statistics are written when the command exits.
+    if stats_path and len(sys.argv) > 1:
+        atexit.register(write_statistics, stats_path, sys.argv[1], sys.argv[2:])
+    
     if len(sys.argv) > 1:
     
         command = sys.argv[1]
@@ -939,33 +4116,71 @@ if __name__ == "__main__":
             argv = sys.argv[:]
             link = False
             source_only = False
+            link_mode = "auto"
+            manifest_path = None
             
-            while len(argv) > 3 and argv[3].startswith("--"):
-                if argv[3] == "--link":
-                    link = True
-                elif argv[3] == "--source-only":
-                    source_only = True
-                del argv[3]
+            try:
+                while len(argv) > 3 and argv[3].startswith("--"):
+                    if argv[3] == "--link":
+                        link = True
+                    elif argv[3] == "--source-only":
+                        source_only = True
+                    elif argv[3] == "--link-mode":
+                        link_mode = argv[4]
+                        del argv[4]
+                    elif argv[3] == "--manifest":
+                        manifest_path = argv[4]
+                        del argv[4]
+                    del argv[3]
+            except IndexError:
+                argv = []
             
-            if len(argv) < 4:
+            if len(argv) < 3 or (len(argv) == 3 and not manifest_path) or \
+               link_mode not in link_modes:
                 sys.stderr.write("Usage: %s %s\n" % (sys.argv[0], add_syntax))
                 sys.exit(1)
             
-            sys.exit(add_packages_and_sources(argv[2], argv[3:], link = link, source_only = source_only))
+            sys.exit(add_packages_and_sources(argv[2], argv[3:], link = link, source_only = source_only,
+                                              link_mode = link_mode, manifest_path = manifest_path))
         
         elif command == "remove":
-            if len(sys.argv) < 3:
+        
+            argv = sys.argv[:]
+            verify = False
+            
+            while len(argv) > 3 and argv[3].startswith("--"):
+                if argv[3] == "--verify":
+                    verify = True
+                del argv[3]
+            
+            if len(argv) < 3:
                 sys.stderr.write("Usage: %s %s\n" % (sys.argv[0], remove_syntax))
                 sys.exit(1)
             
-            sys.exit(remove_packages_and_sources(sys.argv[2], sys.argv[3:]))
+            sys.exit(remove_packages_and_sources(argv[2], argv[3:], verify = verify))
         
         elif command == "update":
-            if len(sys.argv) != 3:
+        
+            argv = sys.argv[:]
+            jobs = 1
+            full = False
+            
+            try:
+                while len(argv) > 3 and argv[3].startswith("--"):
+                    if argv[3] == "--jobs":
+                        jobs = int(argv[4])
+                        del argv[4]
+                    elif argv[3] == "--full":
+                        full = True
+                    del argv[3]
+            except (IndexError, ValueError):
+                argv = []
+            
+            if len(argv) != 3 or jobs < 1:
                 sys.stderr.write("Usage: %s %s\n" % (sys.argv[0], update_syntax))
                 sys.exit(1)
             
-            sys.exit(update_repo(sys.argv[2]))
+            sys.exit(update_repo(argv[2], jobs = jobs, full = full))
     
         elif command == "sign":
             if len(sys.argv) != 4:
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013 met.no
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Tests of the update command, run with python -m unittest discover tests. The
+packages are made by the generator used by benchmarks/repository.py.
+"""
+
+import imp, os, shutil, sys, tempfile, time, unittest
+
+this_dir = os.path.split(os.path.abspath(__file__))[0]
+package_dir = os.path.join(this_dir, os.pardir)
+repo_setup = imp.load_source("repo_setup", os.path.join(package_dir, "python-apt-repo-setup.py"))
+benchmark = imp.load_source("benchmark", os.path.join(package_dir, "benchmarks", "repository.py"))
+
+# The settings are read into global variables, so they are restored after each test.
+settings_names = ["Packages_compression", "Sources_compression", "compression_threads",
+                  "use_catalogue", "use_by_hash", "by_hash_generations", "use_pdiffs",
+                  "pdiff_patches", "use_contents", "verify_signatures", "use_pool"]
+
+class RepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+    
+        self.settings = dict(map(lambda name: (name, getattr(repo_setup, name)), settings_names))
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "input")
+        self.root_path = os.path.join(self.temp_dir, "repo")
+        self.component_path = os.path.join(self.root_path, "dists", "lucid", "main")
+        os.mkdir(self.input_dir)
+        
+        self.generator = benchmark.Generator(1024)
+        self.gmtime = repo_setup.time.gmtime
+        repo_setup.quiet = True
+        repo_setup.create_repo(self.root_path, ["lucid"], ["main"])
+    
+    def tearDown(self):
+    
+        repo_setup.time.gmtime = self.gmtime
+        for name, value in self.settings.items():
+            setattr(repo_setup, name, value)
+        repo_setup.quiet = False
+        shutil.rmtree(self.temp_dir)
+    
+    def add_package(self, name, version):
+    
+        path = os.path.join(self.input_dir, "%s_%s_amd64.deb" % (name, version))
+        benchmark.write_file(path, self.generator.deb(name, version, "amd64"))
+        self.run_quietly(repo_setup.add_packages_and_sources, self.component_path, [path])
+    
+    def add_source(self, name, version):
+    
+        files, dsc = self.generator.source(name, version, ["amd64"])
+        for file_name, data in files.items():
+            benchmark.write_file(os.path.join(self.input_dir, file_name), data)
+        
+        path = os.path.join(self.input_dir, "%s_%s.dsc" % (name, version))
+        benchmark.write_file(path, dsc)
+        self.run_quietly(repo_setup.add_packages_and_sources, self.component_path, [path])
+    
+    def update(self):
+    
+        self.run_quietly(repo_setup.update_repo, self.root_path)
+    
+    def run_quietly(self, function, *args):
+    
+        # Discard the summaries that are written even in quiet mode.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            self.assertEqual(function(*args), 0)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+class PatchTest(RepositoryTest):
+
+    def test_patches_in_the_same_second(self):
+    
+        benchmark.apply_settings(self.root_path, [("pdiff", "enabled", "yes")])
+        
+        # Every update is made to happen at the same time.
+        fixed = time.gmtime()
+        repo_setup.time.gmtime = lambda *args: fixed
+        
+        self.add_package("first", "1.0-1")
+        self.update()
+        self.add_package("second", "1.0-1")
+        self.update()
+        self.add_package("third", "1.0-1")
+        self.update()
+        
+        diff_dir = os.path.join(self.component_path, "binary-amd64", "Packages.diff")
+        current, patches = repo_setup.read_diff_index(os.path.join(diff_dir, "Index"))
+        names = map(lambda patch: patch[0], patches)
+        
+        self.assertEqual(len(names), 2)
+        self.assertEqual(len(set(names)), 2)
+        for name in names:
+            self.assertTrue(os.path.exists(os.path.join(diff_dir, name + ".gz")))
+        
+        # Each patch applies to the version of the index that the previous one made.
+        self.assertNotEqual(patches[0][1], patches[1][1])
+
+class CompressionTest(RepositoryTest):
+
+    def test_changed_formats(self):
+    
+        benchmark.apply_settings(self.root_path, [("by-hash", "enabled", "yes")])
+        
+        self.add_package("example", "1.0-1")
+        self.add_source("example", "1.0-1")
+        self.update()
+        
+        paths = [os.path.join(self.component_path, "binary-amd64", "Packages"),
+                 os.path.join(self.component_path, "source", "Sources")]
+        
+        checksums = []
+        for path in paths:
+            self.assertTrue(os.path.exists(path + ".bz2"))
+            checksums.append(repo_setup.compute_checksums(path + ".bz2")["SHA256"])
+        
+        benchmark.apply_settings(self.root_path, [("compression", "packages", "gz"),
+                                                  ("compression", "sources", "gz")])
+        self.update()
+        
+        # Neither the compressed indices in the old format nor their by-hash files
+        # are left behind.
+        for path, checksum in zip(paths, checksums):
+            self.assertTrue(os.path.exists(path + ".gz"))
+            self.assertFalse(os.path.exists(path + ".bz2"))
+            self.assertFalse(os.path.exists(os.path.join(
+                os.path.split(path)[0], repo_setup.by_hash_dir_name, "SHA256", checksum)))
+
+class CatalogueTest(RepositoryTest):
+
+    def test_versions_of_a_source(self):
+    
+        benchmark.apply_settings(self.root_path, [("catalogue", "database", "yes")])
+        
+        self.add_source("example", "1.0-1")
+        self.add_source("example", "1.1-1")
+        self.update()
+        self.update()
+        
+        # Only one version is in the index, but both are in the catalogue.
+        connection = repo_setup.sqlite3.connect(os.path.join(
+            self.root_path, repo_setup.state_dir_name, repo_setup.catalogue_name))
+        paths = sorted(map(lambda row: os.path.split(row[0])[1],
+                           connection.execute("SELECT path FROM sources")))
+        connection.close()
+        
+        self.assertEqual(paths, ["example_1.0-1.dsc", "example_1.1-1.dsc"])
+
+if __name__ == "__main__":
+    unittest.main()